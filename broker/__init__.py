@@ -6,13 +6,64 @@ real-time processing for alerts from the  Zwicky Transient Facility (ZTF) and
 the Large Synoptic Survey Telescope (LSST).
 """
 
+import logging
 import os
 from warnings import warn
 
-if 'PGB_OFFLINE' not in os.environ:
-    from google.cloud import logging as cloud_logging
+# Loggers that should not be forwarded to Stackdriver. This matches the
+# defaults used by ``google.cloud.logging.Client.setup_logging``.
+_EXCLUDED_LOGGERS = (
+    'google.cloud',
+    'google.auth',
+    'google_auth_httplib2',
+    'google.api_core.bidi',
+    'werkzeug',
+)
+
+
+class _CloudLoggingHandler(logging.Handler):
+    """Forwards log records to Google Cloud Logging
+
+    The cloud logging client is only created when the first record is
+    emitted so that importing ``broker`` does not load the Google Cloud
+    libraries or authenticate with GCP. If the client cannot be created,
+    a warning is issued once and records are written to stderr instead.
+    """
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self._handler = None
+
+    def _get_handler(self) -> logging.Handler:
+        """Return the cloud logging handler, creating it if necessary"""
+
+        if self._handler is None:
+            try:
+                from google.cloud import logging as cloud_logging
+
+                handler = cloud_logging.Client().get_default_handler()
 
-    cloud_logging.Client().setup_logging()
+            except Exception as e:
+                warn(f'Could not connect to Google Cloud Logging ({e!r}). '
+                     f'Logging to stderr instead.')
+                handler = logging.StreamHandler()
+
+            else:
+                for logger_name in _EXCLUDED_LOGGERS:
+                    logging.getLogger(logger_name).propagate = False
+
+            self._handler = handler
+
+        return self._handler
+
+    def emit(self, record):
+        self._get_handler().handle(record)
+
+
+if 'PGB_OFFLINE' not in os.environ:
+    _root_logger = logging.getLogger()
+    _root_logger.setLevel(logging.INFO)
+    _root_logger.addHandler(_CloudLoggingHandler())
 
 for _var in ('GOOGLE_CLOUD_PROJECT', 'GOOGLE_APPLICATION_CREDENTIALS'):
     if _var not in os.environ:
@@ -63,7 +63,7 @@ from confluent_kafka import Consumer, KafkaException
 from broker import exceptions
 from broker.pub_sub_client.message_service import publish_pubsub
 
-if not os.getenv('GPB_OFFLINE', False):
+if 'PGB_OFFLINE' not in os.environ:
     from google.cloud import pubsub, storage
     from google.cloud.pubsub_v1.publisher.futures import Future
 
@@ -30,7 +30,7 @@ Module Documentation
 import os
 from pathlib import Path
 
-if not os.getenv('GPB_OFFLINE', False):
+if 'PGB_OFFLINE' not in os.environ:
     from google.api_core.exceptions import NotFound
     from google.cloud import bigquery, pubsub, logging, storage
 
@@ -89,7 +89,7 @@ def setup_pubsub() -> None:
     """ Create new Pub/Sub topics and subscriptions
 
     New topics [subscriptions] include:
-        ``ztf_alert_data``
+        ``ztf_alert_data`` [``ztf_alert_data_value_added``]
         ``ztf_alert_avro_in_bucket``
         ``ztf_alerts_in_BQ``
         ``test_alerts_in_BQ``
@@ -97,7 +97,7 @@ def setup_pubsub() -> None:
     """
 
     topics = {# '<topic_name>': ['<subscription_name>', ]
-                'ztf_alert_data': [],
+                'ztf_alert_data': ['ztf_alert_data_value_added'],
                 'ztf_alert_avro_in_bucket': [],
                 'ztf_alerts_in_BQ': [],
                 'test_alerts_in_BQ': [],
@@ -2,6 +2,8 @@
 # -*- coding: UTF-8 -*-
 
 """The ``pub_sub_client`` module publishes messages to a Pub/Sub topic and downloads alerts from a Pub/Sub subscription.
+The ``local_pubsub`` submodule provides in-process stand-ins for the Pub/Sub clients.
 """
 
+from . import local_pubsub
 from . import message_service
@@ -0,0 +1,493 @@
+"""In-process stand-in for the Pub/Sub publisher and subscriber clients.
+
+The clients implement the subset of the ``google.cloud.pubsub_v1`` API used
+by the broker (topic and subscription paths, publishing, streaming pull
+with flow control, ack and nack), backed by queues held in memory. They can
+be passed wherever a ``pubsub_v1`` client is accepted so that consumers can
+be run and load tested without a GCP project.
+
+Usage Example:
+
+    ```python
+    from broker.pub_sub_client import local_pubsub
+
+    publisher = local_pubsub.PublisherClient()
+    subscriber = local_pubsub.SubscriberClient()
+    topic = publisher.topic_path('my-project', 'ztf_alert_data')
+    subscription = subscriber.subscription_path('my-project', 'my_sub')
+    publisher.create_topic(name=topic)
+    subscriber.create_subscription(name=subscription, topic=topic)
+
+    publisher.publish(topic, b'alert bytes').result()
+    future = subscriber.subscribe(subscription, callback=lambda m: m.ack())
+    ```
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+log = logging.getLogger(__name__)
+
+
+class FlowControl(NamedTuple):
+    """Limits on the messages a streaming pull holds without acking them"""
+
+    max_bytes: int = 100 * 1024 * 1024
+    max_messages: int = 1000
+    max_lease_duration: float = 3600
+
+
+class _Record:
+    """A published message and its delivery state in one subscription"""
+
+    def __init__(self, message_id, data, attributes, publish_time):
+        self.message_id = message_id
+        self.data = data
+        self.attributes = attributes
+        self.publish_time = publish_time
+        self.delivery_attempt = 0
+
+
+class _Subscription:
+    """Queued and outstanding (delivered but not acked) messages"""
+
+    def __init__(self, topic, ack_deadline_seconds):
+        self.topic = topic
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self.pending = deque()
+        self.outstanding = dict()  # ack_id -> (record, deadline)
+        self.num_acked = 0
+
+
+class LocalPubSub:
+    """Topics and subscriptions shared by local publisher and subscriber clients
+
+    Messages published to a topic are copied to each of its subscriptions.
+    Delivered messages are redelivered if they are nacked or not acked
+    before their ack deadline.
+    """
+
+    def __init__(self):
+        self._topics = dict()  # topic path -> [subscription paths]
+        self._subscriptions = dict()  # subscription path -> _Subscription
+        self._message_ids = itertools.count(1)
+        self._ack_ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return (f'<LocalPubSub(topics: {len(self._topics)}, '
+                f'subscriptions: {len(self._subscriptions)})>')
+
+    def create_topic(self, topic):
+        """Create a topic, if it does not already exist
+
+        Args:
+            topic (str): The topic path
+        """
+
+        with self._condition:
+            self._topics.setdefault(topic, [])
+
+    def create_subscription(self, subscription, topic, ack_deadline_seconds=10):
+        """Create a subscription to a topic, if it does not already exist
+
+        Args:
+            subscription         (str): The subscription path
+            topic                (str): The topic path
+            ack_deadline_seconds (int): Seconds before an unacked message is
+                                        redelivered
+        """
+
+        with self._condition:
+            if subscription in self._subscriptions:
+                return
+
+            self.create_topic(topic)
+            self._topics[topic].append(subscription)
+            self._subscriptions[subscription] = _Subscription(
+                topic, ack_deadline_seconds)
+
+    def _get_subscription(self, subscription):
+        try:
+            return self._subscriptions[subscription]
+
+        except KeyError:
+            raise ValueError(f'Subscription not found: {subscription}') from None
+
+    def publish(self, topic, data, attributes=None):
+        """Add a message to each subscription of a topic
+
+        Args:
+            topic       (str): The topic path
+            data      (bytes): The message data
+            attributes (dict): Message attributes
+
+        Returns:
+            The message id as a string
+        """
+
+        if not isinstance(data, bytes):
+            raise TypeError('Message data must be a bytestring.')
+
+        with self._condition:
+            if topic not in self._topics:
+                raise ValueError(f'Topic not found: {topic}')
+
+            message_id = str(next(self._message_ids))
+            for subscription in self._topics[topic]:
+                record = _Record(message_id, data, dict(attributes or {}),
+                                 time.time())
+                self._subscriptions[subscription].pending.append(record)
+
+            self._condition.notify_all()
+
+        return message_id
+
+    def pull(self, subscription, max_messages, timeout=None):
+        """Lease up to ``max_messages`` messages from a subscription
+
+        Args:
+            subscription  (str): The subscription path
+            max_messages  (int): Maximum number of messages to return
+            timeout     (float): Seconds to wait for a message. Waits
+                                 indefinitely if None.
+
+        Returns:
+            A list of (ack_id, record) tuples. Empty on timeout.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            sub = self._get_subscription(subscription)
+            self._expire(sub)
+            while not sub.pending:
+                wait = 1.  # recheck ack deadlines at least once a second
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return []
+
+                self._condition.wait(wait)
+                self._expire(sub)
+
+            leased = []
+            ack_deadline = time.monotonic() + sub.ack_deadline_seconds
+            while sub.pending and len(leased) < max_messages:
+                record = sub.pending.popleft()
+                record.delivery_attempt += 1
+                ack_id = str(next(self._ack_ids))
+                sub.outstanding[ack_id] = (record, ack_deadline)
+                leased.append((ack_id, record))
+
+            return leased
+
+    @staticmethod
+    def _expire(sub):
+        """Return messages past their ack deadline to the queue"""
+
+        now = time.monotonic()
+        expired = [ack_id for ack_id, (_, deadline) in sub.outstanding.items()
+                   if deadline <= now]
+
+        for ack_id in reversed(expired):
+            sub.pending.appendleft(sub.outstanding.pop(ack_id)[0])
+
+    def acknowledge(self, subscription, ack_ids):
+        """Remove delivered messages from a subscription
+
+        Acks for expired or unknown ack ids are ignored.
+
+        Args:
+            subscription (str): The subscription path
+            ack_ids     (list): Ack ids of the messages
+        """
+
+        with self._condition:
+            sub = self._get_subscription(subscription)
+            for ack_id in ack_ids:
+                if sub.outstanding.pop(ack_id, None) is not None:
+                    sub.num_acked += 1
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        """Change the ack deadline of delivered messages
+
+        A deadline of 0 makes the messages available for redelivery.
+
+        Args:
+            subscription         (str): The subscription path
+            ack_ids             (list): Ack ids of the messages
+            ack_deadline_seconds (int): Seconds from now until redelivery
+        """
+
+        with self._condition:
+            sub = self._get_subscription(subscription)
+            if ack_deadline_seconds <= 0:
+                for ack_id in reversed(ack_ids):
+                    if ack_id in sub.outstanding:
+                        sub.pending.appendleft(sub.outstanding.pop(ack_id)[0])
+
+                self._condition.notify_all()
+                return
+
+            deadline = time.monotonic() + ack_deadline_seconds
+            for ack_id in ack_ids:
+                if ack_id in sub.outstanding:
+                    sub.outstanding[ack_id] = (sub.outstanding[ack_id][0], deadline)
+
+    def get_stats(self, subscription):
+        """Return message counts for a subscription
+
+        Args:
+            subscription (str): The subscription path
+
+        Returns:
+            A dictionary with the number of pending, outstanding and acked
+            messages
+        """
+
+        with self._condition:
+            sub = self._get_subscription(subscription)
+            return {
+                'pending': len(sub.pending),
+                'outstanding': len(sub.outstanding),
+                'acked': sub.num_acked,
+            }
+
+
+_default_pubsub = LocalPubSub()
+
+
+def get_default_pubsub():
+    """Return the LocalPubSub shared by clients created without one"""
+
+    return _default_pubsub
+
+
+class Message:
+    """A message delivered by a streaming pull"""
+
+    def __init__(self, pubsub, subscription, ack_id, record, on_done):
+        self._pubsub = pubsub
+        self._subscription = subscription
+        self._on_done = on_done
+        self.ack_id = ack_id
+        self.message_id = record.message_id
+        self.data = record.data
+        self.attributes = record.attributes
+        self.publish_time = record.publish_time
+        self.delivery_attempt = record.delivery_attempt
+        self.size = len(record.data)
+
+    def __repr__(self):
+        return f'<Message(message_id: {self.message_id}, size: {self.size})>'
+
+    def ack(self):
+        """Acknowledge the message so it is not redelivered"""
+
+        self._pubsub.acknowledge(self._subscription, [self.ack_id])
+        self._on_done(self)
+
+    def nack(self):
+        """Release the message for immediate redelivery"""
+
+        self._pubsub.modify_ack_deadline(self._subscription, [self.ack_id], 0)
+        self._on_done(self)
+
+    def modify_ack_deadline(self, seconds):
+        """Extend (or, with 0, release) the lease of the message"""
+
+        self._pubsub.modify_ack_deadline(self._subscription, [self.ack_id], seconds)
+
+
+class StreamingPullFuture(Future):
+    """Represents a running streaming pull. Cancel it to stop the pull."""
+
+    def __init__(self):
+        super().__init__()
+        self._stop = threading.Event()
+        self.set_running_or_notify_cancel()
+
+    def cancel(self):
+        """Stop pulling messages
+
+        Messages that were delivered but not acked are redelivered after
+        their ack deadline.
+        """
+
+        self._stop.set()
+        return True
+
+    def cancelled(self):
+        return self._stop.is_set()
+
+
+class _StreamingPull:
+    """Delivers messages from a subscription to a callback"""
+
+    def __init__(self, pubsub, subscription, callback, flow_control,
+                 max_callback_threads):
+        self.pubsub = pubsub
+        self.subscription = subscription
+        self.callback = callback
+        self.flow_control = flow_control
+        self.future = StreamingPullFuture()
+        self._executor = ThreadPoolExecutor(
+            max_callback_threads, thread_name_prefix='LocalPubSubCallback')
+        self._held = dict()  # ack_id -> (message, lease start)
+        self._held_bytes = 0
+        self._released = threading.Condition()
+
+    def _release(self, message):
+        with self._released:
+            if self._held.pop(message.ack_id, None) is not None:
+                self._held_bytes -= message.size
+                self._released.notify_all()
+
+    def _extend_leases(self):
+        """Extend the ack deadline of held messages, like the real client"""
+
+        sub = self.pubsub._get_subscription(self.subscription)
+        now = time.monotonic()
+        with self._released:
+            ack_ids = [ack_id for ack_id, (_, start) in self._held.items()
+                       if now - start < self.flow_control.max_lease_duration]
+
+        if ack_ids:
+            self.pubsub.modify_ack_deadline(
+                self.subscription, ack_ids, sub.ack_deadline_seconds)
+
+    def _invoke(self, message):
+        try:
+            self.callback(message)
+
+        except Exception:
+            log.exception('Error in subscriber callback. Message will be nacked.')
+            message.nack()
+
+    def run(self):
+        try:
+            sub = self.pubsub._get_subscription(self.subscription)
+            poll = min(1., sub.ack_deadline_seconds / 2)
+            next_lease = time.monotonic() + poll
+            while not self.future._stop.is_set():
+                if time.monotonic() >= next_lease:
+                    self._extend_leases()
+                    next_lease = time.monotonic() + poll
+
+                # Flow control: wait for held messages to be acked or nacked
+                with self._released:
+                    num_held = len(self._held)
+                    if (num_held >= self.flow_control.max_messages
+                            or self._held_bytes >= self.flow_control.max_bytes):
+                        self._released.wait(poll)
+                        continue
+
+                max_messages = self.flow_control.max_messages - num_held
+                for ack_id, record in self.pubsub.pull(
+                        self.subscription, max_messages, timeout=poll):
+                    message = Message(self.pubsub, self.subscription, ack_id,
+                                      record, self._release)
+                    with self._released:
+                        self._held[ack_id] = (message, time.monotonic())
+                        self._held_bytes += message.size
+
+                    self._executor.submit(self._invoke, message)
+
+        except Exception as e:
+            self._executor.shutdown(wait=False)
+            self.future.set_exception(e)
+
+        else:
+            self._executor.shutdown(wait=True)
+            self.future.set_result(None)
+
+
+class PublisherClient:
+    """Local stand-in for ``google.cloud.pubsub_v1.PublisherClient``"""
+
+    def __init__(self, pubsub=None):
+        """Local stand-in for ``google.cloud.pubsub_v1.PublisherClient``
+
+        Args:
+            pubsub (LocalPubSub): Topics to publish to. Defaults to the
+                                  instance shared by all local clients.
+        """
+
+        self.pubsub = get_default_pubsub() if pubsub is None else pubsub
+
+    @staticmethod
+    def topic_path(project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def create_topic(self, name):
+        self.pubsub.create_topic(name)
+
+    def publish(self, topic, data, **attributes):
+        """Publish a message
+
+        Args:
+            topic  (str): The topic path
+            data (bytes): The message, already encoded
+            attributes  : Message attributes as keyword arguments
+
+        Returns:
+            A future resolving to the message id
+        """
+
+        future = Future()
+        try:
+            future.set_result(self.pubsub.publish(topic, data, attributes))
+
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+class SubscriberClient:
+    """Local stand-in for ``google.cloud.pubsub_v1.SubscriberClient``"""
+
+    def __init__(self, pubsub=None):
+        """Local stand-in for ``google.cloud.pubsub_v1.SubscriberClient``
+
+        Args:
+            pubsub (LocalPubSub): Subscriptions to pull from. Defaults to the
+                                  instance shared by all local clients.
+        """
+
+        self.pubsub = get_default_pubsub() if pubsub is None else pubsub
+
+    @staticmethod
+    def subscription_path(project, subscription):
+        return f'projects/{project}/subscriptions/{subscription}'
+
+    def create_subscription(self, name, topic, ack_deadline_seconds=10):
+        self.pubsub.create_subscription(name, topic, ack_deadline_seconds)
+
+    def subscribe(self, subscription, callback, flow_control=FlowControl(),
+                  max_callback_threads=10):
+        """Start a streaming pull in a background thread
+
+        Args:
+            subscription        (str): The subscription path
+            callback       (callable): Called with each ``Message``
+            flow_control (FlowControl): Limits on unacked messages
+            max_callback_threads (int): Number of threads running callbacks
+
+        Returns:
+            A ``StreamingPullFuture``. Cancel it to stop the pull.
+        """
+
+        self.pubsub._get_subscription(subscription)  # raise early if missing
+        pull = _StreamingPull(self.pubsub, subscription, callback,
+                              flow_control, max_callback_threads)
+
+        thread = threading.Thread(target=pull.run, name='LocalStreamingPull',
+                                  daemon=True)
+        thread.start()
+        return pull.future
@@ -2,7 +2,9 @@
 
 import logging
 import os
-from google.cloud import pubsub_v1
+
+if 'PGB_OFFLINE' not in os.environ:
+    from google.cloud import pubsub_v1
 
 log = logging.getLogger(__name__)
 
@@ -5,6 +5,39 @@
 to all value added products (e.g. classification, cross matches, etc.)
 """
 
-from .classify import rapid
-from .value_added import get_value_added
-from .xmatch import get_xmatches
+import importlib as _importlib
+
+# Public objects and the submodules defining them. Submodules are only
+# imported when an object is first accessed.
+_LAZY_OBJECTS = {
+    'ClassificationCache': 'classify',
+    'LocalCatalog': 'catalog',
+    'RapidClassifierService': 'classifier_service',
+    'RapidPlotter': 'plotting',
+    'ResultStore': 'result_store',
+    'ValueAddedWorker': 'worker',
+    'rapid': 'classify',
+    'get_value_added': 'value_added',
+    'get_value_added_by_candid': 'value_added',
+    'iter_value_added': 'stream',
+    'get_xmatches': 'xmatch',
+    'get_xmatches_table': 'xmatch',
+}
+
+__all__ = sorted(_LAZY_OBJECTS)
+
+
+def __getattr__(name):
+    """Import objects from submodules on first access"""
+
+    if name in _LAZY_OBJECTS:
+        module = _importlib.import_module(f'.{_LAZY_OBJECTS[name]}', __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -3,18 +3,15 @@
 
 """This module handles the uploading of generic data into bigquery."""
 
+import logging
 import os
 from tempfile import NamedTemporaryFile
 from warnings import warn
 
-import pandavro as pdx
-
-from broker.ztf_archive._utils import RTDSafeImport, setup_log
-
-with RTDSafeImport():
+if 'PGB_OFFLINE' not in os.environ:
     from google.cloud import bigquery, storage
 
-    error_client, log = setup_log('data_upload')
+log = logging.getLogger(__name__)
 
 
 def _get_table_id(data_set, table):
@@ -58,7 +55,7 @@ def _batch_ingest(data, data_set, table):
     """Batch upload a Pandas DataFrame into a BigQuery table
 
     Alert data may be temporarily written to disk. If the table does not
-    exist, create it.
+    exist, create it. Blocks until the load job has finished.
 
     Args:
         data (DataFrame): Data to upload to table
@@ -66,6 +63,8 @@ def _batch_ingest(data, data_set, table):
         table      (str): The name of the table
     """
 
+    import pandavro as pdx
+
     # Configure batch loading
     job_config = bigquery.LoadJobConfig()
     job_config.source_format = bigquery.SourceFormat.AVRO
@@ -77,25 +76,24 @@ def _batch_ingest(data, data_set, table):
     with NamedTemporaryFile() as source_file:
         pdx.to_avro(source_file.name, data)
 
-        try:
-            # API request
-            log.debug('Launching batch upload job.')
-            job = bq_client.load_table_from_file(
-                source_file,
-                table_id,
-                location="US",
-                job_config=job_config,
-            )
+        # API request
+        log.debug('Launching batch upload job.')
+        job = bq_client.load_table_from_file(
+            source_file,
+            table_id,
+            location="US",
+            job_config=job_config,
+        )
 
-        except KeyboardInterrupt:
-            job.result()
-            raise
+        # Wait for the data to be loaded. Raises if the job failed.
+        job.result()
 
 
 def upload_to_bigquery(data, data_set, table_name, method='batch', max_tries=1):
     """Batch upload a Pandas DataFrame into a BigQuery table
 
     If the upload fails, retry until success or until max_tries is reached.
+    Returns only once the data has been loaded.
 
     Args:
         data (DataFrame): Data to upload to table
@@ -103,6 +101,9 @@ def upload_to_bigquery(data, data_set, table_name, method='batch', max_tries=1):
         table_name (str): The name of the table
         method     (str): The method upload name ('batch' or 'stream')
         max_tries  (int): Maximum number of tries until error (Default: 1)
+
+    Raises:
+        RuntimeError if the data could not be uploaded within max_tries
     """
 
     if method == 'batch':
@@ -114,10 +115,8 @@ def upload_to_bigquery(data, data_set, table_name, method='batch', max_tries=1):
     else:
         raise ValueError(f'Invalid upload method: {method}')
 
+    error = None
     for i in range(max_tries):
-        if i >= max_tries:
-            raise RuntimeError('Could not upload data. Max tries exceeded.')
-
         try:
             upload_func(data, data_set, table_name)
 
@@ -126,8 +125,12 @@ def upload_to_bigquery(data, data_set, table_name, method='batch', max_tries=1):
 
         except Exception as e:
             warn(f'Error uploading to table {table_name}. Trying again: {str(e)}')
+            error = e
+
+        else:
+            return
 
-            continue
+    raise RuntimeError('Could not upload data. Max tries exceeded.') from error
 
 
 def upload_to_bucket(bucket_name, source_path, destination_name):
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``catalog`` module cross matches alerts against local copies of
+    external catalogs (e.g. 2MASS, Gaia, or a PS1 galaxy subset).
+
+    Catalog positions are held in a kd-tree built on unit vectors, so a
+    whole batch of alerts is matched in a single vectorized query without
+    any network access. Matches are returned in the same format as
+    xmatch.get_xmatches().
+
+    Usage Example:
+
+        ```python
+        from broker.value_added.catalog import LocalCatalog
+
+        gaia = LocalCatalog.from_file('gaia_subset.parquet', 'Gaia',
+                                      id_col='source_id')
+        gaia.save('gaia_subset.npz')  # faster to load next time
+
+        xmatch_dicts = gaia.get_xmatches(alert_list, radius=2)
+        ```
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from broker.ztf_archive import chord_length, radec_to_xyz
+from .xmatch import XMATCH_COLUMNS
+
+ARCSEC_PER_RAD = np.degrees(1) * 3600
+
+
+def _chord_to_arcsec(chord):
+    """ Angular separation in arcsec of unit vectors a chord length apart."""
+
+    return 2 * np.arcsin(np.clip(chord / 2, 0, 1)) * ARCSEC_PER_RAD
+
+
+class LocalCatalog:
+    """ A catalog of sources held in a kd-tree for fast cross matching."""
+
+    def __init__(self, name, ids, ra, dec, redshift=None, sgscore=None):
+        """
+        Args:
+            name         (str): Catalog name, used as the xcatalog value
+
+            ids   (array-like): Source ids, used as the xobjId value
+
+            ra    (array-like): Source Right Ascension in degrees
+
+            dec   (array-like): Source Declination in degrees
+
+            redshift (array-like): Source redshifts (Optional).
+                                   Defaults to -1, as for stars in
+                                   xmatch.get_xmatches().
+
+            sgscore  (array-like): Source star/galaxy scores (Optional).
+                                   Defaults to NaN.
+        """
+
+        from scipy.spatial import cKDTree
+
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        is_valid = np.isfinite(ra) & np.isfinite(dec)
+
+        self.name = name
+        self.ids = np.asarray(ids)[is_valid]
+        self.ra = ra[is_valid]
+        self.dec = dec[is_valid]
+        self.redshift = np.full(len(self.ra), -1.) if redshift is None \
+            else np.asarray(redshift, dtype=float)[is_valid]
+        self.sgscore = np.full(len(self.ra), np.nan) if sgscore is None \
+            else np.asarray(sgscore, dtype=float)[is_valid]
+
+        self.tree = cKDTree(radec_to_xyz(self.ra, self.dec).reshape(-1, 3))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return f'<LocalCatalog({self.name}, sources: {len(self)})>'
+
+    @classmethod
+    def from_file(cls, path, name, id_col='id', ra_col='ra', dec_col='dec',
+                  redshift_col=None, sgscore_col=None):
+        """ Loads a catalog from a CSV, Parquet or FITS table.
+
+        Args:
+            path         (str): Path of the table
+            name         (str): Catalog name, used as the xcatalog value
+            id_col       (str): Column of source ids
+            ra_col       (str): Column of Right Ascension in degrees
+            dec_col      (str): Column of Declination in degrees
+            redshift_col (str): Column of redshifts (Optional)
+            sgscore_col  (str): Column of star/galaxy scores (Optional)
+
+        Returns:
+            A LocalCatalog object
+        """
+
+        import pandas as pd
+
+        path = Path(path)
+        columns = [c for c in (id_col, ra_col, dec_col, redshift_col,
+                               sgscore_col) if c is not None]
+
+        if path.suffix == '.parquet':
+            table = pd.read_parquet(path, columns=columns)
+
+        elif path.suffix in ('.fits', '.fit'):
+            from astropy.table import Table
+
+            table = Table.read(path)[columns].to_pandas()
+
+        else:
+            table = pd.read_csv(path, usecols=columns)
+
+        def column(col):
+            return None if col is None else table[col].to_numpy()
+
+        return cls(name, column(id_col), column(ra_col), column(dec_col),
+                   redshift=column(redshift_col),
+                   sgscore=column(sgscore_col))
+
+    def save(self, path):
+        """ Saves the catalog as a numpy .npz file.
+
+        Args:
+            path (str): Output path
+        """
+
+        np.savez(path, name=self.name, ids=self.ids, ra=self.ra,
+                 dec=self.dec, redshift=self.redshift, sgscore=self.sgscore)
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a catalog written by save().
+
+        Args:
+            path (str): Path of the .npz file
+
+        Returns:
+            A LocalCatalog object
+        """
+
+        with np.load(path, allow_pickle=True) as data:
+            return cls(str(data['name']), data['ids'], data['ra'], data['dec'],
+                       redshift=data['redshift'], sgscore=data['sgscore'])
+
+    def match(self, ra, dec, radius=5., nearest=True):
+        """ Finds catalog sources near a batch of positions.
+
+        Args:
+            ra  (array-like): Right Ascension in degrees
+            dec (array-like): Declination in degrees
+            radius   (float): Match radius in arcsec
+            nearest   (bool): Return only the nearest source per position.
+                              Otherwise return all sources within radius.
+
+        Returns:
+            position indices, catalog indices and separations (arcsec),
+            as three arrays ordered by position and then by separation
+        """
+
+        xyz = radec_to_xyz(np.atleast_1d(ra), np.atleast_1d(dec)).reshape(-1, 3)
+        is_valid = np.isfinite(xyz).all(axis=1)
+        positions = np.flatnonzero(is_valid)
+        chord = chord_length(radius / 3600)
+
+        if len(self) == 0 or len(positions) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+
+        if nearest:
+            dist, rows = self.tree.query(xyz[is_valid], k=1,
+                                         distance_upper_bound=chord)
+            found = np.isfinite(dist)
+            return (positions[found], rows[found].astype(np.int64),
+                    _chord_to_arcsec(dist[found]))
+
+        neighbors = self.tree.query_ball_point(xyz[is_valid], chord)
+        counts = np.fromiter((len(n) for n in neighbors), dtype=np.int64,
+                             count=len(neighbors))
+        pos_idx = np.repeat(positions, counts)
+        rows = np.fromiter((r for n in neighbors for r in n), dtype=np.int64,
+                           count=counts.sum())
+        chords = np.linalg.norm(self.tree.data[rows] - xyz[pos_idx], axis=1)
+
+        order = np.lexsort((chords, pos_idx))
+        return pos_idx[order], rows[order], _chord_to_arcsec(chords[order])
+
+    def get_xmatches_table(self, alert_list, radius=5., nearest=True,
+                           alert_index=False):
+        """ Cross matches a batch of alerts against the catalog.
+
+        Args:
+            alert_list (list): list of alert dicts
+            radius    (float): Match radius in arcsec
+            nearest    (bool): Return only the nearest source per alert
+            alert_index (bool): Also return the position in alert_list of
+                                the alert of each row
+
+        Returns:
+            Pandas DataFrame of cross match info, formatted for BigQuery,
+            with columns xmatch.XMATCH_COLUMNS. dist2d is in arcsec.
+
+            If alert_index is True, returns (table, alert indices (np.array)).
+        """
+
+        import pandas as pd
+
+        if len(alert_list) == 0:
+            table = pd.DataFrame(columns=XMATCH_COLUMNS)
+            return (table, np.empty(0, dtype=np.int64)) if alert_index else table
+
+        ra = [alert['candidate']['ra'] for alert in alert_list]
+        dec = [alert['candidate']['dec'] for alert in alert_list]
+        alert_idx, rows, sep = self.match(
+            np.array(ra, dtype=float), np.array(dec, dtype=float),
+            radius=radius, nearest=nearest)
+
+        object_ids = np.array([alert['objectId'] for alert in alert_list],
+                              dtype=object)
+
+        table = pd.DataFrame({
+            'objectId': object_ids[alert_idx],
+            'xobjId': np.array(self.ids[rows].tolist(), dtype=object),  # builtin types
+            'xcatalog': self.name,
+            'redshift': self.redshift[rows],
+            'dist2d': sep,
+            'sgscore': self.sgscore[rows],
+        }, columns=XMATCH_COLUMNS)
+
+        return (table, alert_idx) if alert_index else table
+
+    def get_xmatches(self, alert_list, radius=5., nearest=True):
+        """ Cross matches a batch of alerts against the catalog.
+
+        Args:
+            as for get_xmatches_table()
+
+        Returns:
+            Dictionaries of cross match info, formatted for BigQuery.
+            One dictionary per unique alert-xmatch pair, as returned by
+            xmatch.get_xmatches().
+            [ {<column name (str)>: <value (str or float)>} ]
+        """
+
+        return self.get_xmatches_table(alert_list, radius=radius,
+                                       nearest=nearest).to_dict('records')
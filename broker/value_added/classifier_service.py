@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``classifier_service`` module runs a long-lived RAPID classifier
+    that is shared by many callers in the same process.
+
+    The model is loaded once, in a background thread. Light curves are
+    submitted over a queue and classified in micro-batches that are formed
+    by size and deadline. Each caller receives a future per light curve.
+
+    Usage Example:
+
+        ```python
+        from broker.value_added import value_added as va
+        from broker.value_added.classifier_service import RapidClassifierService
+
+        light_curves, cx_dicts = va.format_for_rapid(alert_list, xmatch_list)
+        with RapidClassifierService(max_batch_size=512) as service:
+            classification_dicts = service.classify(light_curves, cx_dicts)
+        ```
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .classify import format_rapid_for_BQ, new_rapid_classifier
+
+_STOP = object()  # queue sentinel
+
+
+class RapidClassifierService:
+    """ Classifies light curves with RAPID in micro-batches on a
+        background thread.
+    """
+
+    def __init__(self, max_batch_size=256, max_latency=0.25,
+                 classifier_factory=new_rapid_classifier):
+        """
+        Args:
+            max_batch_size    (int): Maximum number of light curves per batch.
+
+            max_latency     (float): Maximum number of seconds a light curve
+                                     waits for its batch to fill up.
+
+            classifier_factory (callable): Returns the classifier. Called once
+                                           on the worker thread. Must return
+                                           an object with astrorapid's
+                                           get_predictions() interface that
+                                           is not shared with other threads
+                                           (e.g. with classify.rapid()).
+        """
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.classifier_factory = classifier_factory
+        self.class_names = None  # known once the model is loaded
+        self.num_batches = 0
+        self.num_classified = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        status = 'running' if self.running else 'stopped'
+        return f'<RapidClassifierService({status}, batches: {self.num_batches})>'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        """ Whether the worker thread is alive."""
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """ Starts the worker thread, if it is not already running."""
+
+        with self._lock:
+            if not self.running:
+                self._thread = threading.Thread(
+                    target=self._run, name='RapidClassifierService',
+                    daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Classifies any queued light curves and stops the worker thread.
+
+        Args:
+            timeout (float): Seconds to wait for the worker to finish.
+        """
+
+        with self._lock:
+            if self.running:
+                self._queue.put(_STOP)
+                self._thread.join(timeout)
+
+    def submit(self, light_curve):
+        """ Queues a single light curve for classification.
+
+        Args:
+            light_curve (tuple): light_curve_info formatted for input to RAPID,
+                                 as given by value_added.format_for_rapid()
+
+        Returns:
+            A Future resolving to (predictions, times) for the light curve,
+            as returned by astrorapid's get_predictions(), or None if RAPID
+            did not classify it.
+        """
+
+        if not self.running:
+            raise RuntimeError('RapidClassifierService is not running.')
+
+        future = Future()
+        self._queue.put((light_curve, future))
+        return future
+
+    def submit_many(self, light_curves):
+        """ Queues light curves for classification.
+
+        Args:
+            light_curves (list): light curves as accepted by submit()
+
+        Returns:
+            list of futures, one per light curve in input order
+        """
+
+        return [self.submit(lc) for lc in light_curves]
+
+    def classify(self, light_curves, cx_dicts, timeout=None):
+        """ Classifies light curves and waits for the results.
+
+        Args:
+            light_curves (list): as for classify.rapid()
+            cx_dicts     (dict): as for classify.rapid()
+            timeout     (float): Seconds to wait for each result.
+
+        Returns:
+            Classification dictionaries, as returned by classify.rapid()
+        """
+
+        return format_rapid_for_BQ(cx_dicts, self.predict(light_curves, timeout))
+
+    def predict(self, light_curves, timeout=None):
+        """ Classifies light curves and waits for the raw predictions.
+
+        Args:
+            light_curves (list): as for classify.rapid()
+            timeout     (float): Seconds to wait for each result.
+
+        Returns:
+            (predictions, times, cxids) for the classified light curves,
+            as returned by astrorapid's get_predictions()
+        """
+
+        futures = self.submit_many(light_curves)
+        predictions = ([], [], [])
+        for lc, future in zip(light_curves, futures):
+            result = future.result(timeout)
+            if result is None:
+                continue
+
+            lc_preds, lc_times = result
+            predictions[0].append(lc_preds)
+            predictions[1].append(lc_times)
+            predictions[2].append(lc[7])
+
+        return predictions
+
+    def _next_batch(self):
+        """ Collects the next batch from the queue.
+
+        Returns:
+            list of (light_curve, future) tuples and whether to stop
+        """
+
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 \
+                    else self._queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if item is _STOP:
+                return batch, True
+
+            batch.append(item)
+
+        return batch, False
+
+    def _classify_batch(self, classifier, batch):
+        """ Classifies a batch and resolves its futures."""
+
+        batch = [(lc, f) for lc, f in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            preds, times, objids = classifier.get_predictions(
+                [lc for lc, _ in batch], return_predictions_at_obstime=True,
+                return_objids=True)
+
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+            return
+
+        results = {objid: (p, t) for p, t, objid in zip(preds, times, objids)}
+        for lc, future in batch:
+            future.set_result(results.get(lc[7]))
+
+        self.num_batches += 1
+        self.num_classified += len(results)
+
+    def _run(self):
+        """ Worker loop: loads the model and classifies queued batches."""
+
+        classifier = None
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                continue
+
+            if classifier is None:
+                try:
+                    classifier = self.classifier_factory()
+                    self.class_names = getattr(classifier, 'class_names', None)
+
+                except Exception as e:
+                    for _, future in batch:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(e)
+
+                    continue
+
+            self._classify_batch(classifier, batch)
+
+        # Fail anything submitted after the stop request
+        while True:
+            try:
+                item = self._queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if item is not _STOP and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(
+                    RuntimeError('RapidClassifierService was stopped.'))
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_classifier_service():
+    """ Returns a running RapidClassifierService shared by all callers
+        in this process.
+    """
+
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = RapidClassifierService()
+
+        _service.start()
+        return _service
@@ -10,10 +10,203 @@
       https://astrorapid.readthedocs.io
 """
 
-from astrorapid.classify import Classify
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from warnings import warn as _warn
 
+_rapid_lock = Lock()  # Classify objects hold state between calls
 
-def rapid(light_curves, cx_dicts, plotdir=None):
+
+class ClassificationCache:
+    """ A bounded cache of RAPID class probabilities keyed by light curve
+        content (see classification_cache_key()).
+
+        Light curves that are resubmitted unchanged (e.g. the same object
+        and host galaxy pair in a repeated or replayed batch) reuse the
+        stored probabilities instead of being classified again.
+    """
+
+    policies = ('lru', 'fifo')
+
+    def __init__(self, maxsize=100000, policy='lru'):
+        """
+        Args:
+            maxsize (int): Maximum number of cached light curves.
+
+            policy  (str): Eviction policy. 'lru' evicts the least recently
+                           used entry, 'fifo' the oldest inserted entry.
+        """
+
+        if policy not in self.policies:
+            raise ValueError(f'Unknown eviction policy: {policy}')
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return (f'<ClassificationCache(size: {len(self)}, '
+                f'maxsize: {self.maxsize}, policy: {self.policy})>')
+
+    @property
+    def hit_rate(self):
+        """ Fraction of lookups that were found in the cache."""
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def stats(self):
+        """ Returns cache metrics as a dictionary."""
+
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+    def get(self, key):
+        """ Returns cached class probabilities, or None if not cached.
+
+        Args:
+            key (tuple): as given by classification_cache_key()
+        """
+
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if self.policy == 'lru':
+                self._data.move_to_end(key)
+
+            return self._data[key]
+
+    def put(self, key, class_probs):
+        """ Adds class probabilities to the cache.
+
+        Args:
+            key         (tuple): as given by classification_cache_key()
+            class_probs  (dict): {'prob_class<i>': <probability (float)>}
+        """
+
+        with self._lock:
+            self._data[key] = class_probs
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """ Removes all entries and resets the metrics."""
+
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+def classification_cache_key(light_curve, cx_dict):
+    """ Returns a key identifying an object + host galaxy pair and the
+        content of its light curve.
+
+        The cxid of a light curve includes the alert candid and time, which
+        change with every alert. The key therefore uses the objectId,
+        xcatalog and xobjId of the pair together with a digest of the
+        epoch arrays, position, redshift and mwebv.
+
+    Args:
+        light_curve (tuple): light_curve_info formatted for input to RAPID
+
+        cx_dict      (dict): candidate and xmatch info of the light curve,
+                             as given by value_added.format_for_rapid()
+
+    Returns:
+        (objectId, xcatalog, xobjId, digest) tuple
+    """
+
+    import numpy as np
+
+    mjd, flux, fluxerr, passband, photflag, ra, dec, cxid, redshift, mwebv = \
+        light_curve
+
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (mjd, flux, fluxerr, photflag):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+
+    digest.update(''.join(np.asarray(passband, dtype=str)).encode())
+    digest.update(np.array([ra, dec, redshift, mwebv], dtype=float).tobytes())
+
+    return (str(cx_dict['objectId']), str(cx_dict['xcatalog']),
+            str(cx_dict['xobjId']), digest.hexdigest())
+
+
+_classification_cache = None
+_classification_cache_lock = Lock()
+
+
+def get_classification_cache():
+    """ Returns the classification cache shared by all callers in this
+        process.
+
+    Returns:
+        A ClassificationCache object
+    """
+
+    global _classification_cache
+    with _classification_cache_lock:
+        if _classification_cache is None:
+            _classification_cache = ClassificationCache()
+
+        return _classification_cache
+
+
+def new_rapid_classifier(known_redshift=True):
+    """ Loads a new instance of the RAPID classifier.
+
+    Args:
+        known_redshift (bool): Use the model trained with redshifts.
+
+    Returns:
+        An astrorapid.classify.Classify object
+    """
+
+    from astrorapid.classify import Classify
+
+    return Classify(known_redshift=known_redshift)
+
+
+@lru_cache(maxsize=None)
+def load_rapid_classifier(known_redshift=True):
+    """ Loads the RAPID classifier used by rapid(). The model is only
+        loaded once per process and must only be used while holding
+        _rapid_lock.
+
+    Args:
+        known_redshift (bool): Use the model trained with redshifts.
+
+    Returns:
+        An astrorapid.classify.Classify object
+    """
+
+    return new_rapid_classifier(known_redshift=known_redshift)
+
+
+def rapid(light_curves, cx_dicts, plotdir=None, service=None, cache=None):
     """ Classifies alerts using RAPID (aka astrorapid).
 
     Args:
@@ -34,6 +227,18 @@ def rapid(light_curves, cx_dicts, plotdir=None):
 
         plotdir                  (str): Directory for classification plots.
                                         Pass None to skip plotting.
+                                        Plots are rendered in the background
+                                        by plotting.get_rapid_plotter(),
+                                        which may drop or rate limit them.
+
+        service (RapidClassifierService): Optional running classifier
+                                          service to classify with
+                                          (see classifier_service module).
+
+        cache      (ClassificationCache): Optional cache of class
+                                          probabilities. Light curves whose
+                                          content is already cached are not
+                                          classified (or plotted) again.
 
     Returns:
         Dictionaries of classification results, formatted for BigQuery.
@@ -47,22 +252,95 @@ def rapid(light_curves, cx_dicts, plotdir=None):
         _warn('\nThere are no alerts with enough information for classification.\n')
         return []
 
-    classification = Classify(known_redshift=True)
-    predictions = classification.get_predictions(light_curves,
-                                                 return_predictions_at_obstime=True, return_objids=True)
-    # = classes_list, times_list, objids_list
-    # lists of arrays, one array per classified object
+    if cache is None:
+        predictions = _predict(light_curves, service)
+        _plot(plotdir, light_curves, predictions, service)
+        return format_rapid_for_BQ(cx_dicts, predictions)
+
+    keys = [classification_cache_key(lc, cx_dicts[lc[7]]) for lc in light_curves]
+    cached = [cache.get(key) for key in keys]
+    todo = [lc for lc, preds_dict in zip(light_curves, cached) if preds_dict is None]
+    predictions = _predict(todo, service) if todo else ([], [], [])
+    _plot(plotdir, todo, predictions, service)
+    new_preds = {cxid: get_candidate_probabilities(lc_preds)
+                 for lc_preds, _, cxid in zip(*predictions)}
 
-    if plotdir is not None:
-        # Plot classifications vs time
-        classification.plot_light_curves_and_classifications(figdir=plotdir)
-        # classification.plot_classification_animation(figdir=plotdir)
+    classification_dicts = []
+    for lc, key, preds_dict in zip(light_curves, keys, cached):
+        if preds_dict is None:
+            preds_dict = new_preds.get(lc[7])
+            if preds_dict is None:  # not classified by RAPID
+                continue
+
+            cache.put(key, preds_dict)
 
-    classification_dicts = format_rapid_for_BQ(cx_dicts, predictions)
+        classification_dicts.append({**cx_dicts[lc[7]], **preds_dict})
 
     return classification_dicts
 
 
+def _predict(light_curves, service=None):
+    """ Runs RAPID on light curves.
+
+    Args:
+        as for rapid()
+
+    Returns:
+        predictions (tuple): as returned by astrorapid's get_predictions(),
+                             in the order of light_curves
+    """
+
+    if service is not None:
+        return service.predict(light_curves)
+
+    with _rapid_lock:
+        classification = load_rapid_classifier(known_redshift=True)
+        predictions = classification.get_predictions(
+            light_curves, return_predictions_at_obstime=True, return_objids=True)
+        # = classes_list, times_list, objids_list
+        # lists of arrays, one array per classified object
+
+    return predictions
+
+
+def _plot(plotdir, light_curves, predictions, service=None):
+    """ Queues classification plots in the background, if plotdir is given."""
+
+    if plotdir is None or not predictions[0]:
+        return
+
+    from .plotting import get_rapid_plotter
+
+    if service is None:
+        class_names = getattr(load_rapid_classifier(known_redshift=True),
+                              'class_names', None)
+
+    else:
+        class_names = service.class_names
+
+    get_rapid_plotter(plotdir).submit(light_curves, predictions, class_names)
+
+
+def get_candidate_probabilities(lc_preds):
+    """ Returns the class probabilities of the current alert candidate.
+
+    Args:
+        lc_preds (np.array): RAPID predictions for one light curve,
+                             one row per epoch
+
+    Returns:
+        {'prob_class<i>': <probability (float)>}
+    """
+
+    # Get the predictions for the current alert candidate only.
+    # I tried to match the candidate mjd input with a rapid output,
+    # but the output times are not exactly the same as the input times.
+    # This should be the last prediction, but check this.
+    cand_preds = lc_preds[-1]
+    class_colnames = [f'prob_class{i}' for i in range(len(cand_preds))]
+    return dict(zip(class_colnames, cand_preds.tolist()))
+
+
 def format_rapid_for_BQ(cx_dicts, predictions):
     """ Combines RAPID output with candidate and xmatch data and formats
         for upload to BigQuery.
@@ -82,13 +360,7 @@ def format_rapid_for_BQ(cx_dicts, predictions):
     # Merge predicitions with alert and hostgal info
     classification_dicts = []
     for lc_preds, lc_times, cxid in zip(*predictions):
-        # Get the predictions for the current alert candidate only.
-        # I tried to match the candidate mjd input with a rapid output,
-        # but the output times are not exactly the same as the input times.
-        # This should be the last prediction, but check this.
-        cand_preds = lc_preds[-1]
-        class_colnames = [f'prob_class{i}' for i in range(len(cand_preds))]
-        preds_dict = dict(zip(class_colnames, cand_preds.tolist()))
+        preds_dict = get_candidate_probabilities(lc_preds)
 
         # Add predictions to cx_dicts
         classification_dicts.append({**cx_dicts[cxid], **preds_dict})
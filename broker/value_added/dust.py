@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``dust`` module provides Milky Way E(B-V) values from local copies
+    of the Schlegel, Finkbeiner & Davis (1998; SFD) dust maps.
+
+    The maps are memory mapped, so only the pages needed for a lookup are
+    read from disk. Each value is interpolated from the map pixels around a
+    single position and scaled by 0.86 following Schlafly & Finkbeiner
+    (2011). This corresponds to the 'ext SandF ref' value of IRSA's dust
+    service, not to 'ext SandF mean', which is averaged over an aperture
+    and differs where the extinction varies on small scales. Results are
+    cached by HEALPix pixel, and the IRSA service can optionally be used
+    when the maps are not available.
+
+    Usage Example:
+
+        ```python
+        from broker.value_added import dust
+
+        # download the maps once (~130 MB)
+        dust.download_sfd_maps()
+
+        ebv = dust.get_dust_map().ebv([10.68, 83.82], [41.27, -5.39])
+        ```
+
+    Helpful links:
+      https://github.com/kbarbary/sfddata
+      https://irsa.ipac.caltech.edu/applications/DUST/
+"""
+
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+SFD_URL = 'https://github.com/kbarbary/sfddata/raw/master/'
+SFD_FILES = {1: 'SFD_dust_4096_ngp.fits', -1: 'SFD_dust_4096_sgp.fits'}
+SF11_SCALE = 0.86  # Schlafly & Finkbeiner (2011) recalibration of SFD
+
+# Rotation matrix from ICRS (J2000) to Galactic cartesian coordinates
+_ICRS_TO_GAL = np.array([
+    [-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+    [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+    [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669],
+])
+
+
+def get_dust_dir():
+    """ Returns the directory where the SFD dust maps are stored.
+
+        This is ``$PGB_DATA_DIR/sfd_maps`` if ``PGB_DATA_DIR`` is set and
+        a ``sfd_maps`` directory next to this module otherwise.
+    """
+
+    if 'PGB_DATA_DIR' in os.environ:
+        return Path(os.environ['PGB_DATA_DIR']) / 'sfd_maps'
+
+    return Path(__file__).resolve().parent / 'sfd_maps'
+
+
+def download_sfd_maps(out_dir=None, overwrite=False):
+    """ Downloads the SFD dust maps for both galactic hemispheres.
+
+    Args:
+        out_dir    (str): Directory to download into.
+                          Defaults to get_dust_dir().
+
+        overwrite (bool): Download maps that already exist locally.
+    """
+
+    import requests
+
+    out_dir = Path(get_dust_dir() if out_dir is None else out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    for file_name in SFD_FILES.values():
+        path = out_dir / file_name
+        if path.exists() and not overwrite:
+            continue
+
+        response = requests.get(SFD_URL + file_name, stream=True)
+        response.raise_for_status()
+        with open(path, 'wb') as ofile:
+            for block in response.iter_content(1 << 20):
+                ofile.write(block)
+
+
+def icrs_to_galactic(ra, dec):
+    """ Converts ICRS coordinates to Galactic coordinates.
+
+    Args:
+        ra  (array-like): Right Ascension in degrees
+        dec (array-like): Declination in degrees
+
+    Returns:
+        l, b (np.array): Galactic longitude and latitude in radians
+    """
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    xyz = np.stack((np.cos(dec) * np.cos(ra),
+                    np.cos(dec) * np.sin(ra),
+                    np.sin(dec)))
+
+    x, y, z = _ICRS_TO_GAL @ xyz
+    l = np.arctan2(y, x) % (2 * np.pi)
+    b = np.arcsin(np.clip(z, -1, 1))
+    return l, b
+
+
+def ang2pix_nest(nside, ra, dec):
+    """ Returns the nested HEALPix pixel index of equatorial coordinates.
+
+    Args:
+        nside        (int): HEALPix resolution parameter (a power of 2)
+        ra    (array-like): Right Ascension in degrees
+        dec   (array-like): Declination in degrees
+
+    Returns:
+        np.array of pixel indices (int64)
+    """
+
+    order = int(nside).bit_length() - 1
+    if nside != 1 << order:
+        raise ValueError(f'nside must be a power of 2, not {nside}')
+
+    z = np.sin(np.radians(np.asarray(dec, dtype=float)))
+    za = np.abs(z)
+    tt = np.radians(np.asarray(ra, dtype=float)) % (2 * np.pi) / (np.pi / 2)
+    z, za, tt = np.broadcast_arrays(np.atleast_1d(z), np.atleast_1d(za),
+                                    np.atleast_1d(tt))
+
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    # equatorial region
+    eq = za <= 2 / 3
+    temp1 = nside * (0.5 + tt[eq])
+    temp2 = nside * z[eq] * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp, ifm = jp >> order, jm >> order
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # polar caps
+    pol = ~eq
+    ntt = np.minimum(tt[pol].astype(np.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[pol]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[pol] >= 0
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+
+    # interleave the bits of ix and iy
+    pix = face << (2 * order)
+    for bit in range(order):
+        pix |= ((ix >> bit) & 1) << (2 * bit)
+        pix |= ((iy >> bit) & 1) << (2 * bit + 1)
+
+    return pix
+
+
+class _SFDHemisphere:
+    """ Memory mapped SFD map of one galactic hemisphere."""
+
+    def __init__(self, path):
+        from astropy.io import fits
+
+        self._hdul = fits.open(path, memmap=True)
+        header = self._hdul[0].header
+        self.data = self._hdul[0].data
+        self.scale = header['LAM_SCAL']
+        self.crpix = (header['CRPIX1'] - 1, header['CRPIX2'] - 1)
+        self.n = header['LAM_NSGP']
+
+    def lookup(self, l, b):
+        """ Returns bilinearly interpolated map values at galactic (l, b)."""
+
+        # Lambert azimuthal equal-area projection (SFD98 Appendix C)
+        r = self.scale * np.sqrt(1 - self.n * np.sin(b))
+        x = r * np.cos(l) + self.crpix[0]
+        y = -self.n * r * np.sin(l) + self.crpix[1]
+
+        ny, nx = self.data.shape
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, nx - 2)
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, ny - 2)
+        dx = np.clip(x - x0, 0, 1)
+        dy = np.clip(y - y0, 0, 1)
+
+        data = self.data
+        return ((1 - dx) * (1 - dy) * data[y0, x0]
+                + dx * (1 - dy) * data[y0, x0 + 1]
+                + (1 - dx) * dy * data[y0 + 1, x0]
+                + dx * dy * data[y0 + 1, x0 + 1])
+
+    def close(self):
+        self._hdul.close()
+
+
+class DustMap:
+    """ Vectorized Milky Way E(B-V) lookups from local SFD dust maps.
+
+        Values are cached by nested HEALPix pixel, so positions closer than
+        the cache resolution (~0.9 arcmin for nside=4096, well below the
+        6.1 arcmin resolution of the maps) share a single lookup.
+    """
+
+    def __init__(self, map_dir=None, scale=SF11_SCALE, nside=4096,
+                 cache_size=2 ** 20, remote_fallback=False):
+        """
+        Args:
+            map_dir          (str): Directory holding the SFD maps.
+                                    Defaults to get_dust_dir().
+
+            scale          (float): Factor applied to the SFD values.
+
+            nside            (int): HEALPix nside of the cache keys.
+
+            cache_size       (int): Maximum number of cached pixels.
+
+            remote_fallback (bool): Query IRSA's dust service for each
+                                    position if the maps are not available.
+        """
+
+        self.map_dir = Path(get_dust_dir() if map_dir is None else map_dir)
+        self.scale = scale
+        self.nside = nside
+        self.cache_size = cache_size
+        self.remote_fallback = remote_fallback
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._hemispheres = None
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'<DustMap({self.map_dir})>'
+
+    @property
+    def available(self):
+        """ Whether the SFD maps exist in map_dir."""
+
+        return all((self.map_dir / f).exists() for f in SFD_FILES.values())
+
+    def _get_hemispheres(self):
+        if self._hemispheres is None:
+            self._hemispheres = {
+                n: _SFDHemisphere(self.map_dir / f) for n, f in SFD_FILES.items()}
+
+        return self._hemispheres
+
+    def _query_maps(self, ra, dec):
+        """ Returns scaled E(B-V) from the local maps."""
+
+        l, b = icrs_to_galactic(ra, dec)
+        ebv = np.empty(len(l))
+        hemispheres = self._get_hemispheres()
+        for n, hemisphere in hemispheres.items():
+            in_hemisphere = (b >= 0) if n == 1 else (b < 0)
+            if in_hemisphere.any():
+                ebv[in_hemisphere] = hemisphere.lookup(
+                    l[in_hemisphere], b[in_hemisphere])
+
+        return ebv * self.scale
+
+    @staticmethod
+    def _query_remote(ra, dec):
+        """ Returns 'ext SandF mean' from IRSA's dust service.
+
+            Note this is an aperture mean, while _query_maps() returns
+            the value at each position.
+        """
+
+        from astropy.coordinates import SkyCoord
+        from astroquery.irsa_dust import IrsaDust
+
+        ebv = np.empty(len(ra))
+        for i, (r, d) in enumerate(zip(ra, dec)):
+            coo = SkyCoord(r, d, frame='icrs', unit='deg')
+            dust = IrsaDust.get_query_table(coo, section='ebv')
+            ebv[i] = dust['ext SandF mean'][0]
+
+        return ebv
+
+    def _query(self, ra, dec):
+        if self.available:
+            return self._query_maps(ra, dec)
+
+        if self.remote_fallback:
+            return self._query_remote(ra, dec)
+
+        raise FileNotFoundError(
+            f'SFD dust maps not found in {self.map_dir}. '
+            'Run dust.download_sfd_maps() or enable remote_fallback.')
+
+    def ebv(self, ra, dec):
+        """ Returns Milky Way E(B-V) for a batch of coordinates.
+
+        Args:
+            ra  (array-like): Right Ascension in degrees (ICRS)
+            dec (array-like): Declination in degrees (ICRS)
+
+        Returns:
+            np.array of E(B-V) values, one per coordinate
+        """
+
+        ra, dec = np.broadcast_arrays(np.atleast_1d(np.asarray(ra, float)),
+                                      np.atleast_1d(np.asarray(dec, float)))
+        pix = ang2pix_nest(self.nside, ra, dec)
+        ebv = np.empty(len(pix))
+
+        with self._lock:
+            todo = []
+            for i, p in enumerate(pix.tolist()):
+                if p in self._cache:
+                    self._cache.move_to_end(p)
+                    ebv[i] = self._cache[p]
+
+                else:
+                    todo.append(i)
+
+            self.hits += len(pix) - len(todo)
+            self.misses += len(todo)
+
+        if todo:
+            ebv[todo] = self._query(ra[todo], dec[todo])
+            with self._lock:
+                for p, value in zip(pix[todo].tolist(), ebv[todo].tolist()):
+                    self._cache[p] = value
+
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return ebv
+
+    def close(self):
+        """ Closes the memory mapped maps."""
+
+        if self._hemispheres is not None:
+            for hemisphere in self._hemispheres.values():
+                hemisphere.close()
+
+            self._hemispheres = None
+
+
+_dust_map = None
+
+
+def get_dust_map():
+    """ Returns the DustMap shared by all callers in this process.
+
+        The IRSA dust service is only used as a fallback if the
+        ``PGB_DUST_FALLBACK`` environment variable is set.
+
+    Returns:
+        A DustMap object
+    """
+
+    global _dust_map
+    if _dust_map is None:
+        _dust_map = DustMap(
+            remote_fallback='PGB_DUST_FALLBACK' in os.environ)
+
+    return _dust_map
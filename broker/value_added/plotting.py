@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``plotting`` module renders RAPID classification plots in a
+    background process pool, off the classification path.
+
+    Snapshots of the light curves and predictions are handed to a bounded
+    pool of worker processes. When the pool is busy, plots are dropped
+    rather than queued without limit, and each object is plotted at most
+    once per ``min_interval`` seconds. Diagnostic plots can therefore stay
+    enabled in production without slowing down classification.
+
+    Usage Example:
+
+        ```python
+        from broker.value_added import classify
+
+        # plots are rendered in the background by get_rapid_plotter(plotdir)
+        classify.rapid(light_curves, cx_dicts, plotdir='./plots')
+        ```
+"""
+
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+DROP_POLICIES = ('newest', 'oldest')
+PASSBAND_COLORS = {'g': 'tab:green', 'r': 'tab:red', 'i': 'tab:orange'}
+
+
+def plot_classification(plotdir, snapshot):
+    """ Plots a light curve and its class probabilities vs time.
+
+    Args:
+        plotdir   (str): Directory for the plot
+
+        snapshot (dict): as created by RapidPlotter.submit(), with keys
+                         cxid, mjd, flux, fluxerr, passband, preds, times
+                         and class_names
+
+    Returns:
+        Path of the saved figure
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    fig, (ax_flux, ax_prob) = plt.subplots(2, 1, sharex=True, figsize=(8, 6))
+    passband = np.asarray(snapshot['passband'])
+    for band in np.unique(passband):
+        in_band = passband == band
+        ax_flux.errorbar(snapshot['mjd'][in_band], snapshot['flux'][in_band],
+                         yerr=snapshot['fluxerr'][in_band], fmt='o',
+                         color=PASSBAND_COLORS.get(band), label=band)
+
+    preds = np.atleast_2d(snapshot['preds'])
+    class_names = snapshot['class_names'] or [
+        f'prob_class{i}' for i in range(preds.shape[1])]
+    for i, name in enumerate(class_names):
+        ax_prob.plot(snapshot['times'], preds[:, i], label=name)
+
+    ax_flux.set_ylabel('Flux')
+    ax_flux.legend(loc='upper left')
+    ax_prob.set_xlabel('MJD')
+    ax_prob.set_ylabel('Class Probability')
+    ax_prob.set_ylim(0, 1)
+    ax_prob.legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize='small')
+    ax_flux.set_title(snapshot['cxid'])
+
+    Path(plotdir).mkdir(exist_ok=True, parents=True)
+    path = Path(plotdir) / f"classification_vs_time_{snapshot['cxid']}.pdf"
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+class RapidPlotter:
+    """ Renders RAPID classification plots in background processes."""
+
+    def __init__(self, plotdir, max_workers=1, max_pending=16,
+                 min_interval=3600., drop_policy='newest'):
+        """
+        Args:
+            plotdir        (str): Directory for classification plots
+
+            max_workers    (int): Number of plotting processes
+
+            max_pending    (int): Maximum number of plots queued or
+                                  being rendered. Further plots are
+                                  dropped according to drop_policy.
+
+            min_interval (float): Minimum seconds between two plots of the
+                                  same objectId. Pass 0 to plot every time.
+
+            drop_policy    (str): Which plot to drop when the pool is full.
+                                  'newest' drops the submitted plot,
+                                  'oldest' cancels the oldest queued plot
+                                  in its favor.
+        """
+
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f'Unknown drop policy: {drop_policy}')
+
+        self.plotdir = plotdir
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.drop_policy = drop_policy
+
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.num_rate_limited = 0
+        self.num_failed = 0
+
+        self._executor = None
+        self._pending = deque()  # futures, oldest first
+        self._last_plotted = OrderedDict()  # objectId -> time, oldest first
+        self._lock = threading.RLock()  # cancel() runs _on_done in place
+
+    def __repr__(self):
+        return f'<RapidPlotter({self.plotdir}, pending: {len(self._pending)})>'
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, so workers do not inherit the classifier's threads
+            self._executor = ProcessPoolExecutor(
+                self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        return self._executor
+
+    def stats(self):
+        """ Returns plotting metrics as a dictionary."""
+
+        return {
+            'pending': len(self._pending),
+            'submitted': self.num_submitted,
+            'dropped': self.num_dropped,
+            'rate_limited': self.num_rate_limited,
+            'failed': self.num_failed,
+        }
+
+    def _is_rate_limited(self, object_id, now):
+        """ Whether object_id was plotted less than min_interval ago."""
+
+        last = self._last_plotted.get(object_id)
+        return last is not None and now - last < self.min_interval
+
+    def _record_plot(self, object_id, now):
+        """ Records the plot time of object_id for the rate limit."""
+
+        self._last_plotted[object_id] = now
+        self._last_plotted.move_to_end(object_id)
+
+        # forget objects whose interval has passed
+        while self._last_plotted:
+            oldest = next(iter(self._last_plotted.values()))
+            if now - oldest < self.min_interval:
+                break
+
+            self._last_plotted.popitem(last=False)
+
+    def _discard(self, future):
+        try:
+            self._pending.remove(future)
+
+        except ValueError:
+            pass
+
+    def _on_done(self, future):
+        with self._lock:
+            self._discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self.num_failed += 1
+
+    def _make_room(self):
+        """ Frees a slot in the pool if the drop policy allows it.
+
+        Returns:
+            Whether a new plot can be submitted
+        """
+
+        while len(self._pending) >= self.max_pending:
+            if self.drop_policy == 'newest':
+                return False
+
+            # 'oldest': cancel the oldest plot that has not started yet
+            for future in self._pending:
+                if future.cancel():
+                    self._discard(future)
+                    self.num_dropped += 1
+                    break
+
+            else:
+                return False  # all pending plots are being rendered
+
+        return True
+
+    def submit(self, light_curves, predictions, class_names=None):
+        """ Queues classification plots for rendering.
+
+        Args:
+            light_curves (list): light curves as passed to classify.rapid()
+
+            predictions (tuple): as returned by astrorapid's get_predictions()
+
+            class_names  (list): names of the RAPID classes (Optional)
+
+        Returns:
+            Number of plots queued
+        """
+
+        light_curves = {lc[7]: lc for lc in light_curves}
+        num_queued = 0
+        for lc_preds, lc_times, cxid in zip(*predictions):
+            with self._lock:
+                now = time.monotonic()
+                object_id = cxid.split('-')[0]
+                if self._is_rate_limited(object_id, now):
+                    self.num_rate_limited += 1
+                    continue
+
+                if not self._make_room():
+                    self.num_dropped += 1
+                    continue
+
+                mjd, flux, fluxerr, passband = light_curves[cxid][:4]
+                snapshot = {
+                    'cxid': cxid,
+                    'mjd': np.array(mjd, dtype=float),
+                    'flux': np.array(flux, dtype=float),
+                    'fluxerr': np.array(fluxerr, dtype=float),
+                    'passband': np.array(passband, dtype=str),
+                    'preds': np.array(lc_preds, dtype=float),
+                    'times': np.array(lc_times, dtype=float),
+                    'class_names': None if class_names is None else list(class_names),
+                }
+
+                future = self._get_executor().submit(
+                    plot_classification, self.plotdir, snapshot)
+                self._pending.append(future)
+                self._record_plot(object_id, now)
+                self.num_submitted += 1
+                num_queued += 1
+
+            future.add_done_callback(self._on_done)
+
+        return num_queued
+
+    def close(self, wait=True):
+        """ Stops the plotting processes.
+
+        Args:
+            wait (bool): Finish queued plots first. Otherwise they are
+                         cancelled.
+        """
+
+        with self._lock:
+            if not wait:
+                # cancel() runs _on_done, which removes the future from _pending
+                for future in list(self._pending):
+                    future.cancel()
+
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_plotters = dict()
+_plotters_lock = threading.Lock()
+
+
+def get_rapid_plotter(plotdir):
+    """ Returns the RapidPlotter for a plot directory shared by all callers
+        in this process.
+    """
+
+    plotdir = str(plotdir)
+    with _plotters_lock:
+        if plotdir not in _plotters:
+            _plotters[plotdir] = RapidPlotter(plotdir)
+
+        return _plotters[plotdir]
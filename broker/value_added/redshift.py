@@ -6,14 +6,72 @@
 
 """
 
+import os
+import sqlite3
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
+from threading import Lock
 
 import numpy as np
-from sklearn.externals import joblib
 
 RFpath = Path(__file__).resolve().parent / 'regrf_20181008_0.pkl'
 
 
+@lru_cache(maxsize=None)
+def load_rongpuRF(path=RFpath):
+    """ Loads a pre-trained random forest model.
+        The model is only read from disk once per process.
+
+    Args:
+        path (str or Path): Path of the pickled model.
+
+    Returns:
+        The unpickled sklearn regressor.
+    """
+
+    try:
+        from sklearn.externals import joblib
+    except ImportError:  # removed from newer versions of sklearn
+        import joblib
+
+    return joblib.load(path)
+
+
+def calcz_rongpuRF_batch(gmag, rmag, zmag, w1mag, w2mag=0.0, radius=0.0,
+                         q=0.0, p=0.0):
+    """ Calculates redshifts for many objects with a single call to the
+        pre-trained random forest model from Rongpu Zhou (2019, in prep.).
+
+        Arguments may be scalars or arrays and are broadcast against each
+        other. Objects with missing (None or NaN) inputs are not passed to
+        the model. They, and any non-finite model outputs, are assigned a
+        redshift of -1, as are objects that are not galaxies.
+
+    Args:
+        gmag, rmag, zmag, w1mag, w2mag, radius, q, p (array-like):
+            Model inputs, as for calcz_rongpuRF().
+
+    Returns:
+        numpy array of redshifts, one per object.
+    """
+
+    g, r, z, w1, w2, radius, q, p = np.broadcast_arrays(*(
+        np.atleast_1d(np.asarray(x, dtype=float))
+        for x in (gmag, rmag, zmag, w1mag, w2mag, radius, q, p)))
+
+    # Note: w1 is used in place of w2 to match calcz_rongpuRF
+    features = np.column_stack((g - r, r - z, z - w1, w1 - w1, r, radius, q, p))
+    valid = np.isfinite(features).all(axis=1)
+
+    z_phot = np.full(len(features), -1.)
+    if valid.any():
+        z_phot[valid] = load_rongpuRF().predict(features[valid])
+
+    z_phot[~np.isfinite(z_phot)] = -1.
+    return z_phot
+
+
 def calcz_rongpuRF(data):
     """ Calculates redshift using a single pre-trained random forest model
         from Rongpu Zhou (2019, in prep.).
@@ -26,19 +84,238 @@ def calcz_rongpuRF(data):
         redshift of galaxy associated with data.
     """
 
-    # Load single pre-trained tree
-    regrf = joblib.load(RFpath)
+    keys = ('gmag', 'rmag', 'zmag', 'w1mag', 'w2mag', 'radius', 'q', 'p')
+    z_phot = calcz_rongpuRF_batch(*(data[k] for k in keys))
 
-    g = data['gmag']
-    r = data['rmag']
-    z = data['zmag']
-    w1 = data['w1mag']
-    w2 = data['w1mag']
-    radius = data['radius']
-    q = data['q']
-    p = data['p']
+    return z_phot[0]
 
-    data1 = np.column_stack((g - r, r - z, z - w1, w1 - w2, r, radius, q, p))
-    z_phot = regrf.predict(data1)
 
-    return z_phot[0]
+class PhotozCache:
+    """ A bounded, least recently used cache of photo-z's keyed by
+        PS1 object id (``objectidpsN`` in ZTF alerts).
+
+        Entries can optionally be persisted to a local sqlite database so
+        they are shared between processes and survive restarts.
+        Persisted entries are tagged with the name of the model file so that
+        estimates from a different model are never returned.
+    """
+
+    def __init__(self, maxsize=100000, path=None, model=RFpath):
+        """ Creates an empty cache.
+
+        Args:
+            maxsize   (int): Maximum number of entries to keep in memory.
+
+            path      (str): Path of a sqlite database used to persist
+                             entries. Pass None to keep entries in memory only.
+
+            model    (Path): Path of the model whose estimates are cached.
+        """
+
+        self.maxsize = maxsize
+        self.path = path
+        self.model = Path(model).name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self._connection = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(
+                str(path), timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS photoz '
+                '(objectidps INTEGER, model TEXT, redshift REAL, '
+                'PRIMARY KEY (objectidps, model))')
+            self._connection.commit()
+
+    def __contains__(self, objectidps):
+        return objectidps in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'<PhotozCache(size: {len(self)}, maxsize: {self.maxsize})>'
+
+    def _remember(self, objectidps, redshift):
+        """ Adds an entry to the in-memory cache, evicting old entries."""
+
+        self._data[objectidps] = redshift
+        self._data.move_to_end(objectidps)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _load(self, objectidps_list):
+        """ Returns persisted entries for a list of PS1 object ids."""
+
+        found = {}
+        for i in range(0, len(objectidps_list), 500):
+            chunk = objectidps_list[i:i + 500]
+            query = ('SELECT objectidps, redshift FROM photoz WHERE model = ? '
+                     f'AND objectidps IN ({",".join("?" * len(chunk))})')
+            rows = self._connection.execute(query, [self.model, *chunk])
+            found.update((oid, np.nan if z is None else z) for oid, z in rows)
+
+        return found
+
+    def get_many(self, objectidps_list):
+        """ Looks up photo-z's for a list of PS1 object ids.
+
+        Args:
+            objectidps_list (list): PS1 object ids
+
+        Returns:
+            redshifts (np.array): cached redshifts (NaN where not found)
+            found     (np.array): boolean mask of ids found in the cache
+        """
+
+        objectidps_list = [int(oid) for oid in objectidps_list]
+        redshifts = np.full(len(objectidps_list), np.nan)
+        found = np.zeros(len(objectidps_list), dtype=bool)
+
+        with self._lock:
+            missing = []
+            for i, oid in enumerate(objectidps_list):
+                if oid in self._data:
+                    self._data.move_to_end(oid)
+                    redshifts[i] = self._data[oid]
+                    found[i] = True
+
+                else:
+                    missing.append(i)
+
+            if missing and self._connection is not None:
+                stored = self._load([objectidps_list[i] for i in missing])
+                for i in missing:
+                    oid = objectidps_list[i]
+                    if oid in stored:
+                        self._remember(oid, stored[oid])
+                        redshifts[i] = stored[oid]
+                        found[i] = True
+
+            self.hits += int(found.sum())
+            self.misses += int(len(found) - found.sum())
+
+        return redshifts, found
+
+    def put_many(self, objectidps_list, redshifts):
+        """ Adds photo-z's to the cache.
+
+        Args:
+            objectidps_list (list): PS1 object ids
+            redshifts       (list): redshift of each object
+        """
+
+        rows = [(int(oid), float(z))
+                for oid, z in zip(objectidps_list, redshifts)]
+
+        with self._lock:
+            for oid, z in rows:
+                self._remember(oid, z)
+
+            if self._connection is not None:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO photoz VALUES (?, ?, ?)',
+                    [(oid, self.model, None if np.isnan(z) else z)
+                     for oid, z in rows])
+                self._connection.commit()
+
+    def clear(self):
+        """ Removes all entries from the in-memory cache."""
+
+        with self._lock:
+            self._data.clear()
+
+    def close(self):
+        """ Closes the connection to the sqlite database, if any."""
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_photoz_cache = None
+
+
+def get_photoz_cache():
+    """ Returns the photo-z cache shared by all callers in this process.
+
+        If the ``PGB_PHOTOZ_CACHE`` environment variable is set, entries are
+        persisted to a sqlite database at that path and shared with other
+        processes on the same machine.
+
+    Returns:
+        A PhotozCache object
+    """
+
+    global _photoz_cache
+    if _photoz_cache is None:
+        _photoz_cache = PhotozCache(path=os.environ.get('PGB_PHOTOZ_CACHE'))
+
+    return _photoz_cache
+
+
+def calcz_rongpuRF_cached(objectidps, gmag, rmag, zmag, w1mag, cache=None):
+    """ Calculates redshifts with calcz_rongpuRF_batch(), reusing cached
+        values for PS1 objects that were seen before.
+        Only objects missing from the cache are passed to the model.
+
+    Args:
+        objectidps (array-like): PS1 object id of each object.
+                                 Objects with a None or negative id
+                                 (e.g. the -999 placeholder of empty PS1
+                                 slots in ZTF alerts) are never cached.
+
+        gmag, rmag, zmag, w1mag (array-like): Model inputs, as for
+                                              calcz_rongpuRF_batch().
+
+        cache     (PhotozCache): Cache to use.
+                                 Defaults to the shared get_photoz_cache().
+
+    Returns:
+        numpy array of redshifts, one per object.
+    """
+
+    cache = get_photoz_cache() if cache is None else cache
+
+    objectidps = np.asarray(objectidps, dtype=object)
+    gmag, rmag, zmag, w1mag = (np.broadcast_to(
+        np.asarray(x, dtype=float), objectidps.shape)
+        for x in (gmag, rmag, zmag, w1mag))
+
+    has_id = np.array([oid is not None and oid >= 0 for oid in objectidps],
+                      dtype=bool)
+    redshifts = np.full(len(objectidps), np.nan)
+    found = np.zeros(len(objectidps), dtype=bool)
+    if has_id.any():
+        redshifts[has_id], found[has_id] = cache.get_many(objectidps[has_id])
+
+    # Run the model once per uncached PS1 object
+    todo = np.flatnonzero(~found)
+    if len(todo):
+        rows = []  # rows passed to the model
+        first_row = {}  # PS1 object id -> position in rows
+        source = []  # position in rows of the result for each todo row
+        for i in todo:
+            oid = objectidps[i]
+            if not has_id[i]:
+                rows.append(i)
+                source.append(len(rows) - 1)
+                continue
+
+            if oid not in first_row:
+                first_row[oid] = len(rows)
+                rows.append(i)
+
+            source.append(first_row[oid])
+
+        z_phot = calcz_rongpuRF_batch(
+            gmag[rows], rmag[rows], zmag[rows], w1mag[rows])
+        redshifts[todo] = z_phot[source]
+        cache.put_many(list(first_row), z_phot[list(first_row.values())])
+
+    return redshifts
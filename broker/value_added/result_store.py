@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``result_store`` module persists value added products to a local
+    sqlite database keyed by alert candid.
+
+    Cross matches, Milky Way E(B-V) and classifications are stored
+    separately, each tagged with the version of the models that produced
+    it. value_added.get_value_added() looks up stored products before
+    computing anything, so backfills and reruns (e.g. after a failed
+    BigQuery load) only recompute products that are missing or were made
+    by a different model version.
+
+    The store also records which alerts' products were uploaded to each
+    destination table, so that redelivered alerts are not uploaded twice
+    (see worker.ValueAddedWorker).
+
+    Usage Example:
+
+        ```python
+        from broker.value_added import value_added as va
+        from broker.value_added.result_store import ResultStore
+
+        store = ResultStore('value_added.db')
+        xmatches, classifications = va.get_value_added(
+            alert_list, result_store=store)
+        ```
+"""
+
+import json
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+PRODUCTS = ('xmatch', 'mwebv', 'classification')
+
+
+def _package_version(name):
+    """ Returns the installed version of a package without importing it."""
+
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        try:
+            return pkg_resources.get_distribution(name).version
+
+        except pkg_resources.DistributionNotFound:
+            return 'unknown'
+
+    try:
+        return version(name)
+
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+def get_model_versions():
+    """ Returns the version tag of each value added product.
+
+        A product's tag includes the tags of the products it is computed
+        from, so e.g. classifications are recomputed when the photo-z
+        model changes.
+
+    Returns:
+        {product (str): version tag (str)} for each product in PRODUCTS
+    """
+
+    from . import dust
+    from .redshift import RFpath
+
+    xmatch = f'photoz={Path(RFpath).name}'
+    mwebv = f'sfd98x{dust.SF11_SCALE}'
+    rapid = f"astrorapid={_package_version('astrorapid')}"
+    return {
+        'xmatch': xmatch,
+        'mwebv': mwebv,
+        'classification': ';'.join((rapid, xmatch, mwebv)),
+    }
+
+
+def _to_json(value):
+    """ JSON encoder fallback for numpy scalars."""
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _chunks(candids, size=500):
+    """ Splits candids into chunks that fit in a sqlite query.
+
+    Yields:
+        (chunk (list[int]), placeholders for the chunk (str))
+    """
+
+    candids = [int(c) for c in candids]
+    for i in range(0, len(candids), size):
+        chunk = candids[i:i + size]
+        yield chunk, ','.join('?' * len(chunk))
+
+
+class ResultStore:
+    """ Value added products persisted in sqlite, keyed by candid and
+        model version.
+    """
+
+    def __init__(self, path, versions=None):
+        """ Opens (or creates) a result store.
+
+        Args:
+            path      (str): Path of the sqlite database.
+
+            versions (dict): Version tag of each product. Defaults to
+                             get_model_versions().
+        """
+
+        self.path = path
+        self.versions = get_model_versions() if versions is None else versions
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            str(path), timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results '
+            '(candid INTEGER, product TEXT, version TEXT, data TEXT, '
+            'PRIMARY KEY (candid, product, version))')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS uploads '
+            '(candid INTEGER, destination TEXT, '
+            'PRIMARY KEY (candid, destination))')
+        self._connection.commit()
+
+    def __repr__(self):
+        return f'<ResultStore({self.path})>'
+
+    def get_many(self, product, candids):
+        """ Looks up stored results of the current model version.
+
+        Args:
+            product  (str): One of PRODUCTS
+            candids (list): Alert candids
+
+        Returns:
+            {candid (int): result} for the candids found. Results are
+            lists of row dicts for xmatch and classification and floats
+            for mwebv.
+        """
+
+        version = self.versions[product]
+        found = {}
+        with self._lock:
+            for chunk, marks in _chunks(candids):
+                query = ('SELECT candid, data FROM results '
+                         'WHERE product = ? AND version = ? '
+                         f'AND candid IN ({marks})')
+                rows = self._connection.execute(query, [product, version, *chunk])
+                found.update((candid, json.loads(data)) for candid, data in rows)
+
+            self.hits += len(found)
+            self.misses += len({int(c) for c in candids}) - len(found)
+
+        return found
+
+    def put_many(self, product, results):
+        """ Stores results in a single transaction.
+
+        Args:
+            product  (str): One of PRODUCTS
+            results (dict): {candid (int): result}, with results as
+                            returned by get_many()
+        """
+
+        version = self.versions[product]
+        rows = [(int(candid), product, version, json.dumps(result, default=_to_json))
+                for candid, result in results.items()]
+
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', rows)
+
+    def delete(self, product=None, version=None, candids=None):
+        """ Removes stored results.
+
+        Args:
+            product (str): Only remove results of this product (Optional)
+            version (str): Only remove results of this version (Optional)
+            candids (list): Only remove results of these alerts (Optional)
+        """
+
+        query, params = 'DELETE FROM results WHERE 1', []
+        if product is not None:
+            query += ' AND product = ?'
+            params.append(product)
+
+        if version is not None:
+            query += ' AND version = ?'
+            params.append(version)
+
+        self._delete(query, params, candids)
+
+    def get_uploaded(self, destination, candids):
+        """ Looks up which alerts' products were uploaded to a destination.
+
+        Args:
+            destination (str): Name of the destination, e.g. a BigQuery
+                               table as '<data set>.<table>'
+            candids    (list): Alert candids
+
+        Returns:
+            set of the candids that were uploaded
+        """
+
+        uploaded = set()
+        with self._lock:
+            for chunk, marks in _chunks(candids):
+                rows = self._connection.execute(
+                    'SELECT candid FROM uploads WHERE destination = ? '
+                    f'AND candid IN ({marks})', [destination, *chunk])
+                uploaded.update(candid for candid, in rows)
+
+        return uploaded
+
+    def put_uploaded(self, destination, candids):
+        """ Records that alerts' products were uploaded to a destination.
+
+        Args:
+            destination (str): Name of the destination, as in get_uploaded()
+            candids    (list): Alert candids
+        """
+
+        rows = [(int(candid), destination) for candid in candids]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO uploads VALUES (?, ?)', rows)
+
+    def delete_uploaded(self, destination=None, candids=None):
+        """ Forgets recorded uploads.
+
+        Args:
+            destination (str): Only forget uploads to this destination
+                               (Optional)
+            candids    (list): Only forget uploads of these alerts (Optional)
+        """
+
+        query, params = 'DELETE FROM uploads WHERE 1', []
+        if destination is not None:
+            query += ' AND destination = ?'
+            params.append(destination)
+
+        self._delete(query, params, candids)
+
+    def _delete(self, query, params, candids=None):
+        """ Runs a DELETE query, optionally restricted to some candids."""
+
+        with self._lock:
+            with self._connection:
+                if candids is None:
+                    self._connection.execute(query, params)
+                    return
+
+                for chunk, marks in _chunks(candids):
+                    self._connection.execute(
+                        f'{query} AND candid IN ({marks})', [*params, *chunk])
+
+    def count(self, product):
+        """ Returns the number of stored results of the current version."""
+
+        with self._lock:
+            (count,), = self._connection.execute(
+                'SELECT COUNT(*) FROM results WHERE product = ? AND version = ?',
+                (product, self.versions[product]))
+
+        return count
+
+    def close(self):
+        """ Closes the connection to the sqlite database."""
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_result_store = None
+
+
+def get_result_store():
+    """ Returns the result store shared by all callers in this process.
+
+        Results are only stored if the ``PGB_RESULT_STORE`` environment
+        variable is set to the path of a sqlite database.
+
+    Returns:
+        A ResultStore object, or None
+    """
+
+    global _result_store
+    if _result_store is None and 'PGB_RESULT_STORE' in os.environ:
+        _result_store = ResultStore(os.environ['PGB_RESULT_STORE'])
+
+    return _result_store
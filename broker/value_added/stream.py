@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``stream`` module computes value added products for a stream of
+    alerts, yielding results while later alerts are still being processed.
+
+    Alerts are grouped into micro-batches that flow through a pipeline of
+    concurrent stages connected by bounded queues:
+
+        1. batch:    collect alerts from the input iterator
+        2. prepare:  look up stored products (see the result_store module),
+                     submit the missing cross matches / photo-z to a worker
+                     process and look up dust extinction (thread)
+        3. classify: format light curves and classify them with the RAPID
+                     classifier service, reusing cached classifications
+        4. results:  yield (xmatch_dicts, classification_dicts) per batch,
+                     in input order
+
+    The bounded queues limit how many batches are in flight, so a slow
+    consumer or classifier applies back pressure to the input iterator.
+
+    Usage Example:
+
+        ```python
+        from broker.ztf_archive import iter_alerts
+        from broker.value_added.stream import iter_value_added
+
+        for xmatch_dicts, classification_dicts in iter_value_added(iter_alerts()):
+            ...
+        ```
+"""
+
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+
+from . import classify as classify
+from . import value_added as va
+from . import xmatch as xm
+
+_DONE = object()  # queue sentinel marking the end of the stream
+_JOIN_TIMEOUT = 5.  # seconds to wait for each stage thread at shutdown
+
+
+class _StageError:
+    """ Wraps an exception raised in a stage so it reaches the consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _slim_alert(alert):
+    """ Returns the alert fields needed for cross matching.
+
+        Avoids sending cutout images to worker processes.
+    """
+
+    return {'objectId': alert['objectId'], 'candidate': alert['candidate']}
+
+
+def _put(q, item, stop):
+    """ Puts an item on a bounded queue unless the stream is stopped.
+
+    Returns:
+        False if the stream was stopped before the item was queued
+    """
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _get(q, stop):
+    """ Gets the next item from a queue, or _DONE if the stream is stopped."""
+
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+
+        except queue.Empty:
+            continue
+
+    return _DONE
+
+
+def _cancel_pending(q):
+    """ Cancels the futures of batches left in a queue."""
+
+    while True:
+        try:
+            item = q.get_nowait()
+
+        except queue.Empty:
+            return
+
+        if isinstance(item, tuple):
+            for future in item:
+                if isinstance(future, Future):
+                    future.cancel()
+
+
+def _run_stage(func, inbox, outbox, stop):
+    """ Applies func to each item of inbox and queues the result in outbox.
+
+        Errors are forwarded downstream and end the stage.
+    """
+
+    while True:
+        item = _get(inbox, stop)
+        if item is _DONE or isinstance(item, _StageError):
+            _put(outbox, item, stop)
+            return
+
+        try:
+            result = func(item)
+
+        except Exception as e:
+            _put(outbox, _StageError(e), stop)
+            return
+
+        if not _put(outbox, result, stop):
+            return
+
+
+def _batch_alerts(alerts, batch_size, outbox, stop):
+    """ Groups alerts into lists of batch_size and queues them."""
+
+    try:
+        alerts = iter(alerts)
+        while True:
+            batch = list(islice(alerts, batch_size))
+            if not batch:
+                break
+
+            if not _put(outbox, batch, stop):
+                return
+
+    except Exception as e:
+        _put(outbox, _StageError(e), stop)
+        return
+
+    _put(outbox, _DONE, stop)
+
+
+def iter_value_added(alerts, survey='ZTF', batch_size=64, max_batches=4,
+                     executor=None, max_workers=2, rapid_plotdir=None,
+                     result_store=None, classifier_service=None,
+                     classification_cache=None):
+    """ Compiles value added products for a stream of alerts.
+
+        Each stage of the pipeline runs concurrently: while one batch is
+        classified, the next is being cross matched and the one after is
+        being read from the input. Dust lookups run in a thread, photo-z
+        runs in worker processes and RAPID classification runs in the
+        classifier service.
+
+    Args:
+        alerts    (iterable): alert dicts. May be a generator.
+
+        survey         (str): name of survey generating the alerts
+
+        batch_size     (int): number of alerts per micro-batch
+
+        max_batches    (int): maximum number of batches waiting between
+                              two stages
+
+        executor  (Executor): concurrent.futures executor for the cross match
+                              and photo-z work. Defaults to a pool of
+                              max_workers spawned processes that is shut down
+                              when the stream ends.
+                              Pass a ThreadPoolExecutor to stay in-process.
+
+        max_workers    (int): number of worker processes of the default
+                              executor
+
+        rapid_plotdir  (str): directory for RAPID classification plots.
+                              Pass None to skip plotting.
+
+        result_store (ResultStore): Store of previously computed products.
+                              Defaults to result_store.get_result_store().
+
+        classifier_service (RapidClassifierService): Running RAPID service
+                              to classify with. Defaults to
+                              classifier_service.get_classifier_service().
+
+        classification_cache (ClassificationCache): Cache of class
+                              probabilities. Defaults to
+                              classify.get_classification_cache().
+
+    Yields:
+        (xmatch_dicts, classification_dicts) for each batch of alerts,
+        in input order, as returned by value_added.get_value_added()
+        for that batch
+    """
+
+    from .classifier_service import get_classifier_service
+    from .result_store import get_result_store
+
+    if survey != 'ZTF':
+        raise ValueError("stream.iter_value_added() requires survey=='ZTF'")
+
+    if result_store is None:
+        result_store = get_result_store()
+
+    if classifier_service is None:
+        classifier_service = get_classifier_service()
+
+    if classification_cache is None:
+        classification_cache = classify.get_classification_cache()
+
+    own_executor = executor is None
+    if own_executor:
+        # forked workers could inherit locks held by the running threads
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def prepare(alert_list):
+        candids = [int(alert['candidate']['candid']) for alert in alert_list]
+        xmatches = va._get_stored(result_store, 'xmatch', candids)
+        missing_xm = [i for i, c in enumerate(candids) if c not in xmatches]
+        xmatch_future = None
+        if missing_xm:
+            slim_alerts = [_slim_alert(alert_list[i]) for i in missing_xm]
+            xmatch_future = executor.submit(xm.get_xmatches_table,
+                                            slim_alerts, survey=survey,
+                                            alert_index=True)
+
+        # runs while xmatching
+        classifications = va._get_stored(result_store, 'classification',
+                                         candids)
+        missing = [i for i, c in enumerate(candids)
+                   if c not in classifications]
+        mwebvs = va._get_mwebvs_stored([alert_list[i] for i in missing],
+                                       result_store)
+        return (alert_list, xmatches, missing_xm, xmatch_future,
+                classifications, missing, mwebvs)
+
+    def classify_batch(prepared):
+        (alert_list, xmatches, missing_xm, xmatch_future,
+         classifications, missing, mwebvs) = prepared
+        candids = [int(alert['candidate']['candid']) for alert in alert_list]
+        if xmatch_future is not None:
+            missing_alerts = [alert_list[i] for i in missing_xm]
+            new = va._split_xmatches(missing_alerts, *xmatch_future.result())
+            va._put_stored(result_store, 'xmatch', new)
+            xmatches.update(new)
+
+        xmatch_dicts = [row for c in candids for row in xmatches[c]]
+        classification_dicts = va._classify_missing(
+            alert_list, missing, xmatch_dicts, mwebvs, classifications,
+            result_store, classifier_service, classification_cache,
+            rapid_plotdir=rapid_plotdir)
+        return xmatch_dicts, classification_dicts
+
+    stop = threading.Event()
+    batches = queue.Queue(max_batches)
+    prepared = queue.Queue(max_batches)
+    classified = queue.Queue(max_batches)
+    threads = [
+        threading.Thread(target=_batch_alerts,
+                         args=(alerts, batch_size, batches, stop)),
+        threading.Thread(target=_run_stage,
+                         args=(prepare, batches, prepared, stop)),
+        threading.Thread(target=_run_stage,
+                         args=(classify_batch, prepared, classified, stop)),
+    ]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = _get(classified, stop)
+            if item is _DONE:
+                break
+
+            if isinstance(item, _StageError):
+                raise item.exception
+
+            yield item
+
+    finally:
+        stop.set()
+        # the batch thread may be blocked reading the input iterator.
+        # It is a daemon and exits on its own once the iterator returns.
+        for thread in threads:
+            thread.join(timeout=_JOIN_TIMEOUT)
+
+        _cancel_pending(prepared)
+        if own_executor:
+            executor.shutdown()
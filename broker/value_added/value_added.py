@@ -19,18 +19,25 @@
         ```
 """
 
+from operator import itemgetter
 from warnings import warn as _warn
 
 import numpy as np
-from astropy.coordinates import SkyCoord
-from astropy.time import Time
-from astroquery.irsa_dust import IrsaDust
 
 from . import classify as classify
+from . import dust as dust
 from . import xmatch as xm
 
+EPOCH_COLUMNS = ('jd', 'fid', 'magpsf', 'sigmapsf', 'magzpsci')
+FID_PASSBANDS = np.array(['', 'g', 'r', 'i'])  # passband of each ZTF fid
+ZP_FALLBACK = 26.0  # zeropoint of epochs without magzpsci
+MJD_OFFSET = 2400000.5
+_get_epoch_values = itemgetter(*EPOCH_COLUMNS)
 
-def get_value_added(alert_list, survey='ZTF', rapid_plotdir=None):
+
+def get_value_added(alert_list, survey='ZTF', rapid_plotdir=None,
+                    result_store=None, classifier_service=None,
+                    classification_cache=None):
     """ Compiles all value added products for each alert in alert_list.
 
     Args:
@@ -41,6 +48,25 @@ def get_value_added(alert_list, survey='ZTF', rapid_plotdir=None):
         rapid_plotdir (str): directory for RAPID classification plots.
                              Pass None to skip plotting.
 
+        result_store (ResultStore): Store of previously computed products
+                             keyed by candid (see the result_store module).
+                             Only products missing from the store are
+                             computed, and they are added to it.
+                             Defaults to result_store.get_result_store().
+
+        classifier_service (RapidClassifierService): Running RAPID service
+                             to classify with (see the classifier_service
+                             module). Defaults to the long-lived service
+                             shared by the process, given by
+                             classifier_service.get_classifier_service().
+
+        classification_cache (ClassificationCache): Cache of class
+                             probabilities keyed by light curve content.
+                             Unchanged light curves are not classified
+                             again. Defaults to the cache shared by the
+                             process, given by
+                             classify.get_classification_cache().
+
     Returns:
         Lists of dictionaries of value added products, formatted for
         upload to BigQuery. One dictionary per unique alert-xmatch pair.
@@ -51,29 +77,244 @@ def get_value_added(alert_list, survey='ZTF', rapid_plotdir=None):
 
     """
 
+    from .classifier_service import get_classifier_service
+    from .result_store import get_result_store
+
+    if result_store is None:
+        result_store = get_result_store()
+
+    if classifier_service is None:
+        classifier_service = get_classifier_service()
+
+    if classification_cache is None:
+        classification_cache = classify.get_classification_cache()
+
+    if result_store is not None and survey == 'ZTF':
+        return _get_value_added_stored(alert_list, result_store,
+                                       classifier_service,
+                                       classification_cache,
+                                       rapid_plotdir=rapid_plotdir)
+
     ### Cross Matches
-    xmatch_dicts = xm.get_xmatches(alert_list, survey=survey)  # list of dicts
+    xmatch_table = xm.get_xmatches_table(alert_list, survey=survey)
+    xmatch_dicts = xmatch_table.to_dict('records')  # list of dicts
     ###
 
     ### Classification
     # RAPID
-    light_curves, cx_dicts = format_for_rapid(alert_list, xmatch_dicts,
+    light_curves, cx_dicts = format_for_rapid(alert_list, xmatch_table,
                                               survey=survey)
     classification_dicts = classify.rapid(light_curves, cx_dicts,
-                                          plotdir=rapid_plotdir)
+                                          plotdir=rapid_plotdir,
+                                          service=classifier_service,
+                                          cache=classification_cache)
     # list of dicts
     ###
 
     return xmatch_dicts, classification_dicts
 
 
-def format_for_rapid(alert_list, xmatch_list, survey='ZTF'):
+def _get_value_added_stored(alert_list, result_store, classifier_service,
+                            classification_cache, rapid_plotdir=None):
+    """ get_value_added() for ZTF alerts, computing only the products that
+        are missing from result_store.
+    """
+
+    xmatches, classifications = get_value_added_by_candid(
+        alert_list, rapid_plotdir=rapid_plotdir, result_store=result_store,
+        classifier_service=classifier_service,
+        classification_cache=classification_cache)
+
+    candids = [int(alert['candidate']['candid']) for alert in alert_list]
+    xmatch_dicts = [row for c in candids for row in xmatches[c]]
+    classification_dicts = [cd for cd_list in classifications.values()
+                            for cd in cd_list]
+    return xmatch_dicts, classification_dicts
+
+
+def get_value_added_by_candid(alert_list, survey='ZTF', rapid_plotdir=None,
+                              result_store=None, classifier_service=None,
+                              classification_cache=None):
+    """ Compiles all value added products of each alert, grouped by alert.
+
+        Classifications of an alert are taken from result_store as a
+        whole, so alerts of one object that were first classified in
+        different batches are not re-paired with each other's cross
+        matches.
+
+    Args:
+        alert_list   (list): list of alert dicts
+
+        survey        (str): name of survey generating the alerts
+
+        Other arguments are as for get_value_added(), except that no
+        result store is used if result_store is None.
+
+    Returns:
+        Dictionaries of value added products of each alert, formatted for
+        upload to BigQuery, in the order of alert_list.
+
+        xmatches        { <candid (int)>: [ {<column name (str)>: <value>} ] }
+
+        classifications { <candid (int)>: [ {<column name (str)>: <value>} ] }
+    """
+
+    if survey != 'ZTF':
+        raise ValueError("value_added.get_value_added_by_candid() requires "
+                         "survey=='ZTF'")
+
+    if classifier_service is None:
+        from .classifier_service import get_classifier_service
+
+        classifier_service = get_classifier_service()
+
+    if classification_cache is None:
+        classification_cache = classify.get_classification_cache()
+
+    candids = [int(alert['candidate']['candid']) for alert in alert_list]
+
+    ### Cross Matches
+    xmatches = _get_stored(result_store, 'xmatch', candids)
+    missing = [i for i, c in enumerate(candids) if c not in xmatches]
+    if missing:
+        missing_alerts = [alert_list[i] for i in missing]
+        new = _split_xmatches(missing_alerts, *xm.get_xmatches_table(
+            missing_alerts, alert_index=True))
+        _put_stored(result_store, 'xmatch', new)
+        xmatches.update(new)
+
+    xmatch_dicts = [row for c in candids for row in xmatches[c]]
+    ###
+
+    ### Classification
+    classifications = _get_stored(result_store, 'classification', candids)
+    missing = [i for i, c in enumerate(candids) if c not in classifications]
+    mwebvs = _get_mwebvs_stored([alert_list[i] for i in missing], result_store)
+    _classify_missing(alert_list, missing, xmatch_dicts, mwebvs,
+                      classifications, result_store, classifier_service,
+                      classification_cache, rapid_plotdir=rapid_plotdir)
+    ###
+
+    return ({c: xmatches[c] for c in candids},
+            {c: classifications[c] for c in candids})
+
+
+def _get_stored(result_store, product, candids):
+    """ result_store.get_many(), or no results if result_store is None."""
+
+    if result_store is None:
+        return dict()
+
+    return result_store.get_many(product, candids)
+
+
+def _put_stored(result_store, product, results):
+    """ result_store.put_many(), unless result_store is None."""
+
+    if result_store is not None:
+        result_store.put_many(product, results)
+
+
+def _split_xmatches(alert_list, xmatch_table, alert_index):
+    """ Splits a cross match table into the rows of each alert.
+
+    Args:
+        alert_list          (list): alert dicts
+        xmatch_table   (DataFrame): as given by
+                                    xm.get_xmatches_table(alert_list)
+        alert_index (array-like): position in alert_list of the alert of
+                                  each row, as returned by
+                                  xm.get_xmatches_table(alert_index=True)
+
+    Returns:
+        { <candid (int)>: <xmatch rows of the alert (list[dict])> }
+    """
+
+    candids = [int(alert['candidate']['candid']) for alert in alert_list]
+    xmatches = {c: [] for c in candids}
+    for i, row in zip(np.asarray(alert_index).tolist(),
+                      xmatch_table.to_dict('records')):
+        xmatches[candids[i]].append(row)
+
+    return xmatches
+
+
+def _get_mwebvs_stored(alert_list, result_store):
+    """ get_mwebvs(), looking up only the alerts missing from result_store.
+
+    Returns:
+        Milky Way E(B-V) of each alert (list[float])
+    """
+
+    candids = [int(alert['candidate']['candid']) for alert in alert_list]
+    mwebvs = _get_stored(result_store, 'mwebv', candids)
+    missing = [i for i, c in enumerate(candids) if c not in mwebvs]
+    if missing:
+        new = dict(zip((candids[i] for i in missing),
+                       get_mwebvs([alert_list[i] for i in missing]).tolist()))
+        _put_stored(result_store, 'mwebv', new)
+        mwebvs.update(new)
+
+    return [mwebvs[c] for c in candids]
+
+
+def _classify_missing(alert_list, missing, xmatch_dicts, mwebvs,
+                      classifications, result_store, classifier_service,
+                      classification_cache, rapid_plotdir=None):
+    """ Classifies the alerts at the missing positions of alert_list and
+        adds their classifications to classifications and result_store.
+
+    Args:
+        missing        (list): positions in alert_list to classify
+        xmatch_dicts   (list): cross match rows of the alerts
+        mwebvs         (list): Milky Way E(B-V) of each missing alert
+        classifications (dict): {candid (int): classification dicts}
+                                for the alerts that are not missing
+
+    Returns:
+        classification_dicts of all alerts, ordered by candid as in
+        alert_list
+    """
+
+    import pandas as pd
+
+    candids = [int(alert['candidate']['candid']) for alert in alert_list]
+    if missing:
+        xmatch_table = pd.DataFrame(
+            {c: np.array([row[c] for row in xmatch_dicts], dtype=object)
+             for c in xm.XMATCH_COLUMNS}, columns=xm.XMATCH_COLUMNS)
+        xmatch_table = xmatch_table.astype(
+            {'redshift': float, 'dist2d': float, 'sgscore': float})
+
+        light_curves, cx_dicts = format_for_rapid(
+            [alert_list[i] for i in missing], xmatch_table, mwebvs=mwebvs)
+        new = {candids[i]: [] for i in missing}
+        for cd in classify.rapid(light_curves, cx_dicts, plotdir=rapid_plotdir,
+                                 service=classifier_service,
+                                 cache=classification_cache):
+            new[int(cd['candid'])].append(cd)
+
+        _put_stored(result_store, 'classification', new)
+        classifications.update(new)
+
+    return [cd for c in dict.fromkeys(candids) for cd in classifications[c]]
+
+
+def format_for_rapid(alert_list, xmatch_list, survey='ZTF',
+                     light_curve_store=None, mwebvs=None):
     """ Creates a list of tuples formatted for RAPID classifier.
 
     Args:
         alert_list  (list): alert dicts
-        xmatch_list (list): cross matched objects as given by xm.get_xmatches()
+        xmatch_list (list): cross matched objects as given by xm.get_xmatches(),
+                            or a DataFrame as given by xm.get_xmatches_table()
         survey       (str): name of survey generating the alerts
+        light_curve_store (LightCurveStore): Optional store of previously
+                            seen epochs (see ``broker.ztf_archive``).
+                            Alerts are merged into the store and light
+                            curves are taken from it.
+        mwebvs (array-like): Milky Way E(B-V) of each alert.
+                             Looked up with dust.get_dust_map() if None.
 
     Returns:
         light_curves (list): [(light curve info formatted for input to RAPID.)]
@@ -90,30 +331,100 @@ def format_for_rapid(alert_list, xmatch_list, survey='ZTF'):
     if survey != 'ZTF':
         raise ValueError("value_added.format_for_rapid() requires survey=='ZTF'")
 
-    # map objectId's to xmatch list positions
-    oid_map = map_objectId_list(xmatch_list)
+    # map objectId's to xmatch positions
+    xmatch_columns = get_xmatch_columns(xmatch_list)
+    oid_map = group_objectIds(xmatch_columns['objectId'])
+
+    # MW dust extinction for the whole batch
+    if mwebvs is None:
+        mwebvs = get_mwebvs(alert_list)
+
+    # Light curve data for the whole batch
+    epochs_list = [get_alert_epochs(alert, light_curve_store)
+                   for alert in alert_list]
+    epoch_dicts = format_for_rapid_proc_epochs_batch(epochs_list)
 
     # Gather info for each candidate + xmatch object
     light_curves = []  # for RAPID input
     cx_dicts = dict()  # collect candidate & xmatch data to merge with RAPID results
-    for alert in alert_list:
-        lc, cxd = format_for_rapid_proc_alert(alert, xmatch_list, oid_map)
+    for alert, mwebv, epoch_data in zip(alert_list, mwebvs, epoch_dicts):
+        lc, cxd = format_for_rapid_proc_alert(alert, xmatch_columns, oid_map,
+                                              mwebv=mwebv,
+                                              epoch_data=epoch_data)
         light_curves.extend(lc)
         cx_dicts.update(cxd)
 
     return light_curves, cx_dicts
 
 
-def format_for_rapid_proc_alert(alert, xmatch_list, oid_map):
+def get_mwebvs(alert_list):
+    """ Returns the Milky Way E(B-V) at the position of each alert.
+
+    Args:
+        alert_list (list): alert dicts
+
+    Returns:
+        numpy array with one value per alert
+    """
+
+    if len(alert_list) == 0:
+        return np.empty(0)
+
+    ra = [alert['candidate']['ra'] for alert in alert_list]
+    dec = [alert['candidate']['dec'] for alert in alert_list]
+    return dust.get_dust_map().ebv(ra, dec)
+
+
+def get_alert_epochs(alert, light_curve_store=None):
+    """ Returns the observation epochs of an alert.
+
+    Args:
+        alert  (dict): single alert dictionary
+
+        light_curve_store (LightCurveStore): Optional store of previously
+                            seen epochs. If given, the alert is merged into
+                            the store and the stored light curve up to the
+                            alert's candidate epoch is returned. Later epochs
+                            (e.g. from a prebuilt store) are left out, so
+                            results do not depend on processing order.
+
+    Returns:
+        list of epoch dicts, or a structured array with dtype EPOCH_DTYPE
+        (see ``broker.ztf_archive``) if light_curve_store is given
+    """
+
+    if light_curve_store is None:
+        return (alert['prv_candidates'] or []) + [alert['candidate']]
+
+    epochs = light_curve_store.update(alert)
+    return epochs[epochs['jd'] <= alert['candidate']['jd']]
+
+
+def format_for_rapid_proc_alert(alert, xmatch_list, oid_map,
+                                light_curve_store=None, mwebv=None,
+                                epoch_data=None):
     """
     Args:
         alert  (dict): single alert dictionary
 
-        xmatch_list (list): cross matched objects as given by xm.get_xmatches()
+        xmatch_list (list): cross matched objects as given by xm.get_xmatches(),
+                            or columns as given by get_xmatch_columns()
 
         oid_map     (dict): mapping of oid's to position(s) in xmatch_list
                             e.g. oid_map = map_objectId_list(xmatch_list)
 
+        light_curve_store (LightCurveStore): Optional store of previously
+                            seen epochs. If given, the alert is merged into
+                            the store and the stored light curve is used.
+
+        mwebv      (float): Milky Way E(B-V) at the alert position.
+                            Looked up with dust.get_dust_map() if None.
+
+        epoch_data  (dict): light curve data, as returned by
+                            format_for_rapid_proc_epochs().
+                            Built from the alert if None, in which case
+                            light_curve_store is used.
+
     Returns:
         light_curves (list): [(light curve info formatted for input to RAPID.)]
 
@@ -125,8 +436,9 @@ def format_for_rapid_proc_alert(alert, xmatch_list, oid_map):
     """
 
     # Collect data from observation epochs
-    epochs = alert['prv_candidates'] + [alert['candidate']]
-    epoch_data = format_for_rapid_proc_epochs(epochs)
+    if epoch_data is None:
+        epochs = get_alert_epochs(alert, light_curve_store)
+        epoch_data = format_for_rapid_proc_epochs(epochs)
 
     # Skip classification if don't have g passband
     if 'g' not in epoch_data['passband']:
@@ -138,80 +450,140 @@ def format_for_rapid_proc_alert(alert, xmatch_list, oid_map):
 
     # MW dust extinction
     # fix this. ZTF docs say ra, dec are in J2000 [deg]
-    coo = SkyCoord(alert['candidate']['ra'], alert['candidate']['dec'],
-                   frame='icrs', unit='deg')
-    dust = IrsaDust.get_query_table(coo, section='ebv')
-    mwebv = dust['ext SandF mean'][0]
+    if mwebv is None:
+        mwebv = dust.get_dust_map().ebv(alert['candidate']['ra'],
+                                        alert['candidate']['dec'])[0]
 
     # Create objects for each candidate-host galaxy pair
     light_curves, cx_dicts = format_for_rapid_proc_xmatches(alert, xmatch_list,
-                                                            oid_map[alert['objectId']],
+                                                            oid_map.get(alert['objectId'], []),
                                                             epoch_data, mwebv)
 
     return light_curves, cx_dicts
 
 
-def format_for_rapid_proc_epochs(epochs):
-    """ Collects data from each observation epoch of a single alert.
+def _get_epoch_columns(epochs):
+    """ Gathers the epoch data needed by RAPID into float arrays.
 
     Args:
-        epochs (list[dict]): one dict per observation epoch
+        epochs (list[dict] or np.ndarray): one dict or structured array
+                                           element per observation epoch.
+                                           Missing values may be None
+                                           (dicts) or NaN (arrays).
 
     Returns:
-        epoch_dict (dict): keys: 'mjd','flux','fluxerr','passband','photflag'
-                           values: Lists of light curve data with one element
-                                   per epoch.
+        dict of float arrays keyed by EPOCH_COLUMNS, with NaN for
+        missing values.
+    """
+
+    if isinstance(epochs, np.ndarray):
+        return {c: epochs[c].astype(float) if c in epochs.dtype.names
+                else np.full(len(epochs), np.nan) for c in EPOCH_COLUMNS}
+
+    try:
+        rows = list(map(_get_epoch_values, epochs))
+
+    except KeyError:  # early schema(s) did not contain some columns
+        rows = [tuple(e.get(c) for c in EPOCH_COLUMNS) for e in epochs]
+
+    values = np.array(rows, dtype=float).reshape(len(rows), len(EPOCH_COLUMNS))
+    return dict(zip(EPOCH_COLUMNS, values.T))
+
+
+def format_for_rapid_proc_epochs_batch(epochs_list):
+    """ Collects data from each observation epoch of a batch of alerts.
+        Epochs of all alerts are processed together with vectorized
+        operations and split per alert at the end.
+
+    Args:
+        epochs_list (list): one element per alert; each element holds the
+                            epochs of the alert as accepted by
+                            format_for_rapid_proc_epochs()
+
+    Returns:
+        epoch_dicts (list[dict]): one dict per alert, as returned by
+                                  format_for_rapid_proc_epochs().
+                                  Alerts with inconsistent zeropoints
+                                  get no epochs.
     """
 
-    # prepare empty lists to zip epoch data
-    mjd, flux, fluxerr, passband, photflag = ([] for i in range(5))
-    # passband mapping
-    fid_dict = {1: 'g', 2: 'r', 3: 'i'}
-    # set and track epochs with missing zeropoints
-    zp_fallback, zp_in_keys = 26.0, [0 for i in range(len(epochs))]
-
-    for epoch in epochs:
-        # skip nondetections.
-        if epoch['magpsf'] is None: continue
-        # fix this. try setting magnitude to epoch['diffmaglim']
-
-        # check zeropoint (early schema(s) did not contain this)
-        if 'magzpsci' not in epoch.keys():  # fix this. do something better.
-            _warn('Epoch does not have zeropoint data. '
-                  'Setting to {}'.format(zp_fallback))
-            zp_in_keys[n] = 1
-            epoch['magzpsci'] = zp_fallback
-
-        # Gather epoch data
-        mjd.append(jd_to_mjd(epoch['jd']))
-        f, ferr = mag_to_flux(epoch['magpsf'], epoch['magzpsci'],
-                              epoch['sigmapsf'])
-        flux.append(f)
-        fluxerr.append(ferr)
-        passband.append(fid_dict[epoch['fid']])
-        photflag.append(4096)  # fix this, determines trigger time
-        # (1st mjd where this == 6144)
-
-    # check zeropoint consistency
-    # either 0 or all epochs (with detections) should be missing zeropoints
-    if sum(zp_in_keys) not in [0, len(mjd)]:
-        raise ValueError((f'Inconsistent zeropoint values in alert {oid}. '
-                          'Cannot continue with classification.'))
-
-    # Set trigger date. fix this.
-    photflag = np.asarray(photflag)
-    photflag[flux == np.max(flux)] = 6144
+    columns = [_get_epoch_columns(epochs) for epochs in epochs_list]
+    data = {c: np.concatenate([col[c] for col in columns] or [[]])
+            for c in EPOCH_COLUMNS}
+    offsets = np.cumsum([0] + [len(col['jd']) for col in columns])
+
+    # skip nondetections.
+    # fix this. try setting magnitude to epoch['diffmaglim']
+    detected = ~np.isnan(data['magpsf'])
+    data = {c: values[detected] for c, values in data.items()}
+    offsets = np.concatenate(([0], np.cumsum(detected)))[offsets]
+    counts = np.diff(offsets)
+
+    # check zeropoint (early schema(s) did not contain this)
+    zp_missing = np.isnan(data['magzpsci'])
+    if zp_missing.any():  # fix this. do something better.
+        _warn('Epoch does not have zeropoint data. '
+              'Setting to {}'.format(ZP_FALLBACK))
+        data['magzpsci'][zp_missing] = ZP_FALLBACK
+
+        # check zeropoint consistency
+        # either 0 or all epochs (with detections) should be missing zeropoints
+        # Alerts that fail the check are returned without epochs,
+        # so they are not classified.
+        num_missing = np.diff(np.concatenate(([0], np.cumsum(zp_missing)))[offsets])
+        inconsistent = (num_missing != 0) & (num_missing != counts)
+        if inconsistent.any():
+            _warn(f'Inconsistent zeropoint values in alert(s) '
+                  f'{np.flatnonzero(inconsistent).tolist()} of batch. '
+                  'Skipping their classification.')
+            keep = ~np.repeat(inconsistent, counts)
+            data = {c: values[keep] for c, values in data.items()}
+            offsets = np.concatenate(([0], np.cumsum(keep)))[offsets]
+            counts = np.diff(offsets)
+
+    # Gather epoch data
+    mjd = jd_to_mjd(data['jd'])
+    flux, fluxerr = mag_to_flux(data['magpsf'], data['magzpsci'],
+                                data['sigmapsf'])
+    passband = FID_PASSBANDS[data['fid'].astype(int)]
+
+    # fix this, determines trigger time (1st mjd where this == 6144)
+    # Set trigger date to the epoch of max flux. fix this.
+    photflag = np.full(len(flux), 4096)
+    nonempty = counts > 0
+    if nonempty.any():
+        max_flux = np.maximum.reduceat(flux, offsets[:-1][nonempty])
+        photflag[flux == np.repeat(max_flux, counts[nonempty])] = 6144
 
     # Gather info
-    epoch_dict = {
-        'mjd': np.asarray(mjd),
-        'flux': np.asarray(flux),
-        'fluxerr': np.asarray(fluxerr),
-        'passband': np.asarray(passband),
-        'photflag': photflag
-    }
+    return [
+        {
+            'mjd': mjd[start:stop],
+            'flux': flux[start:stop],
+            'fluxerr': fluxerr[start:stop],
+            'passband': passband[start:stop],
+            'photflag': photflag[start:stop]
+        }
+        for start, stop in zip(offsets[:-1], offsets[1:])
+    ]
 
-    return epoch_dict
+
+def format_for_rapid_proc_epochs(epochs):
+    """ Collects data from each observation epoch of a single alert.
+
+    Args:
+        epochs (list[dict] or np.ndarray): one dict per observation epoch,
+                                           or a structured array with
+                                           dtype EPOCH_DTYPE (see
+                                           ``broker.ztf_archive``)
+
+    Returns:
+        epoch_dict (dict): keys: 'mjd','flux','fluxerr','passband','photflag'
+                           values: Arrays of light curve data with one element
+                                   per epoch with a detection.
+    """
+
+    return format_for_rapid_proc_epochs_batch([epochs])[0]
 
 
 def format_for_rapid_proc_xmatches(alert, xmatch_list, xm_indices, epoch_data, mwebv):
@@ -219,7 +591,8 @@ def format_for_rapid_proc_xmatches(alert, xmatch_list, xm_indices, epoch_data, m
     Args:
         alert       (dict): single alert dictionary
 
-        xmatch_list (list): cross matched objects as given by xm.get_xmatches()
+        xmatch_list (list): cross matched objects as given by xm.get_xmatches(),
+                            or columns as given by get_xmatch_columns()
 
         xm_indices  (list): indices of xmatch_list corresponding to alert objectId
 
@@ -246,14 +619,18 @@ def format_for_rapid_proc_xmatches(alert, xmatch_list, xm_indices, epoch_data, m
     # create a new object for each candidate-host galaxy pair
     light_curves = []  # for RAPID input
     cx_dicts = dict()  # collect candidate+xmatch data to merge with RAPID results
-    for i in xm_indices:
-        xmatch = xmatch_list[i]
-        xobjId = xmatch['xobjId']
-        xcatalog = xmatch['xcatalog']
-        redshift = xmatch['redshift']
+    if isinstance(xmatch_list, dict):  # columns
+        xmatches = zip(*(xmatch_list[c][xm_indices].tolist()
+                         for c in ('xobjId', 'xcatalog', 'redshift')))
+
+    else:
+        xmatches = ((xmatch_list[i]['xobjId'], xmatch_list[i]['xcatalog'],
+                     xmatch_list[i]['redshift']) for i in xm_indices)
+
+    for xobjId, xcatalog, redshift in xmatches:
 
         # skip classification if we don't have redshift info
-        if redshift < 0: continue
+        if not redshift >= 0: continue  # also skips NaN
 
         # get unique candidate-xmatch id to match RAPID input and output
         cxid = alert_xobj_id([oid, cid, cand_mjd, xcatalog, xobjId])
@@ -317,6 +694,59 @@ def alert_xobj_id(data):
         raise ValueError('alert_xobj_id() received invalid data type.')
 
 
+def get_xmatch_columns(xmatch_list):
+    """ Gathers the cross match data needed for classification into arrays.
+
+    Args:
+        xmatch_list (list or DataFrame): cross matched objects as given by
+                                         xm.get_xmatches() or
+                                         xm.get_xmatches_table()
+
+    Returns:
+        { <column name (str)>: <values (np.array)> } for columns
+        'objectId', 'xobjId', 'xcatalog' and 'redshift'
+    """
+
+    columns = ('objectId', 'xobjId', 'xcatalog', 'redshift')
+    if hasattr(xmatch_list, 'columns'):  # DataFrame
+        out = {c: xmatch_list[c].to_numpy(dtype=object) for c in columns}
+
+    else:
+        out = {c: np.array([x[c] for x in xmatch_list], dtype=object)
+               for c in columns}
+
+    out['redshift'] = out['redshift'].astype(float)
+    return out
+
+
+def group_objectIds(object_ids):
+    """ Groups positions in a sequence by objectId with a single sort.
+
+        Positions are stored CSR-style: all groups share one array of
+        positions sorted by objectId and each group is a view into it.
+
+    Args:
+        object_ids (array-like): objectId of each element
+
+    Returns:
+        { <objectID (str)>: <corresponding positions (np.array)> }
+        Positions keep their original order within each group.
+    """
+
+    object_ids = np.asarray(object_ids, dtype=str)
+    if len(object_ids) == 0:
+        return dict()
+
+    order = np.argsort(object_ids, kind='stable')
+    sorted_ids = object_ids[order]
+    starts = np.flatnonzero(np.concatenate(
+        ([True], sorted_ids[1:] != sorted_ids[:-1])))
+    stops = np.append(starts[1:], len(order))
+
+    return {oid: order[start:stop] for oid, start, stop
+            in zip(sorted_ids[starts].tolist(), starts, stops)}
+
+
 def map_objectId_list(dict_list):
     """ Creates a mapping between list indices and objectId's.
 
@@ -329,8 +759,7 @@ def map_objectId_list(dict_list):
 
     out_dict = dict()
     for idx, d in enumerate(dict_list):
-        obj_id = d['objectId']
-        out_dict[obj_id] = [*out_dict.get(obj_id, []), idx]
+        out_dict.setdefault(d['objectId'], []).append(idx)
 
     return out_dict
 
@@ -344,6 +773,6 @@ def mag_to_flux(mag, zeropoint, magerr):
 
 
 def jd_to_mjd(jd):
-    """ Converts Julian Date to modified Julian Date.
+    """ Converts Julian Date(s) to modified Julian Date(s).
     """
-    return Time(jd, format='jd').mjd
+    return np.asarray(jd) - MJD_OFFSET
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" The ``worker`` module runs a long-lived process that computes value
+    added products for alerts published to Pub/Sub.
+
+    The worker subscribes to the alert data topic with streaming pull,
+    collects messages into batches, runs cross matching and classification
+    on each batch (value_added.get_value_added()) and loads the results to
+    BigQuery with batch loads. Messages are acked only after the results of
+    their batch have been loaded, and nacked (redelivered) if anything
+    fails. Alerts may therefore be received more than once. The worker
+    records each upload in a ResultStore (see the result_store module) and
+    does not upload an alert's products to a table again, e.g. cross
+    matches whose batch was redelivered because the classification upload
+    failed.
+
+    The dust maps and models are checked when the worker starts (see
+    check_dependencies()), so a misconfigured worker exits instead of
+    nacking every batch. If computing the products of a batch fails, its
+    messages are retried one at a time, and a message whose products
+    cannot be computed ``max_failures`` times is logged and dropped.
+
+    Usage Example:
+
+        ```python
+        from broker.value_added.worker import ValueAddedWorker
+
+        worker = ValueAddedWorker('ztf_alert_data_value_added')
+        worker.run()  # until interrupted
+        ```
+
+    To run against the in-process Pub/Sub stand-in, e.g. for load testing,
+    pass a broker.pub_sub_client.local_pubsub.SubscriberClient and an
+    upload function that does not write to BigQuery.
+"""
+
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+
+log = logging.getLogger(__name__)
+
+project_id = os.getenv('GOOGLE_CLOUD_PROJECT')
+
+
+def decode_alerts(data):
+    """ Decodes the alerts in an Avro file, as published by
+        alert_ingestion.consume.GCSKafkaConsumer.
+
+    Args:
+        data (bytes): Avro file contents
+
+    Returns:
+        list of alert dicts
+    """
+
+    import fastavro
+
+    return list(fastavro.reader(BytesIO(data)))
+
+
+def check_dependencies(classifier_service=None):
+    """ Checks that the data and models needed to compute value added
+        products are available.
+
+    Args:
+        classifier_service (RapidClassifierService): Service the products
+            will be classified with. If None, the astrorapid package is
+            required by the default service.
+
+    Raises:
+        RuntimeError listing everything that is missing
+    """
+
+    from importlib.util import find_spec
+
+    from . import dust
+    from . import redshift as red
+
+    missing = []
+    dust_map = dust.get_dust_map()
+    if not (dust_map.available or dust_map.remote_fallback):
+        missing.append(f'SFD dust maps in {dust_map.map_dir} (run '
+                       'dust.download_sfd_maps() or set PGB_DUST_FALLBACK)')
+
+    try:
+        red.load_rongpuRF()
+
+    except Exception as e:
+        missing.append(f'photo-z model {red.RFpath} ({e!r})')
+
+    if classifier_service is None and find_spec('astrorapid') is None:
+        missing.append('the astrorapid package')
+
+    if missing:
+        raise RuntimeError('Cannot compute value added products. Missing: '
+                           + '; '.join(missing))
+
+
+class ValueAddedWorker:
+    """ Computes value added products for alerts received from a Pub/Sub
+        subscription and uploads them to BigQuery.
+    """
+
+    def __init__(self, subscription, data_set='ztf_alerts',
+                 xmatch_table='xmatch', classification_table='classification',
+                 batch_size=100, max_latency=10., max_messages=None,
+                 max_tries=3, subscriber=None, upload=None, survey='ZTF',
+                 classifier_service=None, result_store=None, max_failures=5):
+        """
+        Args:
+            subscription      (str): Pub/Sub subscription name or path
+
+            data_set          (str): BigQuery data set for the results
+
+            xmatch_table      (str): BigQuery table for cross matches
+
+            classification_table (str): BigQuery table for classifications
+
+            batch_size        (int): Number of messages processed together
+
+            max_latency     (float): Maximum seconds a message waits for its
+                                     batch to fill up
+
+            max_messages      (int): Maximum number of unacked messages held
+                                     by the subscriber (flow control).
+                                     Defaults to 2 * batch_size.
+
+            max_tries         (int): Upload attempts per table and batch
+
+            subscriber             : Pub/Sub SubscriberClient.
+                                     Defaults to pubsub_v1.SubscriberClient().
+
+            upload       (callable): Called as upload(data, data_set, table)
+                                     with a DataFrame of results. Must raise
+                                     if the data was not stored. Defaults to
+                                     bq_upload.upload_to_bigquery().
+
+            survey            (str): name of survey generating the alerts
+
+            classifier_service (RapidClassifierService): RAPID service to
+                                     classify with. Defaults to the service
+                                     shared by the process.
+
+            result_store (ResultStore): Store of computed products and
+                                     uploads. Defaults to
+                                     result_store.get_result_store(), or to
+                                     an in-memory store that forgets each
+                                     batch once its messages are acked.
+
+            max_failures      (int): Number of times the products of a
+                                     message may fail to compute before the
+                                     message is dropped
+        """
+
+        from .result_store import ResultStore, get_result_store
+
+        if result_store is None:
+            result_store = get_result_store()
+
+        self._own_store = result_store is None
+        if self._own_store:
+            result_store = ResultStore(':memory:')
+
+        self.subscription = subscription
+        self.data_set = data_set
+        self.xmatch_table = xmatch_table
+        self.classification_table = classification_table
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_messages = 2 * batch_size if max_messages is None else max_messages
+        self.max_tries = max_tries
+        self.subscriber = subscriber
+        self.upload = upload
+        self.survey = survey
+        self.classifier_service = classifier_service
+        self.result_store = result_store
+        self.max_failures = max_failures
+
+        self.num_batches = 0
+        self.num_failed_batches = 0
+        self.num_alerts = 0
+        self.num_acked = 0
+        self.num_skipped_uploads = 0
+        self.num_dropped = 0
+
+        self._buffer = []  # [(received time, message)]
+        self._buffer_changed = threading.Condition()
+        self._stop = threading.Event()
+        self._pull_future = None
+        self._thread = None
+        self._failures = {}  # message_id -> number of failed computations
+
+    def __repr__(self):
+        status = 'running' if self.running else 'stopped'
+        return f'<ValueAddedWorker({self.subscription}, {status})>'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        """ Whether the worker is processing messages."""
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def _get_subscriber(self):
+        if self.subscriber is None:
+            from google.cloud import pubsub_v1
+
+            self.subscriber = pubsub_v1.SubscriberClient()
+
+        return self.subscriber
+
+    def _get_flow_control(self):
+        from broker.pub_sub_client import local_pubsub
+
+        if isinstance(self.subscriber, local_pubsub.SubscriberClient):
+            return local_pubsub.FlowControl(max_messages=self.max_messages)
+
+        from google.cloud.pubsub_v1.types import FlowControl
+
+        return FlowControl(max_messages=self.max_messages)
+
+    def _upload(self, data, table):
+        if self.upload is not None:
+            return self.upload(data, self.data_set, table)
+
+        from . import bq_upload
+
+        bq_upload.upload_to_bigquery(data, self.data_set, table,
+                                     method='batch', max_tries=self.max_tries)
+
+    def _receive(self, message):
+        """ Streaming pull callback. Queues a message for the next batch."""
+
+        with self._buffer_changed:
+            self._buffer.append((time.monotonic(), message))
+            if len(self._buffer) >= self.batch_size:
+                self._buffer_changed.notify()
+
+    def _next_batch(self):
+        """ Waits for a full batch, or for the oldest message to reach
+            max_latency, and returns its messages.
+        """
+
+        with self._buffer_changed:
+            while not self._stop.is_set():
+                if len(self._buffer) >= self.batch_size:
+                    break
+
+                timeout = None
+                if self._buffer:
+                    timeout = self._buffer[0][0] + self.max_latency - time.monotonic()
+                    if timeout <= 0:
+                        break
+
+                self._buffer_changed.wait(timeout)
+
+            batch = [message for _, message in self._buffer[:self.batch_size]]
+            del self._buffer[:self.batch_size]
+            return batch
+
+    def process_messages(self, messages):
+        """ Computes and uploads value added products for a batch of messages.
+
+            Messages are acked once the results are stored and nacked if
+            uploading fails. If computing the products fails, the messages
+            are retried one at a time and only failing messages are nacked.
+            Messages that cannot be decoded, or whose products failed to
+            compute max_failures times, are logged and acked, since they
+            would fail on every delivery.
+
+        Args:
+            messages (list): Pub/Sub messages with Avro alert data
+        """
+
+        from . import value_added as va
+
+        alert_list, decoded = [], []
+        for message in messages:
+            try:
+                alert_list.extend(decode_alerts(message.data))
+
+            except Exception:
+                log.exception(f'Could not decode message {message.message_id}. '
+                              'Dropping it.')
+                message.ack()
+
+            else:
+                decoded.append(message)
+
+        if not decoded:
+            return
+
+        try:
+            xmatches, classifications = va.get_value_added_by_candid(
+                alert_list, survey=self.survey,
+                classifier_service=self.classifier_service,
+                result_store=self.result_store)
+
+        except Exception:
+            self.num_failed_batches += 1
+            if len(decoded) > 1:
+                log.exception(f'Could not process a batch of {len(alert_list)} '
+                              'alerts. Retrying its messages one at a time.')
+                for message in decoded:
+                    self.process_messages([message])
+
+            else:
+                self._fail(decoded[0])
+
+            return
+
+        try:
+            for products, table in ((xmatches, self.xmatch_table),
+                                    (classifications, self.classification_table)):
+                self._upload_new(products, table)
+
+        except Exception:
+            log.exception(f'Could not upload a batch of {len(alert_list)} '
+                          'alerts. Messages will be redelivered.')
+            self.num_failed_batches += 1
+            for message in decoded:
+                message.nack()
+
+            return
+
+        for message in decoded:
+            self._failures.pop(message.message_id, None)
+            message.ack()
+
+        if self._own_store:
+            candids = list(xmatches)
+            self.result_store.delete(candids=candids)
+            self.result_store.delete_uploaded(candids=candids)
+
+        self.num_batches += 1
+        self.num_alerts += len(alert_list)
+        self.num_acked += len(decoded)
+
+    def _fail(self, message):
+        """ Nacks a message whose products could not be computed, or drops
+            it once this happened max_failures times.
+        """
+
+        failures = self._failures.get(message.message_id, 0) + 1
+        if failures < self.max_failures:
+            log.exception(f'Could not process message {message.message_id} '
+                          f'(failure {failures}). It will be redelivered.')
+            self._failures[message.message_id] = failures
+            message.nack()
+            return
+
+        log.exception(f'Could not process message {message.message_id} '
+                      f'in {failures} attempts. Dropping it.')
+        self._failures.pop(message.message_id, None)
+        self.num_dropped += 1
+        message.ack()
+
+    def _upload_new(self, products, table):
+        """ Uploads the products of alerts that were not uploaded to table
+            before and records the upload in the result store.
+
+        Args:
+            products (dict): {candid (int): row dicts}, as returned by
+                             value_added.get_value_added_by_candid()
+            table     (str): BigQuery table
+        """
+
+        import pandas as pd
+
+        destination = f'{self.data_set}.{table}'
+        uploaded = self.result_store.get_uploaded(destination, products)
+        self.num_skipped_uploads += len(uploaded)
+        new = [c for c in products if c not in uploaded]
+        rows = [row for c in new for row in products[c]]
+        if rows:
+            self._upload(pd.DataFrame(rows), table)
+
+        self.result_store.put_uploaded(destination, new)
+
+    def _run(self):
+        """ Processing loop. Runs until stopped, then drains the buffer."""
+
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self.process_messages(batch)
+
+        # Process what was received before the pull was cancelled
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+
+            self.process_messages(batch)
+
+    def start(self):
+        """ Subscribes and starts processing messages in the background.
+
+            Raises RuntimeError if the data or models needed to compute
+            value added products are missing (see check_dependencies()).
+        """
+
+        if self.running:
+            return
+
+        check_dependencies(self.classifier_service)
+        subscriber = self._get_subscriber()
+        subscription = self.subscription
+        if not subscription.startswith('projects/'):
+            subscription = subscriber.subscription_path(project_id, subscription)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ValueAddedWorker', daemon=True)
+        self._thread.start()
+        self._pull_future = subscriber.subscribe(
+            subscription, callback=self._receive,
+            flow_control=self._get_flow_control())
+
+        log.info(f'Listening for alerts on {subscription}')
+
+    def stop(self, timeout=None):
+        """ Stops pulling messages, processes any received messages and
+            stops the worker.
+
+        Args:
+            timeout (float): Seconds to wait for the worker to finish.
+        """
+
+        if self._pull_future is not None:
+            self._pull_future.cancel()
+            self._pull_future = None
+
+        with self._buffer_changed:
+            self._stop.set()
+            self._buffer_changed.notify_all()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self, duration=None):
+        """ Processes messages until interrupted.
+
+        Args:
+            duration (float): Stop after this many seconds (Optional)
+        """
+
+        self.start()
+        try:
+            self._thread.join(duration)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.stop()
@@ -11,16 +11,43 @@
 
 from warnings import warn as _warn
 
-import pandas as pd
-from astropy import units as u
-from astroquery.xmatch import XMatch
+import numpy as np
 
-from broker.ztf_archive import _parse_data as psd
 from . import redshift as red
 
 
-def get_xmatches(alert_list, survey='ZTF', sg_thresh=0.5):
+XMATCH_COLUMNS = ['objectId', 'xobjId', 'xcatalog', 'redshift', 'dist2d',
+                  'sgscore']
+PS1_SLOTS = ('1', '2', '3')  # suffixes of the PS1 sources in a ZTF alert
+
+
+def _get_ps1_column(cands, field, dtype=float):
+    """ Gathers a PS1 candidate field for all sources in a batch of alerts.
+
+    Args:
+        cands (list): candidate dicts of each alert
+        field  (str): field name without the PS1 source suffix
+        dtype (type): numpy dtype of the returned array.
+                      None values become NaN for float dtypes.
+
+    Returns:
+        numpy array with shape (len(cands) * 3,), ordered by alert and then
+        by PS1 source.
+    """
+
+    columns = [np.array([c[field + s] for c in cands], dtype=dtype)
+               for s in PS1_SLOTS]
+
+    return np.column_stack(columns).ravel()
+
+
+def get_xmatches_table(alert_list, survey='ZTF', sg_thresh=0.5,
+                       photoz_cache=None, catalogs=(), catalog_radius=5.,
+                       alert_index=False):
     """ Finds alert cross matches in all available catalogs.
+        Cross matches for the whole batch are gathered into arrays and
+        photo-z's are calculated with a single call to the model.
+        Photo-z's of previously seen PS1 objects are taken from a cache.
 
     Args:
         alert_list (list): list of alert dicts
@@ -30,54 +57,111 @@ def get_xmatches(alert_list, survey='ZTF', sg_thresh=0.5):
         sg_thresh (float): sgscore threshold (maximum) for calling it a galaxy.
                            (sgscore -> 1 implies star)
 
+        photoz_cache (PhotozCache): Cache of photo-z's keyed by PS1 object id.
+                                    Defaults to red.get_photoz_cache().
+
+        catalogs   (list): LocalCatalog objects (see the catalog module) to
+                           match against in addition to the PS1 sources
+                           included in the alerts
+
+        catalog_radius (float): Match radius for catalogs, in arcsec.
+                                The nearest source within it is matched.
+
+        alert_index (bool): Also return the position in alert_list of the
+                            alert of each row.
+
     Returns:
-        Dictionaries of cross match info, formatted for BigQuery.
-        One dictionary per unique alert-xmatch pair.
-        [ {<column name (str)>: <value (str or float)>} ]
+        Pandas DataFrame of cross match info, formatted for BigQuery.
+        One row per unique alert-xmatch pair with columns XMATCH_COLUMNS.
 
+        If alert_index is True, returns (table, alert indices (np.array)).
     """
+
+    import pandas as pd
+
     _warn('The ZTF/Pan-STARRS photo-z calculation needs to be updated. '
           'It uses a random forest model trained on DECaLS data '
           'for photo-z estimation on Pan-STARRS data. '
           '\nThe result should not be trusted!')
 
-    xmatches = []
-
-    for alert in alert_list:
-
-        if survey == 'ZTF':
-            # get xmatches included in alert packet
-            cand = alert['candidate']
-            for s in ['1', '2', '3']:  # for each PS1 source in alert
-                sgscore = cand['sgscore' + s]
-
-                # calculate redshift
-                zdict = {
-                    'gmag': cand['sgmag' + s],
-                    'rmag': cand['srmag' + s],
-                    'zmag': cand['simag' + s],  # note this is imag
-                    'w1mag': cand['szmag' + s],  # note this is zmag
-                    'w2mag': 0.0,
-                    'radius': 0.0,
-                    'q': 0.0,
-                    'p': 0.0
-                }
-                # if source is likely a galaxy, calculate redshift
-                # else set it to -1
-                redshift = red.calcz_rongpuRF(zdict) if sgscore < sg_thresh \
-                    else -1
-
-                # collect the xmatch data
-                xmatches.append({
-                                    'objectId': alert['objectId'],
-                                    'xobjId': cand['objectidps' + s],
-                                    'xcatalog': 'PS1',
-                                    'redshift': redshift,
-                                    'dist2d': cand['distpsnr' + s],
-                                    'sgscore': sgscore
-                                })
-
-    return xmatches
+    if survey != 'ZTF' or len(alert_list) == 0:
+        table = pd.DataFrame(columns=XMATCH_COLUMNS)
+        return (table, np.empty(0, dtype=np.int64)) if alert_index else table
+
+    # get xmatches included in alert packets
+    cands = [alert['candidate'] for alert in alert_list]
+    xobjids = _get_ps1_column(cands, 'objectidps', dtype=object)
+    sgscore = _get_ps1_column(cands, 'sgscore')
+
+    # if source is likely a galaxy, calculate redshift
+    # else set it to -1
+    redshift = np.full(len(sgscore), -1.)
+    is_galaxy = sgscore < sg_thresh
+    if is_galaxy.any():
+        redshift[is_galaxy] = red.calcz_rongpuRF_cached(
+            xobjids[is_galaxy],
+            gmag=_get_ps1_column(cands, 'sgmag')[is_galaxy],
+            rmag=_get_ps1_column(cands, 'srmag')[is_galaxy],
+            zmag=_get_ps1_column(cands, 'simag')[is_galaxy],  # note: imag
+            w1mag=_get_ps1_column(cands, 'szmag')[is_galaxy],  # note: zmag
+            cache=photoz_cache,
+        )
+
+    object_ids = np.array([alert['objectId'] for alert in alert_list],
+                          dtype=object)
+
+    table = pd.DataFrame({
+        'objectId': np.repeat(object_ids, len(PS1_SLOTS)),
+        'xobjId': xobjids,
+        'xcatalog': 'PS1',
+        'redshift': redshift,
+        'dist2d': _get_ps1_column(cands, 'distpsnr'),
+        'sgscore': sgscore,
+    }, columns=XMATCH_COLUMNS)
+
+    indices = np.repeat(np.arange(len(alert_list)), len(PS1_SLOTS))
+    if catalogs:
+        matches = [c.get_xmatches_table(alert_list, catalog_radius,
+                                        alert_index=True) for c in catalogs]
+        table = pd.concat([table] + [t for t, _ in matches], ignore_index=True)
+        indices = np.concatenate([indices] + [i for _, i in matches])
+
+    return (table, indices) if alert_index else table
+
+
+def get_xmatches(alert_list, survey='ZTF', sg_thresh=0.5, photoz_cache=None,
+                 catalogs=(), catalog_radius=5.):
+    """ Finds alert cross matches in all available catalogs.
+
+    Args:
+        alert_list (list): list of alert dicts
+
+        survey      (str): name of survey generating the alerts
+
+        sg_thresh (float): sgscore threshold (maximum) for calling it a galaxy.
+                           (sgscore -> 1 implies star)
+
+        photoz_cache (PhotozCache): Cache of photo-z's keyed by PS1 object id.
+                                    Defaults to red.get_photoz_cache().
+
+        catalogs   (list): LocalCatalog objects to also match against
+
+        catalog_radius (float): Match radius for catalogs, in arcsec
+
+    Returns:
+        Dictionaries of cross match info, formatted for BigQuery.
+        One dictionary per unique alert-xmatch pair.
+        [ {<column name (str)>: <value (str or float)>} ]
+
+        Use get_xmatches_table() to get the same data as a DataFrame,
+        e.g. for bq_upload.upload_to_bigquery().
+    """
+
+    table = get_xmatches_table(alert_list, survey=survey, sg_thresh=sg_thresh,
+                               photoz_cache=photoz_cache, catalogs=catalogs,
+                               catalog_radius=catalog_radius)
+
+    return table.to_dict('records')
 
 
 def get_astroquery_xmatches(fcat1='mock_stream/data/alerts_radec.csv',
@@ -97,6 +181,9 @@ def get_astroquery_xmatches(fcat1='mock_stream/data/alerts_radec.csv',
 
     """
 
+    from astropy import units as u
+    from astroquery.xmatch import XMatch
+
     with open(fcat1) as ofile:
         table = XMatch.query(
             cat1=ofile,
@@ -108,52 +195,99 @@ def get_astroquery_xmatches(fcat1='mock_stream/data/alerts_radec.csv',
     return table
 
 
-def get_alerts_ra_dec(fout=None, max_alerts=1000):
+RA_DEC_COLUMNS = ['alert_id', 'ra', 'dec']
+
+
+def iter_alerts_ra_dec(max_alerts=None, chunk_size=100000, start_date=None,
+                       end_date=None):
+    """ Iterates over the candid, RA and DEC of locally available alerts.
+        Values are read from the local alert index (see
+        ``broker.ztf_archive.iter_release_indices``), which is built on
+        first use by decoding only the indexed fields of each alert.
+
+    Args:
+        max_alerts  (int): Max number of alerts to grab data from.
+                           None or <= 0 will return all available.
+        chunk_size  (int): Max number of alerts per chunk.
+        start_date  (str): Earliest release date to include (Optional).
+        end_date    (str): Latest release date to include (Optional).
+
+    Yields:
+        Pandas DataFrames with columns RA_DEC_COLUMNS.
+        alert_id holds the alert candid.
+    """
+
+    import pandas as pd
+
+    from broker.ztf_archive import iter_release_indices
+
+    remaining = max_alerts if max_alerts is not None and max_alerts > 0 else None
+    for _, index in iter_release_indices(start_date, end_date):
+        if remaining is not None:
+            index = index[:remaining]
+            remaining -= len(index)
+
+        for start in range(0, len(index), chunk_size):
+            chunk = index[start:start + chunk_size]
+            yield pd.DataFrame({'alert_id': chunk['candid'],
+                                'ra': chunk['ra'],
+                                'dec': chunk['dec']}, columns=RA_DEC_COLUMNS)
+
+        if remaining == 0:
+            return
+
+
+def get_alerts_ra_dec(fout=None, max_alerts=1000, chunk_size=100000,
+                      start_date=None, end_date=None):
     """ For use with get_astroquery_xmatches().
-        Iterates through alerts and writes RA & DEC info to file with format
+        Writes the candid, RA and DEC of local alerts to file with format
         compatible with astroquery.xmatch.query().
+        Data is written in chunks, as read from the local alert index.
 
     Args:
-        fout       (str): Path to save file.
+        fout       (str): Path to save file. Written as Parquet if the
+                          suffix is .parquet and as CSV otherwise.
         max_alerts (int): Max number of alerts to grab data from.
-                           <= 0 will return all available.
+                          None or <= 0 will return all available.
+        chunk_size (int): Number of alerts written at a time.
+        start_date (str): Earliest release date to include (Optional).
+        end_date   (str): Latest release date to include (Optional).
 
     Returns:
-        None, returns the alert data as a Pandas DataFrame.
+        None if fout is given, else the alert data as a Pandas DataFrame.
     """
 
-    # Grab RA, DEC from each alert
-    data_list = []  # list containing alert data dicts
-    try:
-        for a, alert in enumerate(psd.iter_alerts()):
-            # Get the alert
-            alert_id = alert['candid']
-            alert_data = psd.get_alert_data(alert_id)
-
-            # Save the data
-            dat = {
-                'alert_id': alert_id,
-                'ra': alert_data['candidate']['ra'],
-                'dec': alert_data['candidate']['dec']
-            }
-            data_list.append(dat)
-
-            if (a > max_alerts) & (a > 0):
-                break
-
-    except RuntimeError as re:
-        print("No local alert data found. "
-              "Please run 'mock_stream.download_data' first.")
-
-        raise re
-
-    # Write to file or return as a DataFrame
-    df = pd.DataFrame(data_list)
-    if fout is not None:
-        df.to_csv(fout, sep=',', columns=['alert_id', 'ra', 'dec'],
-                  header=True, index=False)
+    import pandas as pd
+
+    chunks = iter_alerts_ra_dec(max_alerts=max_alerts, chunk_size=chunk_size,
+                                start_date=start_date, end_date=end_date)
+
+    first = next(chunks, None)
+    if first is None:
+        raise RuntimeError("No local alert data found. "
+                           "Please run 'ztf_archive.download_recent_data' first.")
+
+    # Return as a DataFrame
+    if fout is None:
+        return pd.concat([first, *chunks], ignore_index=True)
+
+    # Write to file
+    if str(fout).endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(first, preserve_index=False)
+        with pq.ParquetWriter(str(fout), table.schema) as writer:
+            writer.write_table(table)
+            for chunk in chunks:
+                writer.write_table(
+                    pa.Table.from_pandas(chunk, schema=table.schema,
+                                         preserve_index=False))
 
     else:
-        return df
+        with open(fout, 'w', newline='') as ofile:
+            first.to_csv(ofile, sep=',', header=True, index=False)
+            for chunk in chunks:
+                chunk.to_csv(ofile, sep=',', header=False, index=False)
 
     return None
@@ -22,6 +22,14 @@ Usage Example
    # Download the most recent day of available data
    ztfa.download_recent_data(max_downloads=1)
 
+   # Iterate over bright, real g-band alerts without decoding the others
+   filters = {'fid': 1, 'max_mag': 18, 'min_rb': 0.65}
+   for alert in ztfa.iter_alerts(filters=filters):
+       print(alert['objectId'])
+
+   # Find the ids of alerts within 5 arcseconds of a position
+   alert_ids = ztfa.cone_search(ra=176.52, dec=16.88, radius=5 / 3600)
+
    # Delete any data downloaded to your local machine
    ztfa.delete_local_data()
 
@@ -29,11 +37,65 @@ Module Documentation
 --------------------
 """
 
+import importlib as _importlib
 import os as _os
 from warnings import warn as _warn
 
-from ._download_data import *
-from ._parse_data import *
+# Public objects and the (private) submodules defining them. Submodules are
+# only imported when one of their objects is first accessed so that
+# importing ``broker.ztf_archive`` does not load heavy dependencies.
+_LAZY_OBJECTS = {
+    '_cutouts': (
+        'CUTOUT_TYPES', 'CutoutCache', 'decode_cutout', 'get_cutouts',
+        'render_thumbnails'),
+    '_download_data': (
+        'MANIFEST_MAX_AGE', 'MANIFEST_PATH', 'ReleaseManifest', 'ZTF_DATA_DIR',
+        'ZTF_URL', 'create_ztf_sync_table', 'delete_local_data',
+        'download_data_date', 'download_recent_data', 'get_local_alerts',
+        'get_local_releases', 'get_release_date', 'get_remote_manifest',
+        'get_remote_md5_table'),
+    '_export': (
+        'EXPORT_TABLES', 'export_archive', 'export_release',
+        'read_exported_table'),
+    '_inventory': ('LocalInventory', 'get_local_inventory'),
+    '_index': (
+        'INDEX_DTYPE', 'build_release_index', 'chord_length', 'filter_index',
+        'get_alert_index', 'get_index_paths', 'get_release_index',
+        'iter_release_indices', 'radec_to_xyz', 'select_alerts'),
+    '_light_curves': (
+        'EPOCH_DTYPE', 'LightCurveStore', 'build_light_curve_store',
+        'get_alert_epochs', 'merge_epochs'),
+    '_parse_data': (
+        'get_alert_data', 'iter_alerts', 'plot_cutout', 'plot_stamps'),
+    '_spatial': (
+        'AlertSpatialIndex', 'cone_search', 'get_spatial_index',
+        'polygon_search'),
+}
+
+_OBJECT_MODULES = {
+    obj: module for module, objects in _LAZY_OBJECTS.items() for obj in objects}
+
+__all__ = sorted(_OBJECT_MODULES)
+
+
+def __getattr__(name):
+    """Import objects from submodules on first access"""
+
+    if name in _OBJECT_MODULES:
+        module = _importlib.import_module(f'.{_OBJECT_MODULES[name]}', __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+
+    if name in _LAZY_OBJECTS or name == '_utils':
+        return _importlib.import_module(f'.{name}', __name__)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
 
 if 'PGB_DATA_DIR' not in _os.environ:
     _warn('The ZTF data directory not set in the current environment. '
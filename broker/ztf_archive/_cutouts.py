@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Decodes the image cutouts (stamps) of ZTF alerts into numpy arrays and
+renders them as thumbnails, optionally across a pool of processes.
+"""
+
+import gzip
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+
+CUTOUT_TYPES = ('Science', 'Template', 'Difference')
+
+
+def decode_cutout(stamp: bytes) -> Tuple[np.ndarray, dict]:
+    """Decode a single gzipped FITS cutout
+
+    Args:
+        stamp: The ``stampData`` of an alert cutout
+
+    Returns:
+        The image as a ``float32`` array and the FITS header as a dictionary
+    """
+
+    from astropy.io import fits
+
+    with fits.open(io.BytesIO(gzip.decompress(stamp))) as hdul:
+        data = np.asarray(hdul[0].data, dtype=np.float32)
+        header = dict(hdul[0].header)
+
+    return data, header
+
+
+def _get_stamps(alert: dict) -> tuple:
+    """Return the stamp bytes of each cutout in an alert
+
+    Args:
+        alert: A ZTF alert packet
+
+    Returns:
+        A tuple of bytes (or None for missing cutouts) ordered as ``CUTOUT_TYPES``
+    """
+
+    return tuple(
+        (alert[f'cutout{t}'] or {}).get('stampData') for t in CUTOUT_TYPES)
+
+
+def _decode_stamps(stamps: tuple) -> tuple:
+    """Decode the stamps of a single alert
+
+    Args:
+        stamps: Stamp bytes as returned by ``_get_stamps``
+
+    Returns:
+        A tuple of ``(data, header)`` pairs, or None for missing cutouts
+    """
+
+    return tuple(None if s is None else decode_cutout(s) for s in stamps)
+
+
+class CutoutCache:
+    """A bounded, least recently used cache of decoded cutouts keyed by candid"""
+
+    def __init__(self, maxsize: int = 4096):
+        """Create an empty cache
+
+        Args:
+            maxsize: Maximum number of alerts to keep in the cache
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, candid: int) -> bool:
+        return candid in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f'<CutoutCache(size: {len(self)}, maxsize: {self.maxsize})>'
+
+    def get(self, candid: int):
+        """Return the decoded cutouts of an alert or None if not cached
+
+        Args:
+            candid: The alert candid
+
+        Returns:
+            Decoded cutouts as returned by ``_decode_stamps`` or None
+        """
+
+        try:
+            self._data.move_to_end(candid)
+
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self._data[candid]
+
+    def put(self, candid: int, cutouts: tuple) -> None:
+        """Add the decoded cutouts of an alert to the cache
+
+        Args:
+            candid: The alert candid
+            cutouts: Decoded cutouts as returned by ``_decode_stamps``
+        """
+
+        self._data[candid] = cutouts
+        self._data.move_to_end(candid)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries from the cache"""
+
+        self._data.clear()
+
+
+def _stack(images: List[np.ndarray]) -> np.ndarray:
+    """Stack images of possibly different shapes, padding with NaN
+
+    Cutouts near the edge of a CCD can be smaller than the usual 63 x 63
+    pixels.
+
+    Args:
+        images: Two dimensional arrays (or None for missing images)
+
+    Returns:
+        A ``float32`` array with shape ``(N, height, width)``
+    """
+
+    shapes = [im.shape for im in images if im is not None] or [(0, 0)]
+    height, width = max(s[0] for s in shapes), max(s[1] for s in shapes)
+    out = np.full((len(images), height, width), np.nan, dtype=np.float32)
+    for i, image in enumerate(images):
+        if image is not None:
+            out[i, :image.shape[0], :image.shape[1]] = image
+
+    return out
+
+
+def get_cutouts(
+        alerts: Iterable[dict],
+        num_workers: int = None,
+        cache: CutoutCache = None) -> dict:
+    """Decode the cutouts of many alerts into stacked numpy arrays
+
+    Args:
+        alerts: ZTF alert packets
+        num_workers: Number of processes used to decode cutouts (optional)
+        cache: Optional ``CutoutCache`` to read from and add to
+
+    Returns:
+        A dictionary with keys ``candid`` (array of alert candids),
+        ``science``, ``template``, and ``difference`` (``float32`` arrays
+        with shape ``(N, height, width)``) and ``headers`` (list with a
+        tuple of headers per alert)
+    """
+
+    alerts = list(alerts)
+    candids = [alert['candid'] for alert in alerts]
+
+    decoded = [None if cache is None else cache.get(c) for c in candids]
+    missing = [i for i, d in enumerate(decoded) if d is None]
+    stamps = [_get_stamps(alerts[i]) for i in missing]
+
+    if num_workers and num_workers > 1 and len(stamps) > 1:
+        chunksize = max(1, len(stamps) // (4 * num_workers))
+        with ProcessPoolExecutor(num_workers) as executor:
+            new_cutouts = list(executor.map(_decode_stamps, stamps, chunksize=chunksize))
+
+    else:
+        new_cutouts = [_decode_stamps(s) for s in stamps]
+
+    for i, cutouts in zip(missing, new_cutouts):
+        decoded[i] = cutouts
+        if cache is not None:
+            cache.put(candids[i], cutouts)
+
+    out = {'candid': np.array(candids, dtype='i8')}
+    for j, cutout_type in enumerate(CUTOUT_TYPES):
+        out[cutout_type.lower()] = _stack(
+            [None if d[j] is None else d[j][0] for d in decoded])
+
+    out['headers'] = [
+        tuple(None if c is None else c[1] for c in d) for d in decoded]
+
+    return out
+
+
+def _scale_image(image: np.ndarray) -> np.ndarray:
+    """Apply an arcsinh stretch to an image for display
+
+    Args:
+        image: A two dimensional array
+
+    Returns:
+        The stretched image scaled to the range [0, 1]
+    """
+
+    finite = image[np.isfinite(image)]
+    if not finite.size:
+        return np.zeros_like(image)
+
+    low, high = np.percentile(finite, (0.5, 99.5))
+    scaled = np.arcsinh(np.clip((image - low) / max(high - low, 1e-12), 0, 1) * 10)
+    return np.nan_to_num(scaled / np.arcsinh(10))
+
+
+def _render_thumbnail(stamps: tuple, path: str) -> str:
+    """Render the cutouts of a single alert as a PNG file
+
+    Args:
+        stamps: Stamp bytes as returned by ``_get_stamps``
+        path: Path of the output file
+
+    Returns:
+        The path of the output file
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 2))
+    FigureCanvasAgg(fig)
+    for i, (cutout_type, cutout) in enumerate(zip(CUTOUT_TYPES, _decode_stamps(stamps))):
+        axis = fig.add_subplot(1, 3, i + 1)
+        axis.set_axis_off()
+        axis.set_title(cutout_type, fontsize=8)
+        if cutout is not None:
+            axis.imshow(_scale_image(cutout[0]), cmap='gray', origin='lower')
+
+    fig.savefig(path, dpi=100, bbox_inches='tight')
+    return path
+
+
+def render_thumbnails(
+        alerts: Iterable[dict],
+        out_dir: Union[Path, str],
+        num_workers: int = None) -> List[Path]:
+    """Render PNG thumbnails of the cutouts for a batch of alerts
+
+    One file named ``<candid>.png`` is written per alert.
+
+    Args:
+        alerts: ZTF alert packets
+        out_dir: Directory to write the thumbnails into
+        num_workers: Number of processes used to render thumbnails (optional)
+
+    Returns:
+        The paths of the written files
+    """
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    stamps, paths = [], []
+    for alert in alerts:
+        stamps.append(_get_stamps(alert))
+        paths.append(str(out_dir / f'{alert["candid"]}.png'))
+
+    if num_workers and num_workers > 1 and len(stamps) > 1:
+        with ProcessPoolExecutor(num_workers) as executor:
+            written = list(executor.map(_render_thumbnail, stamps, paths))
+
+    else:
+        written = [_render_thumbnail(s, p) for s, p in zip(stamps, paths)]
+
+    return [Path(p) for p in written]
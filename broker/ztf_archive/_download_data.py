@@ -3,36 +3,220 @@
 
 """Downloads sample ZTF alerts from the ZTF alerts archive."""
 
+import json
+import re
 import shutil
 import tarfile
+import time
+from pathlib import Path
 from tempfile import TemporaryFile
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable, Iterator, Tuple
+from warnings import warn
 
-import numpy as np
-import requests
-from astropy.table import Table
-from tqdm import tqdm
+from broker.ztf_archive._utils import get_ztf_cache_dir, get_ztf_data_dir
+from ._inventory import get_local_inventory
 
-from broker.ztf_archive._utils import get_ztf_data_dir
+if TYPE_CHECKING:
+    from astropy.table import Table
 
 ZTF_DATA_DIR = get_ztf_data_dir()
 ZTF_DATA_DIR.mkdir(exist_ok=True, parents=True)
+ZTF_CACHE_DIR = get_ztf_cache_dir()
 ZTF_URL = "https://ztf.uw.edu/alerts/public/"
 
+# Cached copy of the remote MD5SUMS file and its HTTP validators
+MANIFEST_PATH = ZTF_CACHE_DIR / 'MD5SUMS'
+MANIFEST_HEADERS_PATH = ZTF_CACHE_DIR / 'MD5SUMS.json'
+MANIFEST_MAX_AGE = 3600  # Seconds before the cached manifest is revalidated
 
-def get_remote_md5_table() -> Table:
+_RELEASE_PREFIX = 'ztf_public_'
+_RELEASE_REGEX = re.compile(r'ztf_public_(\d{8})\.tar\.gz$')
+_manifest_memo = {}
+
+
+def get_release_date(file_name: str) -> str:
+    """Return the release date of a file published on the ZTF Alerts Archive
+
+    Args:
+        file_name: Name of a daily release (e.g. ``ztf_public_20180626.tar.gz``)
+
+    Returns:
+        The release date as a ``YYYYMMDD`` string or None if not a release
+    """
+
+    match = _RELEASE_REGEX.search(file_name)
+    return match.group(1) if match else None
+
+
+class ReleaseManifest:
+    """Parsed contents of the MD5SUMS file from the ZTF Alerts Archive
+
+    Published files are indexed by both file name and release date so that
+    comparisons against locally downloaded releases are hash lookups.
+    """
+
+    def __init__(self, text: str):
+        """Parse the contents of an MD5SUMS file
+
+        Args:
+            text: Contents of the MD5SUMS file
+        """
+
+        self.files = []
+        self.md5 = {}
+        self.files_by_date = {}
+        for row in text.splitlines():
+            if not row.strip():
+                continue
+
+            md5, file_name = row.split()
+            self.files.append(file_name)
+            self.md5[file_name] = md5
+
+            release_date = get_release_date(file_name)
+            if release_date:
+                self.files_by_date[release_date] = file_name
+
+    def __contains__(self, file_name: str) -> bool:
+        return file_name in self.md5
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __repr__(self) -> str:
+        return f'<ReleaseManifest(num_files: {len(self)})>'
+
+
+def _read_cached_manifest() -> Tuple[str, dict]:
+    """Return the cached MD5SUMS file and its HTTP validators
+
+    Returns:
+        The cached file contents and headers, or None if no cache exists
+    """
+
+    try:
+        text = MANIFEST_PATH.read_text()
+        headers = json.loads(MANIFEST_HEADERS_PATH.read_text())
+
+    except (FileNotFoundError, ValueError):
+        return None, {}
+
+    return text, headers
+
+
+def _write_cached_manifest(text: str, headers: dict) -> None:
+    """Write the MD5SUMS file and its HTTP validators to the local cache
+
+    Args:
+        text: Contents of the MD5SUMS file
+        headers: HTTP validators returned with the file
+    """
+
+    ZTF_CACHE_DIR.mkdir(exist_ok=True, parents=True)
+    MANIFEST_PATH.write_text(text)
+    MANIFEST_HEADERS_PATH.write_text(json.dumps(headers))
+
+
+def _fetch_manifest_text(refresh: bool = False, max_age: float = None) -> str:
+    """Return the MD5SUMS file, revalidating the local cache if necessary
+
+    The cached file is used without contacting the archive if it is younger
+    than ``max_age``. Otherwise a conditional request is made using the
+    cached ``ETag`` / ``Last-Modified`` headers.
+
+    Args:
+        refresh: Revalidate the cache regardless of its age
+        max_age: Maximum age of the cache in seconds (Default: MANIFEST_MAX_AGE)
+
+    Returns:
+        The contents of the MD5SUMS file
+    """
+
+    import requests
+
+    max_age = MANIFEST_MAX_AGE if max_age is None else max_age
+    cached_text, cached_headers = _read_cached_manifest()
+    if cached_text is not None and not refresh:
+        if time.time() - cached_headers.get('checked', 0) < max_age:
+            return cached_text
+
+    request_headers = {}
+    if cached_text is not None:
+        if 'ETag' in cached_headers:
+            request_headers['If-None-Match'] = cached_headers['ETag']
+
+        if 'Last-Modified' in cached_headers:
+            request_headers['If-Modified-Since'] = cached_headers['Last-Modified']
+
+    md5_url = requests.compat.urljoin(ZTF_URL, 'MD5SUMS')
+    try:
+        response = requests.get(md5_url, headers=request_headers)
+        response.raise_for_status()
+
+    except requests.exceptions.RequestException as e:
+        if cached_text is None:
+            raise
+
+        warn(f'Could not revalidate cached MD5SUMS file, using cache: {e}')
+        return cached_text
+
+    if response.status_code == 304:
+        text = cached_text
+        headers = cached_headers
+
+    else:
+        text = response.content.decode()
+        headers = {k: response.headers[k] for k in ('ETag', 'Last-Modified')
+                   if k in response.headers}
+
+    headers['checked'] = time.time()
+    _write_cached_manifest(text, headers)
+    return text
+
+
+def get_remote_manifest(
+        refresh: bool = False, max_age: float = None) -> ReleaseManifest:
+    """Get an index of files published on the ZTF Alerts Archive
+
+    The archive's MD5SUMS file is cached on disk and only downloaded again
+    if it has changed. The file is parsed once per process.
+
+    Args:
+        refresh: Revalidate the cached file regardless of its age
+        max_age: Maximum age of the cache in seconds (Default: MANIFEST_MAX_AGE)
+
+    Returns:
+        A ``ReleaseManifest`` object
+    """
+
+    text = _fetch_manifest_text(refresh, max_age)
+    if text not in _manifest_memo:
+        _manifest_memo.clear()
+        _manifest_memo[text] = ReleaseManifest(text)
+
+    return _manifest_memo[text]
+
+
+def get_remote_md5_table(refresh: bool = False) -> 'Table':
     """Get a list of published ZTF data releases from the ZTF Alerts Archive
 
+    Args:
+        refresh: Revalidate the cached list of releases regardless of its age
+
     Returns:
         A list of file names for alerts published on the ZTF Alerts Archive
     """
 
-    md5_url = requests.compat.urljoin(ZTF_URL, 'MD5SUMS')
-    md5_table = requests.get(md5_url).content.decode()
+    from astropy.table import Table
+
+    manifest = get_remote_manifest(refresh)
     out_table = Table(
         names=['md5', 'file'],
         dtype=['U32', 'U1000'],
-        rows=[row.split() for row in md5_table.split('\n')[:-1]])
+        rows=[(manifest.md5[f], f) for f in manifest])
 
     return out_table['file', 'md5']
 
@@ -44,7 +228,7 @@ def get_local_releases() -> Iterable[str]:
         An iterable of downloaded release dates from the ZTF Alerts Archive
     """
 
-    return (p.name.lstrip('ztf_public_') for p in ZTF_DATA_DIR.glob('*'))
+    return (release for release in get_local_inventory(ZTF_DATA_DIR).releases())
 
 
 def get_local_alerts() -> Iterable[int]:
@@ -54,7 +238,18 @@ def get_local_alerts() -> Iterable[int]:
         An iterable of alert ID values as ints
     """
 
-    return (int(p.stem) for p in ZTF_DATA_DIR.glob('*/*.avro'))
+    inventory = get_local_inventory(ZTF_DATA_DIR)
+    return (alert_id for alert_id in inventory.alert_ids())
+
+
+def _get_local_alert_paths() -> Iterable[Path]:
+    """Return an iterable of file paths for all downloaded alert data
+
+    Returns:
+        An iterable of ``Path`` objects
+    """
+
+    return get_local_inventory(ZTF_DATA_DIR).alert_paths()
 
 
 def _download_alerts_file(
@@ -71,13 +266,16 @@ def _download_alerts_file(
         verbose: Display a progress bar
     """
 
+    import requests
+    from tqdm import tqdm
+
     # noinspection PyUnresolvedReferences
     url = requests.compat.urljoin(ZTF_URL, file_name)
     file_data = requests.get(url, stream=True)
 
     # Get size of data to be downloaded
     total_size = int(file_data.headers.get('content-length', 0))
-    iteration_number = np.ceil(total_size // block_size)
+    iteration_number = total_size // block_size
 
     # Construct progress bar iterable
     data_iterable = file_data.iter_content(block_size)
@@ -122,6 +320,7 @@ def download_data_date(
     file_name = f'ztf_public_{year}{month:02d}{day:02d}.tar.gz'
     out_dir = ZTF_DATA_DIR / file_name.rstrip('.tar.gz')
     _download_alerts_file(file_name, out_dir, block_size, verbose)
+    get_local_inventory(ZTF_DATA_DIR).add_release(get_release_date(file_name))
 
 
 def download_recent_data(
@@ -141,14 +340,18 @@ def download_recent_data(
         stop_on_exist: Exit when encountering an alert that is already downloaded
     """
 
-    file_names = get_remote_md5_table()['file']
+    from tqdm import tqdm
+
+    file_names = get_remote_manifest()
+    inventory = get_local_inventory(ZTF_DATA_DIR)
     num_downloads = min(max_downloads, len(file_names))
     for i, f_name in enumerate(file_names):
         if i >= max_downloads:
             break
 
         # Skip download if data was already downloaded
-        if f_name in list(get_local_releases()):
+        release = get_release_date(f_name)
+        if inventory.has_release(release):
             tqdm.write(
                 f'Already Downloaded ({i + 1}/{num_downloads}): {f_name}')
 
@@ -160,6 +363,7 @@ def download_recent_data(
         out_dir = ZTF_DATA_DIR / f_name.rstrip('.tar.gz')
         tqdm.write(f'Downloading ({i + 1}/{num_downloads}): {f_name}')
         _download_alerts_file(f_name, out_dir, block_size, verbose)
+        inventory.add_release(release)
 
 
 def delete_local_data() -> None:
@@ -167,12 +371,13 @@ def delete_local_data() -> None:
 
     shutil.rmtree(ZTF_DATA_DIR)
     ZTF_DATA_DIR.mkdir(exist_ok=True, parents=True)
+    get_local_inventory(ZTF_DATA_DIR).clear()
 
 
 def create_ztf_sync_table(
         bucket_name: str = None,
         out_path: str = None,
-        verbose: bool = True) -> Table:
+        verbose: bool = True) -> 'Table':
     """Create a table for uploading ZTF releases to a GCP bucket
 
     Only include files not already present in the bucket
@@ -183,7 +388,10 @@ def create_ztf_sync_table(
         verbose    (bool): Whether to display a progress bar (Default: True)
     """
 
+    import requests
+    from astropy.table import Table
     from google.cloud import storage
+    from tqdm import tqdm
 
     # Get new file urls to upload
     release_table = get_remote_md5_table()
@@ -192,9 +400,9 @@ def create_ztf_sync_table(
     if bucket_name:
         storage_client = storage.Client()
         bucket = storage_client.get_bucket(bucket_name)
-        existing_files = [blob.name for blob in bucket.list_blobs()]
+        existing_files = {blob.name for blob in bucket.list_blobs()}
 
-        is_new = ~np.isin(release_table['file'], existing_files)
+        is_new = [f not in existing_files for f in release_table['file']]
         release_table = release_table[is_new]
 
     files = release_table['file']
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Exports locally downloaded ZTF alerts to columnar Parquet files and reads
+them back as Arrow tables or pandas DataFrames.
+
+Each exported table is partitioned by night (i.e., release date) using
+``night=YYYYMMDD`` subdirectories:
+
+- ``candidates``: One row per alert with the alert's candidate properties
+- ``prv_candidates``: One row per unique previous epoch of each object. Each
+  epoch is written once, to the first exported night that contains it.
+- ``cutouts``: One row per alert with the compressed cutout stamps (optional)
+"""
+
+from pathlib import Path
+from typing import Iterable, Union
+
+from broker.ztf_archive._utils import get_ztf_data_dir
+from ._download_data import get_local_releases
+from ._inventory import get_local_inventory
+from ._parse_data import _iter_parsed_alerts
+from ._schema import get_field_schema, read_header
+
+ZTF_DATA_DIR = get_ztf_data_dir()
+EXPORT_TABLES = ('candidates', 'prv_candidates', 'cutouts')
+CUTOUT_FIELDS = ('cutoutScience', 'cutoutTemplate', 'cutoutDifference')
+
+_ARROW_TYPES = {
+    'boolean': 'bool_',
+    'int': 'int32',
+    'long': 'int64',
+    'float': 'float32',
+    'double': 'float64',
+    'string': 'string',
+    'bytes': 'binary',
+}
+
+
+def _arrow_type(schema):
+    """Return the Arrow data type of an expanded Avro schema
+
+    Args:
+        schema: An expanded Avro schema
+
+    Returns:
+        A ``pyarrow.DataType``
+    """
+
+    import pyarrow as pa
+
+    if isinstance(schema, list):
+        branches = [b for b in schema if b != 'null']
+        if len(branches) != 1:
+            raise ValueError(f'Unsupported Avro union: {schema}')
+
+        return _arrow_type(branches[0])
+
+    schema_type = schema['type'] if isinstance(schema, dict) else schema
+    if schema_type in _ARROW_TYPES:
+        return getattr(pa, _ARROW_TYPES[schema_type])()
+
+    if schema_type == 'record':
+        return pa.struct([(f['name'], _arrow_type(f['type'])) for f in schema['fields']])
+
+    if schema_type == 'array':
+        return pa.list_(_arrow_type(schema['items']))
+
+    raise ValueError(f'Unsupported Avro type: {schema_type}')
+
+
+def _record_fields(schema) -> list:
+    """Return the fields of a (possibly nullable or repeated) record schema
+
+    Args:
+        schema: An expanded Avro schema
+
+    Returns:
+        A list of Avro field definitions
+    """
+
+    if isinstance(schema, list):
+        schema = next(b for b in schema if b != 'null')
+
+    if schema['type'] == 'array':
+        return _record_fields(schema['items'])
+
+    return schema['fields']
+
+
+def _arrow_schemas(writer_schema: str) -> dict:
+    """Return the Arrow schemas of the exported tables
+
+    Args:
+        writer_schema: The Avro schema of the exported alerts
+
+    Returns:
+        A dictionary mapping table names to ``pyarrow.Schema`` objects
+    """
+
+    import pyarrow as pa
+
+    object_id = pa.field('objectId', pa.string())
+    candidate = _record_fields(get_field_schema(writer_schema, 'candidate'))
+    prv_candidate = _record_fields(get_field_schema(writer_schema, 'prv_candidates'))
+
+    return {
+        'candidates': pa.schema(
+            [object_id] + [(f['name'], _arrow_type(f['type'])) for f in candidate]),
+        'prv_candidates': pa.schema(
+            [object_id] + [(f['name'], _arrow_type(f['type'])) for f in prv_candidate]),
+        'cutouts': pa.schema(
+            [object_id, ('candid', pa.int64())]
+            + [(f, pa.binary()) for f in CUTOUT_FIELDS]),
+    }
+
+
+class _BatchWriter:
+    """Accumulates rows for a single table and writes them in row groups"""
+
+    def __init__(self, path: Path, schema):
+        """Open a Parquet file for writing
+
+        Args:
+            path: Path of the output file
+            schema: The ``pyarrow.Schema`` of the table
+        """
+
+        import pyarrow.parquet as pq
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.schema = schema
+        self.columns = {name: [] for name in schema.names}
+        self._writer = pq.ParquetWriter(str(path), schema)
+
+    def append(self, row: dict) -> None:
+        """Add a row to the current batch"""
+
+        for name, column in self.columns.items():
+            column.append(row.get(name))
+
+    def flush(self) -> None:
+        """Write the current batch as a row group"""
+
+        import pyarrow as pa
+
+        if self.columns[self.schema.names[0]]:
+            table = pa.Table.from_pydict(self.columns, schema=self.schema)
+            self._writer.write_table(table)
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self) -> None:
+        """Flush remaining rows and close the output file"""
+
+        self.flush()
+        self._writer.close()
+
+
+def _exported_epochs(out_dir: Union[Path, str], exclude: Iterable[str] = ()) -> set:
+    """Return the keys of previous epochs already exported to ``out_dir``
+
+    Args:
+        out_dir: Directory the tables were exported into
+        exclude: Nights to ignore, e.g. because they are about to be rewritten
+
+    Returns:
+        A set of ``(objectId, jd, fid)`` tuples
+    """
+
+    if not (Path(out_dir) / 'prv_candidates').exists():
+        return set()
+
+    data = read_exported_table(
+        'prv_candidates', out_dir, columns=['objectId', 'jd', 'fid', 'night'],
+        as_pandas=False).to_pydict()
+
+    exclude = set(exclude)
+    return {
+        (object_id, jd, fid) for object_id, jd, fid, night
+        in zip(data['objectId'], data['jd'], data['fid'], data['night'])
+        if night not in exclude
+    }
+
+
+def _export_release(release, out_dir, include_cutouts, batch_size,
+                    num_workers, seen_epochs):
+    """Export a downloaded release, skipping previous epochs in ``seen_epochs``
+
+    See ``export_release`` for a description of the arguments.
+    ``seen_epochs`` is updated with the previous epochs written for the release.
+    """
+
+    paths = sorted(get_local_inventory(ZTF_DATA_DIR).alert_paths(release))
+    if not paths:
+        raise ValueError(f'Release {release} not locally available.')
+
+    with open(paths[0], 'rb') as f:
+        schemas = _arrow_schemas(read_header(f)['avro.schema'])
+
+    tables = EXPORT_TABLES if include_cutouts else EXPORT_TABLES[:2]
+    fields = ['objectId', 'candid', 'candidate', 'prv_candidates']
+    if include_cutouts:
+        fields += CUTOUT_FIELDS
+
+    out_dir = Path(out_dir)
+    writers = {
+        table: _BatchWriter(
+            out_dir / table / f'night={release}' / 'part-0.parquet',
+            schemas[table])
+        for table in tables
+    }
+
+    alerts = _iter_parsed_alerts(paths, num_workers=num_workers, fields=fields)
+    try:
+        for i, alert in enumerate(alerts, start=1):
+            object_id = alert['objectId']
+            writers['candidates'].append(
+                {'objectId': object_id, **alert['candidate']})
+
+            for epoch in alert['prv_candidates'] or []:
+                key = (object_id, epoch['jd'], epoch['fid'])
+                if key not in seen_epochs:
+                    seen_epochs.add(key)
+                    writers['prv_candidates'].append(
+                        {'objectId': object_id, **epoch})
+
+            if include_cutouts:
+                row = {'objectId': object_id, 'candid': alert['candid']}
+                for field in CUTOUT_FIELDS:
+                    row[field] = (alert[field] or {}).get('stampData')
+
+                writers['cutouts'].append(row)
+
+            if i % batch_size == 0:
+                for writer in writers.values():
+                    writer.flush()
+
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def export_release(
+        release: str,
+        out_dir: Union[Path, str],
+        include_cutouts: bool = False,
+        batch_size: int = 5000,
+        num_workers: int = None) -> None:
+    """Export a downloaded release to columnar Parquet files
+
+    Alerts are streamed into row groups of ``batch_size`` alerts so memory
+    usage does not depend on the size of the release. Previous epochs are
+    deduplicated on ``objectId``, ``jd`` and ``fid`` across all nights in
+    ``out_dir``: epochs already exported for another night are not written
+    again.
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+        out_dir: Directory to write the exported tables into
+        include_cutouts: Also export the cutout stamps (Default: False)
+        batch_size: Number of alerts per row group (Default: 5000)
+        num_workers: Number of processes used to decode alerts (optional)
+    """
+
+    seen_epochs = _exported_epochs(out_dir, exclude=[release])
+    _export_release(release, out_dir, include_cutouts, batch_size,
+                    num_workers, seen_epochs)
+
+
+def export_archive(
+        out_dir: Union[Path, str],
+        releases: Iterable[str] = None,
+        include_cutouts: bool = False,
+        batch_size: int = 5000,
+        num_workers: int = None) -> None:
+    """Export downloaded releases to columnar Parquet files
+
+    See ``export_release`` for details on the exported tables. Previous
+    epochs are deduplicated across all exported nights.
+
+    Args:
+        out_dir: Directory to write the exported tables into
+        releases: Release dates to export (Default: All downloaded releases)
+        include_cutouts: Also export the cutout stamps (Default: False)
+        batch_size: Number of alerts per row group (Default: 5000)
+        num_workers: Number of processes used to decode alerts (optional)
+    """
+
+    releases = list(get_local_releases() if releases is None else releases)
+    seen_epochs = _exported_epochs(out_dir, exclude=releases)
+    for release in releases:
+        _export_release(release, out_dir, include_cutouts, batch_size,
+                        num_workers, seen_epochs)
+
+
+def read_exported_table(
+        table: str,
+        out_dir: Union[Path, str],
+        start_date: str = None,
+        end_date: str = None,
+        columns: Iterable[str] = None,
+        as_pandas: bool = True):
+    """Read a table written by ``export_release`` or ``export_archive``
+
+    Nights outside of the given date range are not read from disk.
+
+    Args:
+        table: Name of the table (``candidates``, ``prv_candidates`` or ``cutouts``)
+        out_dir: Directory the tables were exported into
+        start_date: Earliest night to read as a ``YYYYMMDD`` string (optional)
+        end_date: Latest night to read as a ``YYYYMMDD`` string (optional)
+        columns: Columns to read (Default: All columns)
+        as_pandas: Return a ``DataFrame`` instead of a ``pyarrow.Table``
+
+    Returns:
+        The table data with an additional ``night`` column
+    """
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if table not in EXPORT_TABLES:
+        raise ValueError(f'Invalid table name: {table}')
+
+    partitioning = ds.partitioning(pa.schema([('night', pa.string())]), flavor='hive')
+    dataset = ds.dataset(
+        str(Path(out_dir) / table), format='parquet', partitioning=partitioning)
+
+    row_filter = None
+    for bound, op in ((start_date, '__ge__'), (end_date, '__le__')):
+        if bound is not None:
+            expression = getattr(ds.field('night'), op)(str(bound))
+            row_filter = expression if row_filter is None else row_filter & expression
+
+    data = dataset.to_table(
+        columns=None if columns is None else list(columns), filter=row_filter)
+
+    return data.to_pandas() if as_pandas else data
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Builds and queries a lightweight index of locally downloaded ZTF alerts.
+
+The index holds a handful of candidate properties for every alert so that
+subsets of the local archive can be selected without decoding each alert.
+"""
+
+from datetime import date
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from broker.ztf_archive._utils import get_ztf_cache_dir, get_ztf_data_dir
+from ._inventory import get_local_inventory
+from ._schema import read_fields
+
+ZTF_DATA_DIR = get_ztf_data_dir()
+INDEX_DIR = get_ztf_cache_dir() / 'index'
+
+INDEX_DTYPE = np.dtype([
+    ('release', 'U8'),
+    ('alert_id', 'i8'),
+    ('objectId', 'U16'),
+    ('candid', 'i8'),
+    ('jd', 'f8'),
+    ('fid', 'i2'),
+    ('magpsf', 'f4'),
+    ('sigmapsf', 'f4'),
+    ('rb', 'f4'),
+    ('programid', 'i2'),
+    ('ra', 'f8'),
+    ('dec', 'f8'),
+])
+
+_CANDIDATE_COLUMNS = (
+    'jd', 'fid', 'magpsf', 'sigmapsf', 'rb', 'programid', 'ra', 'dec')
+_INDEX_FIELDS = ('objectId', 'candid') + tuple(
+    f'candidate.{c}' for c in _CANDIDATE_COLUMNS)
+_MISSING = {'f': np.nan, 'i': -1}
+_DATE = Union[str, date]
+
+
+def _release_dir(release: str) -> Path:
+    """Return the directory of a downloaded release
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+
+    Returns:
+        A ``Path`` object
+    """
+
+    return ZTF_DATA_DIR / f'ztf_public_{release}'
+
+
+def _index_path(release: str) -> Path:
+    """Return the path of the index file for a downloaded release
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+
+    Returns:
+        A ``Path`` object
+    """
+
+    return INDEX_DIR / f'{release}.npy'
+
+
+def _index_row(release: str, path: Path) -> tuple:
+    """Return the index entry for a single alert file
+
+    Args:
+        release: The release date of the alert
+        path: Path of the alert file
+
+    Returns:
+        A tuple with values ordered as ``INDEX_DTYPE``
+    """
+
+    with open(path, 'rb') as f:
+        alert = read_fields(f, _INDEX_FIELDS)
+
+    row = [release, int(path.stem), alert['objectId'], alert['candid']]
+    for column in _CANDIDATE_COLUMNS:
+        value = alert['candidate'][column]
+        if value is None:
+            value = _MISSING[INDEX_DTYPE[column].kind]
+
+        row.append(value)
+
+    return tuple(row)
+
+
+def build_release_index(release: str) -> np.ndarray:
+    """Build and save the alert index for a single downloaded release
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+
+    Returns:
+        The index as a structured numpy array
+    """
+
+    release_dir = _release_dir(release)
+    if not release_dir.is_dir():
+        raise ValueError(f'Release {release} not locally available.')
+
+    inventory = get_local_inventory(ZTF_DATA_DIR)
+    inventory.refresh()
+    rows = [_index_row(release, p) for p in inventory.alert_paths(release)]
+    index = np.array(rows, dtype=INDEX_DTYPE)
+
+    INDEX_DIR.mkdir(exist_ok=True, parents=True)
+    np.save(_index_path(release), index)
+    return index
+
+
+def get_release_index(release: str, rebuild: bool = False) -> np.ndarray:
+    """Return the alert index for a single downloaded release
+
+    The index is built on first use and rebuilt whenever the contents of
+    the release directory change.
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+        rebuild: Rebuild the index even if it is up to date
+
+    Returns:
+        The index as a structured numpy array
+    """
+
+    if rebuild or _index_mtime(release) is None:
+        return build_release_index(release)
+
+    return np.load(_index_path(release))
+
+
+def _index_mtime(release: str) -> Optional[int]:
+    """Return the modification time of an up to date release index
+
+    Only file metadata is read, so checking every release is cheap.
+
+    Args:
+        release: The release date as a ``YYYYMMDD`` string
+
+    Returns:
+        The modification time in ns, or None if the index of the release
+        is missing or older than the release directory
+    """
+
+    try:
+        index_stat = _index_path(release).stat()
+
+    except FileNotFoundError:
+        return None
+
+    if index_stat.st_mtime < _release_dir(release).stat().st_mtime:
+        return None
+
+    return index_stat.st_mtime_ns
+
+
+def _normalize_date(release_date: _DATE) -> str:
+    """Return a date as a ``YYYYMMDD`` string
+
+    Args:
+        release_date: A ``date`` object or ``YYYYMMDD`` string
+
+    Returns:
+        The date as a string
+    """
+
+    if isinstance(release_date, date):
+        return release_date.strftime('%Y%m%d')
+
+    return str(release_date).replace('-', '')
+
+
+def _local_releases() -> List[str]:
+    """Return the release dates of all downloaded releases"""
+
+    return get_local_inventory(ZTF_DATA_DIR).releases()
+
+
+def iter_release_indices(
+        start_date: _DATE = None,
+        end_date: _DATE = None) -> Iterator[Tuple[str, np.ndarray]]:
+    """Iterate over the alert indices of downloaded releases in a date range
+
+    Releases are visited in chronological order and each index is only
+    loaded (or built) when it is reached.
+
+    Args:
+        start_date: Earliest release date to include (inclusive, optional)
+        end_date: Latest release date to include (inclusive, optional)
+
+    Yields:
+        The release date as a ``YYYYMMDD`` string and its index as a
+        structured numpy array
+    """
+
+    releases = sorted(_local_releases())
+    if start_date is not None:
+        start_date = _normalize_date(start_date)
+        releases = [r for r in releases if r >= start_date]
+
+    if end_date is not None:
+        end_date = _normalize_date(end_date)
+        releases = [r for r in releases if r <= end_date]
+
+    for release in releases:
+        yield release, get_release_index(release)
+
+
+def get_alert_index(
+        start_date: _DATE = None, end_date: _DATE = None) -> np.ndarray:
+    """Return the alert index for all downloaded releases in a date range
+
+    Args:
+        start_date: Earliest release date to include (inclusive, optional)
+        end_date: Latest release date to include (inclusive, optional)
+
+    Returns:
+        The index as a structured numpy array
+    """
+
+    indices = [index for _, index in iter_release_indices(start_date, end_date)]
+    if not indices:
+        return np.empty(0, dtype=INDEX_DTYPE)
+
+    return np.concatenate(indices)
+
+
+def _as_array(value) -> np.ndarray:
+    """Return a scalar or iterable as a one dimensional array"""
+
+    return np.atleast_1d(np.asarray(value))
+
+
+def radec_to_xyz(ra, dec) -> np.ndarray:
+    """Convert coordinates to unit vectors
+
+    Args:
+        ra: Right Ascension in degrees
+        dec: Declination in degrees
+
+    Returns:
+        An array of unit vectors with shape ``(N, 3)``
+    """
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack(
+        (cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+
+def chord_length(radius: float) -> float:
+    """Return the chord length between unit vectors separated by an angle
+
+    Args:
+        radius: Angular separation in degrees
+
+    Returns:
+        The chord length
+    """
+
+    return 2 * np.sin(np.radians(min(radius, 180)) / 2)
+
+
+def filter_index(
+        index: np.ndarray,
+        fid: Union[int, Iterable[int]] = None,
+        min_mag: float = None,
+        max_mag: float = None,
+        min_rb: float = None,
+        programid: Union[int, Iterable[int]] = None,
+        region: Tuple[float, float, float] = None) -> np.ndarray:
+    """Return a boolean mask selecting alerts that pass a set of filters
+
+    Args:
+        index: An alert index as returned by ``get_alert_index``
+        fid: Filter id(s) to keep (1 = g, 2 = r, 3 = i)
+        min_mag: Minimum PSF magnitude (i.e., the brightest allowed)
+        max_mag: Maximum PSF magnitude (i.e., the faintest allowed)
+        min_rb: Minimum real-bogus score
+        programid: Program id(s) to keep
+        region: Cone ``(ra, dec, radius)`` in degrees
+
+    Returns:
+        A boolean array with one element per index entry
+    """
+
+    mask = np.ones(len(index), dtype=bool)
+    if fid is not None:
+        mask &= np.isin(index['fid'], _as_array(fid))
+
+    if min_mag is not None:
+        mask &= index['magpsf'] >= min_mag
+
+    if max_mag is not None:
+        mask &= index['magpsf'] <= max_mag
+
+    if min_rb is not None:
+        mask &= index['rb'] >= min_rb
+
+    if programid is not None:
+        mask &= np.isin(index['programid'], _as_array(programid))
+
+    if region is not None:
+        ra, dec, radius = region
+        center = radec_to_xyz(ra, dec)[0]
+        dot = radec_to_xyz(index['ra'], index['dec']) @ center
+        mask &= dot >= np.cos(np.radians(radius))
+
+    return mask
+
+
+def select_alerts(
+        start_date: _DATE = None,
+        end_date: _DATE = None,
+        **filters) -> np.ndarray:
+    """Return index entries for downloaded alerts that pass a set of filters
+
+    Alerts are selected using the local alert index without being decoded.
+    See ``filter_index`` for the supported keyword arguments.
+
+    Args:
+        start_date: Earliest release date to include (inclusive, optional)
+        end_date: Latest release date to include (inclusive, optional)
+        Any filter accepted by ``filter_index``
+
+    Returns:
+        The selected index entries as a structured numpy array
+    """
+
+    index = get_alert_index(start_date, end_date)
+    return index[filter_index(index, **filters)]
+
+
+def get_index_paths(index: np.ndarray) -> Iterable[Path]:
+    """Return file paths for the alerts in an alert index
+
+    Args:
+        index: An alert index as returned by ``get_alert_index``
+
+    Returns:
+        An iterable of ``Path`` objects
+    """
+
+    return (
+        _release_dir(release) / f'{alert_id}.avro'
+        for release, alert_id in zip(index['release'], index['alert_id'])
+    )
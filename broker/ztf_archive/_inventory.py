@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Keeps an in-memory inventory of locally downloaded ZTF releases and alerts.
+
+Directory listings are built with ``os.scandir`` and cached against the
+modification time of each directory, so repeated queries only rescan
+releases whose contents have changed since the last call.
+"""
+
+import os
+import time
+from itertools import chain
+from pathlib import Path
+from threading import RLock
+from typing import Dict, Iterator, List, Tuple, Union
+
+from broker.ztf_archive._utils import get_ztf_data_dir
+
+_RELEASE_PREFIX = 'ztf_public_'
+_ALERT_SUFFIX = '.avro'
+
+
+def _scan_releases(data_dir: str) -> List[str]:
+    """Return the release dates of all release directories in ``data_dir``"""
+
+    with os.scandir(data_dir) as entries:
+        return [
+            entry.name[len(_RELEASE_PREFIX):] for entry in entries
+            if entry.name.startswith(_RELEASE_PREFIX) and entry.is_dir()
+        ]
+
+
+def _scan_alerts(release_dir: str) -> Tuple[int, ...]:
+    """Return the ids of all alert files in a release directory"""
+
+    suffix_len = len(_ALERT_SUFFIX)
+    with os.scandir(release_dir) as entries:
+        return tuple(
+            int(entry.name[:-suffix_len]) for entry in entries
+            if entry.name.endswith(_ALERT_SUFFIX)
+            and entry.name[:-suffix_len].isdigit()
+        )
+
+
+def _mtime(path: str) -> int:
+    """Return the modification time of a path in ns, or -1 if it is missing"""
+
+    try:
+        return os.stat(path).st_mtime_ns
+
+    except FileNotFoundError:
+        return -1
+
+
+class LocalInventory:
+    """Cached listing of the releases and alerts in a local data directory
+
+    Listings are refreshed lazily: queries compare the modification time of
+    the data directory and of each release directory against the cached
+    values and rescan only the directories that changed. Checks are made at
+    most once every ``refresh_interval`` seconds.
+    """
+
+    def __init__(self, data_dir: Union[str, Path], refresh_interval: float = 1):
+        """Cached listing of the releases and alerts in a local data directory
+
+        Args:
+            data_dir: Directory holding one ``ztf_public_<date>`` directory per release
+            refresh_interval: Minimum number of seconds between checks for changes
+        """
+
+        self.data_dir = Path(data_dir)
+        self.refresh_interval = refresh_interval
+        self._lock = RLock()
+        self._last_refresh = None
+        self._data_dir_mtime = None
+        self._release_mtimes: Dict[str, int] = {}
+        self._release_alerts: Dict[str, Tuple[int, ...]] = {}
+        self._alert_releases: Dict[int, str] = {}
+        self._num_duplicates = 0  # Alerts present in more than one release
+
+    def __repr__(self) -> str:
+        return f'<LocalInventory {self.data_dir}>'
+
+    def _release_dir(self, release: str) -> str:
+        return os.path.join(self.data_dir, _RELEASE_PREFIX + release)
+
+    def _forget_release(self, release: str) -> None:
+        """Remove a release from the cached listings"""
+
+        self._release_mtimes.pop(release, None)
+        if release not in self._release_alerts:
+            return
+
+        alert_ids = self._release_alerts.pop(release)
+        if not self._num_duplicates:
+            for alert_id in alert_ids:
+                del self._alert_releases[alert_id]
+
+            return
+
+        # Alerts shared with other releases must stay in the lookup table
+        self._alert_releases.clear()
+        for other, other_ids in self._release_alerts.items():
+            for alert_id in other_ids:
+                self._alert_releases.setdefault(alert_id, other)
+
+        total = sum(len(ids) for ids in self._release_alerts.values())
+        self._num_duplicates = total - len(self._alert_releases)
+
+    def _scan_release(self, release: str, mtime: int) -> None:
+        """(Re)build the cached listing of a single release"""
+
+        self._forget_release(release)
+        try:
+            alert_ids = _scan_alerts(self._release_dir(release))
+
+        except FileNotFoundError:
+            return
+
+        self._release_alerts[release] = alert_ids
+        self._release_mtimes[release] = mtime
+
+        num_known = len(self._alert_releases)
+        if self._alert_releases.keys().isdisjoint(alert_ids):
+            self._alert_releases.update(dict.fromkeys(alert_ids, release))
+
+        else:
+            for alert_id in alert_ids:
+                self._alert_releases.setdefault(alert_id, release)
+
+        num_added = len(self._alert_releases) - num_known
+        self._num_duplicates += len(alert_ids) - num_added
+
+    def refresh(self, force: bool = True) -> None:
+        """Rescan any directories modified since the last refresh
+
+        Args:
+            force: Check for changes even if ``refresh_interval`` has not elapsed
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            if not (force or self._last_refresh is None
+                    or now - self._last_refresh >= self.refresh_interval):
+                return
+
+            self._last_refresh = now
+            data_dir_mtime = _mtime(self.data_dir)
+            if data_dir_mtime != self._data_dir_mtime:
+                on_disk = set(_scan_releases(self.data_dir)) \
+                    if data_dir_mtime >= 0 else set()
+
+                for release in set(self._release_mtimes) - on_disk:
+                    self._forget_release(release)
+
+                for release in on_disk - set(self._release_mtimes):
+                    self._release_mtimes[release] = None
+
+                self._data_dir_mtime = data_dir_mtime
+
+            for release, cached_mtime in list(self._release_mtimes.items()):
+                mtime = _mtime(self._release_dir(release))
+                if mtime < 0:
+                    self._forget_release(release)
+
+                elif mtime != cached_mtime:
+                    self._scan_release(release, mtime)
+
+    def add_release(self, release: str) -> None:
+        """Record a newly downloaded release without rescanning other releases
+
+        Args:
+            release: The release date as a ``YYYYMMDD`` string
+        """
+
+        with self._lock:
+            self._scan_release(release, _mtime(self._release_dir(release)))
+
+    def discard_release(self, release: str) -> None:
+        """Remove a deleted release from the inventory
+
+        Args:
+            release: The release date as a ``YYYYMMDD`` string
+        """
+
+        with self._lock:
+            self._forget_release(release)
+
+    def clear(self) -> None:
+        """Drop all cached listings"""
+
+        with self._lock:
+            self._last_refresh = None
+            self._data_dir_mtime = None
+            self._release_mtimes.clear()
+            self._release_alerts.clear()
+            self._alert_releases.clear()
+            self._num_duplicates = 0
+
+    def releases(self) -> List[str]:
+        """Return the sorted release dates of all downloaded releases"""
+
+        with self._lock:
+            self.refresh(force=False)
+            return sorted(self._release_alerts)
+
+    def alert_ids(self, release: str = None) -> Tuple[int, ...]:
+        """Return the ids of downloaded alerts
+
+        Args:
+            release: Only return alerts from the given release (Optional)
+
+        Returns:
+            A tuple of alert ids
+        """
+
+        with self._lock:
+            self.refresh(force=False)
+            if release is not None:
+                return self._release_alerts.get(release, ())
+
+            return tuple(chain.from_iterable(
+                self._release_alerts[r] for r in sorted(self._release_alerts)))
+
+    def alert_paths(self, release: str = None) -> Iterator[Path]:
+        """Return file paths of downloaded alerts
+
+        Args:
+            release: Only return alerts from the given release (Optional)
+
+        Returns:
+            An iterator of ``Path`` objects
+        """
+
+        with self._lock:
+            self.refresh(force=False)
+            releases = sorted(self._release_alerts) if release is None else [release]
+            listings = [(r, self._release_alerts.get(r, ())) for r in releases]
+
+        for release, alert_ids in listings:
+            release_dir = Path(self._release_dir(release))
+            for alert_id in alert_ids:
+                yield release_dir / f'{alert_id}{_ALERT_SUFFIX}'
+
+    def get_release(self, alert_id: int) -> str:
+        """Return the release date of a downloaded alert
+
+        Args:
+            alert_id: Unique ZTF identifier for the alert packet
+
+        Returns:
+            The release date as a ``YYYYMMDD`` string
+        """
+
+        alert_id = int(alert_id)
+        with self._lock:
+            self.refresh(force=False)
+            if alert_id not in self._alert_releases:
+                self.refresh()  # The alert may be newer than the cached listing
+
+            try:
+                return self._alert_releases[alert_id]
+
+            except KeyError:
+                raise ValueError(
+                    f'Data for "{alert_id}" not locally available.') from None
+
+    def get_path(self, alert_id: int) -> Path:
+        """Return the file path of a downloaded alert
+
+        Args:
+            alert_id: Unique ZTF identifier for the alert packet
+
+        Returns:
+            A ``Path`` object
+        """
+
+        release = self.get_release(alert_id)
+        return Path(self._release_dir(release)) / f'{alert_id}{_ALERT_SUFFIX}'
+
+    def has_release(self, release: str) -> bool:
+        """Return whether a release has been downloaded"""
+
+        with self._lock:
+            self.refresh(force=False)
+            return release in self._release_alerts
+
+    def count(self, release: str = None) -> int:
+        """Return the number of downloaded alerts
+
+        Args:
+            release: Only count alerts from the given release (Optional)
+        """
+
+        with self._lock:
+            self.refresh(force=False)
+            if release is not None:
+                return len(self._release_alerts.get(release, ()))
+
+            return len(self._alert_releases)
+
+    def __contains__(self, alert_id: int) -> bool:
+        with self._lock:
+            self.refresh(force=False)
+            return alert_id in self._alert_releases
+
+    def __len__(self) -> int:
+        return self.count()
+
+
+_inventories: Dict[Path, LocalInventory] = {}
+
+
+def get_local_inventory(data_dir: Union[str, Path] = None) -> LocalInventory:
+    """Return the shared inventory of a local data directory
+
+    Args:
+        data_dir: The data directory (Default: the ZTF data directory)
+
+    Returns:
+        A ``LocalInventory`` object
+    """
+
+    data_dir = Path(get_ztf_data_dir() if data_dir is None else data_dir)
+    if data_dir not in _inventories:
+        _inventories[data_dir] = LocalInventory(data_dir)
+
+    return _inventories[data_dir]
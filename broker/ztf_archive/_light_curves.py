@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Maintains per-object light curves assembled from ZTF alerts.
+
+Every ZTF alert repeats up to 30 days of previous epochs for its object.
+The ``LightCurveStore`` merges the epochs of successive alerts into a
+single, deduplicated array per ``objectId`` so the photometric history of an
+object only has to be parsed once.
+"""
+
+from pathlib import Path
+from typing import Iterable, List, Union
+
+import numpy as np
+
+from ._parse_data import iter_alerts
+
+EPOCH_DTYPE = np.dtype([
+    ('jd', 'f8'),
+    ('fid', 'i2'),
+    ('candid', 'i8'),
+    ('magpsf', 'f4'),
+    ('sigmapsf', 'f4'),
+    ('magzpsci', 'f4'),
+    ('diffmaglim', 'f4'),
+])
+
+_MISSING = {'f': np.nan, 'i': -1}
+_LIGHT_CURVE_FIELDS = ('objectId', 'candidate', 'prv_candidates')
+
+
+def _epoch_row(epoch: dict) -> tuple:
+    """Return a single epoch of an alert as a tuple ordered as ``EPOCH_DTYPE``
+
+    Args:
+        epoch: A candidate or previous candidate from an alert
+
+    Returns:
+        A tuple of epoch values with missing values filled
+    """
+
+    row = []
+    for name in EPOCH_DTYPE.names:
+        value = epoch.get(name)
+        row.append(_MISSING[EPOCH_DTYPE[name].kind] if value is None else value)
+
+    return tuple(row)
+
+
+def get_alert_epochs(alert: dict) -> np.ndarray:
+    """Return all epochs of an alert as a structured numpy array
+
+    Args:
+        alert: A ZTF alert packet
+
+    Returns:
+        An array with dtype ``EPOCH_DTYPE`` and one element per epoch
+    """
+
+    epochs = (alert['prv_candidates'] or []) + [alert['candidate']]
+    return np.array([_epoch_row(e) for e in epochs], dtype=EPOCH_DTYPE)
+
+
+def merge_epochs(*epoch_arrays: np.ndarray) -> np.ndarray:
+    """Merge epoch arrays into a single array sorted by observation date
+
+    Epochs are deduplicated on ``jd`` and ``fid``. If an epoch is present
+    as both a detection and a non-detection, the detection is kept.
+
+    Args:
+        epoch_arrays: Arrays with dtype ``EPOCH_DTYPE``
+
+    Returns:
+        The merged array
+    """
+
+    epochs = np.concatenate(epoch_arrays)
+    order = np.lexsort((epochs['candid'] < 0, epochs['fid'], epochs['jd']))
+    epochs = epochs[order]
+
+    is_first = np.ones(len(epochs), dtype=bool)
+    is_first[1:] = (
+        (epochs['jd'][1:] != epochs['jd'][:-1])
+        | (epochs['fid'][1:] != epochs['fid'][:-1]))
+
+    return epochs[is_first]
+
+
+class LightCurveStore:
+    """Deduplicated light curves of ZTF objects keyed by ``objectId``"""
+
+    def __init__(self):
+        """Create an empty light curve store"""
+
+        self._light_curves = dict()
+
+    def __contains__(self, object_id: str) -> bool:
+        return object_id in self._light_curves
+
+    def __getitem__(self, object_id: str) -> np.ndarray:
+        return self._light_curves[object_id]
+
+    def __len__(self) -> int:
+        return len(self._light_curves)
+
+    def __repr__(self) -> str:
+        return f'<LightCurveStore(num_objects: {len(self)})>'
+
+    def object_ids(self) -> List[str]:
+        """Return the ids of all objects in the store"""
+
+        return list(self._light_curves)
+
+    def update(self, alert: dict) -> np.ndarray:
+        """Merge the epochs of an alert into the store
+
+        Args:
+            alert: A ZTF alert packet
+
+        Returns:
+            The updated light curve of the alert's object
+        """
+
+        object_id = alert['objectId']
+        new_epochs = get_alert_epochs(alert)
+        if object_id in self._light_curves:
+            new_epochs = merge_epochs(self._light_curves[object_id], new_epochs)
+
+        else:
+            new_epochs = merge_epochs(new_epochs)
+
+        self._light_curves[object_id] = new_epochs
+        return new_epochs
+
+    def update_many(self, alerts: Iterable[dict]) -> None:
+        """Merge the epochs of multiple alerts into the store
+
+        Args:
+            alerts: ZTF alert packets
+        """
+
+        for alert in alerts:
+            self.update(alert)
+
+    def get_epochs(self, object_id: str) -> List[dict]:
+        """Return the light curve of an object as a list of epoch dictionaries
+
+        The returned epochs use the same keys as ``prv_candidates`` in a ZTF
+        alert, with ``None`` for missing values.
+
+        Args:
+            object_id: The ZTF object id
+
+        Returns:
+            A list of dictionaries with one element per epoch
+        """
+
+        epochs = []
+        for row in self._light_curves[object_id].tolist():
+            epoch = dict(zip(EPOCH_DTYPE.names, row))
+            for name, value in epoch.items():
+                if value != value or (name == 'candid' and value < 0):
+                    epoch[name] = None  # Restore missing values
+
+            epochs.append(epoch)
+
+        return epochs
+
+    def save(self, path: Union[Path, str]) -> None:
+        """Save the store to a compressed numpy file
+
+        Light curves are stored back to back in a single array with an
+        array of offsets marking where each object's epochs begin.
+
+        Args:
+            path: Path of the output file
+        """
+
+        object_ids = self.object_ids()
+        lengths = [len(self._light_curves[oid]) for oid in object_ids]
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype('i8')
+        epochs = (
+            np.concatenate([self._light_curves[oid] for oid in object_ids])
+            if object_ids else np.empty(0, dtype=EPOCH_DTYPE))
+
+        np.savez_compressed(
+            path,
+            object_ids=np.array(object_ids, dtype=str),
+            offsets=offsets,
+            epochs=epochs)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> 'LightCurveStore':
+        """Load a store saved with ``LightCurveStore.save``
+
+        Args:
+            path: Path of the saved file
+
+        Returns:
+            A ``LightCurveStore`` object
+        """
+
+        store = cls()
+        with np.load(path) as data:
+            offsets, epochs = data['offsets'], data['epochs']
+            for i, object_id in enumerate(data['object_ids'].tolist()):
+                store._light_curves[object_id] = epochs[offsets[i]:offsets[i + 1]]
+
+        return store
+
+
+def build_light_curve_store(
+        store: LightCurveStore = None, **kwargs) -> LightCurveStore:
+    """Build or update a light curve store from locally downloaded alerts
+
+    Only the fields needed to build light curves are decoded.
+
+    Args:
+        store: An existing store to update (Default: Create a new store)
+        Any other arguments for ``iter_alerts`` except ``num_alerts``,
+        ``raw`` and ``fields`` (e.g., ``filters`` or ``num_workers``)
+
+    Returns:
+        The updated ``LightCurveStore``
+    """
+
+    store = LightCurveStore() if store is None else store
+    store.update_many(iter_alerts(fields=_LIGHT_CURVE_FIELDS, **kwargs))
+    return store
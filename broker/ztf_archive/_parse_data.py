@@ -7,28 +7,36 @@ tutorial: https://goo.gl/TsyEjx
 
 import gzip
 import io
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Sequence, Union
 
-import aplpy
 import fastavro
-import matplotlib.pyplot as plt
-from astropy.io import fits
-from matplotlib.pyplot import Figure
 
 from broker.ztf_archive._utils import get_ztf_data_dir
-from ._download_data import get_local_alerts
+from ._download_data import _get_local_alert_paths
+from ._inventory import get_local_inventory
+from ._schema import read_fields
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
 ZTF_DATA_DIR = get_ztf_data_dir()
 _AVRO_DATA = Union[dict, bytes]
 
 
-def _parse_alert_file(path: Union[Path, str], raw: bool = False) -> _AVRO_DATA:
+def _parse_alert_file(
+        path: Union[Path, str],
+        raw: bool = False,
+        fields: Sequence[str] = None) -> _AVRO_DATA:
     """Return the contents of an avro file published by ZTF
 
     Args:
         path: The file path to read
         raw: Optionally return the file data as bytes (Default: False)
+        fields: Only decode the given fields (e.g., ``candidate.ra``)
 
     Returns:
         The file contents as a dictionary or bytes
@@ -38,69 +46,211 @@ def _parse_alert_file(path: Union[Path, str], raw: bool = False) -> _AVRO_DATA:
         if raw:
             return f.read()
 
-        else:
+        elif fields is None:
             return next(fastavro.reader(f))
 
+        else:
+            return read_fields(f, fields)
+
 
-def get_alert_data(alert_id: int, raw: bool = False) -> _AVRO_DATA:
+def get_alert_data(
+        alert_id: int,
+        raw: bool = False,
+        fields: Sequence[str] = None) -> _AVRO_DATA:
     """Return the contents of an avro file published by ZTF
 
+    Fields not listed in ``fields`` are skipped without being decoded.
+    Nested fields are separated with a period, e.g.
+    ``fields=['objectId', 'candidate.ra', 'candidate.dec']``.
+
     Args:
         alert_id: Unique ZTF identifier for the alert packet
         raw: Optionally return the file data as bytes (Default: False)
+        fields: Only decode the given fields (Default: All fields)
 
     Returns:
         The file contents as a dictionary
     """
 
-    # Search for avro file in subdirectories
-    path = next(ZTF_DATA_DIR.glob(f'*/{alert_id}.avro'))
+    path = get_local_inventory(ZTF_DATA_DIR).get_path(alert_id)
     try:
-        return _parse_alert_file(path, raw)
+        return _parse_alert_file(path, raw, fields)
 
     except FileNotFoundError:
         raise ValueError(
             f'Data for "{alert_id}" not locally available (at {path}).')
 
 
-def iter_alerts(num_alerts: int = None, raw: bool = False) -> _AVRO_DATA:
+def _parse_alert_files(
+        paths: List[Path],
+        raw: bool = False,
+        fields: Sequence[str] = None) -> List[_AVRO_DATA]:
+    """Return the contents of multiple avro files published by ZTF
+
+    Args:
+        paths: The file paths to read
+        raw: Optionally return the file data as bytes (Default: False)
+        fields: Only decode the given fields (Default: All fields)
+
+    Returns:
+        A list with the contents of each file
+    """
+
+    return [_parse_alert_file(path, raw, fields) for path in paths]
+
+
+def _iter_chunks(iterable: Iterable, chunk_size: int) -> Iterator[list]:
+    """Split an iterable into lists of length ``chunk_size``
+
+    Args:
+        iterable: The iterable to split
+        chunk_size: Maximum length of each list
+
+    Yields:
+        Lists of elements from ``iterable``
+    """
+
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def _iter_parsed_alerts(
+        paths: Iterable[Path],
+        raw: bool = False,
+        num_workers: int = None,
+        ordered: bool = True,
+        chunk_size: int = 1,
+        max_prefetch: int = None,
+        fields: Sequence[str] = None) -> Iterator[_AVRO_DATA]:
+    """Iterate over the contents of avro files using a pool of processes
+
+    At most ``max_prefetch`` chunks of files are submitted to the pool at
+    any one time so that memory usage stays flat for large archives.
+
+    Args:
+        paths: The file paths to read
+        raw: Optionally return the file data as bytes (Default: False)
+        fields: Only decode the given fields (Default: All fields)
+        num_workers: Number of worker processes (Default: decode serially)
+        ordered: Yield alerts in the same order as ``paths`` (Default: True)
+        chunk_size: Number of files decoded per task (Default: 1)
+        max_prefetch: Maximum number of pending tasks (Default: 2 * num_workers)
+
+    Yields:
+        The contents of each file as a dictionary or bytes
+    """
+
+    if not num_workers or num_workers <= 1:
+        for path in paths:
+            yield _parse_alert_file(path, raw, fields)
+
+        return
+
+    if chunk_size < 1:
+        raise ValueError('chunk_size argument must be an int >= 1')
+
+    max_prefetch = max_prefetch or 2 * num_workers
+    chunks = _iter_chunks(paths, chunk_size)
+    with ProcessPoolExecutor(num_workers) as executor:
+        pending = deque(
+            executor.submit(_parse_alert_files, chunk, raw, fields)
+            for chunk in islice(chunks, max_prefetch)
+        )
+
+        try:
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+
+                # Keep the pool busy while results are consumed
+                for chunk in islice(chunks, 1):
+                    pending.append(
+                        executor.submit(_parse_alert_files, chunk, raw, fields))
+
+                yield from future.result()
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_alerts(
+        num_alerts: int = None,
+        raw: bool = False,
+        num_workers: int = None,
+        ordered: bool = True,
+        chunk_size: int = 1,
+        max_prefetch: int = None,
+        fields: Sequence[str] = None,
+        filters: dict = None) -> _AVRO_DATA:
     """Iterate over all locally available alert data
 
     If ``num_alerts`` is not specified, yield individual alerts. Otherwise,
     yield a list of alerts with length ``num_alerts``.
 
+    Alerts are decoded serially unless ``num_workers`` is greater than one,
+    in which case decoding is spread across a pool of processes. If
+    ``fields`` is given, only those fields are decoded (see
+    ``get_alert_data``).
+
+    Alerts can be selected using ``filters``, a dictionary of keyword
+    arguments for ``select_alerts`` (e.g., ``{'fid': 1, 'min_rb': 0.5}``).
+    Filters are evaluated against the local alert index so alerts that do
+    not pass are never read from disk.
+
     Args:
         num_alerts: Maximum number of alerts to yield at a time (optional)
         raw: Return file data as bytes
+        num_workers: Number of processes used to decode alerts (optional)
+        ordered: Preserve the order of alerts when decoding in parallel
+        chunk_size: Number of alerts decoded per task when decoding in parallel
+        max_prefetch: Maximum number of pending tasks (Default: 2 * num_workers)
+        fields: Only decode the given fields (Default: All fields)
+        filters: Only yield alerts passing the given filters (optional)
 
     Yields:
         A list of dictionaries or bytes representing ZTF alert data
     """
 
     err_msg = 'num_alerts argument must be an int >= 1'
-    if num_alerts and num_alerts <= 0:
+    if num_alerts is not None and num_alerts <= 0:
         raise ValueError(err_msg)
 
+    if filters:
+        from ._index import get_index_paths, select_alerts
+
+        paths = get_index_paths(select_alerts(**filters))
+
+    else:
+        paths = _get_local_alert_paths()
+
+    alerts = _iter_parsed_alerts(
+        paths,
+        raw=raw,
+        num_workers=num_workers,
+        ordered=ordered,
+        chunk_size=chunk_size,
+        max_prefetch=max_prefetch,
+        fields=fields)
+
     # Return individual alerts
     if num_alerts is None:
-        for alert_id in get_local_alerts():
-            yield get_alert_data(alert_id, raw)
-
+        yield from alerts
         return
 
     # Return alerts as list
-    alerts_list = []
-    for alert_id in get_local_alerts():
-        alerts_list.append(get_alert_data(alert_id, raw))
-        if len(alerts_list) >= num_alerts:
-            yield alerts_list
-            alerts_list = []
-
-    if alerts_list:
-        yield alerts_list
+    yield from _iter_chunks(alerts, num_alerts)
 
 
-def plot_cutout(packet: dict, fig: Figure = None, subplot: tuple = (1, 1, 1)) -> Figure:
+def plot_cutout(packet: dict, fig: 'Figure' = None, subplot: tuple = (1, 1, 1)) -> 'Figure':
     """Plot a single cutout image from an alert packet
 
     Args:
@@ -112,6 +262,10 @@ def plot_cutout(packet: dict, fig: Figure = None, subplot: tuple = (1, 1, 1)) ->
         A matplotlib figure
     """
 
+    import aplpy
+    import matplotlib.pyplot as plt
+    from astropy.io import fits
+
     stamp = packet['cutoutScience']['stampData']
     with gzip.open(io.BytesIO(stamp), 'rb') as f:
         with fits.open(io.BytesIO(f.read())) as hdul:
@@ -124,7 +278,7 @@ def plot_cutout(packet: dict, fig: Figure = None, subplot: tuple = (1, 1, 1)) ->
     return fig
 
 
-def plot_stamps(packet: dict) -> Figure:
+def plot_stamps(packet: dict) -> 'Figure':
     """Plot all three stamps contained in a ZTF alert packet
 
     Args:
@@ -134,6 +288,8 @@ def plot_stamps(packet: dict) -> Figure:
         A matplotlib figure
     """
 
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(12, 4))
     for i, cutout in enumerate(['Science', 'Template', 'Difference']):
         ffig = plot_cutout(packet, fig=fig, subplot=(1, 3, i + 1))
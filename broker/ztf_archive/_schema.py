@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Builds projected Avro reader schemas so that alerts can be decoded without
+materializing unwanted fields (e.g., image cutouts).
+"""
+
+import json
+from functools import lru_cache
+from typing import Iterable, Union
+
+import fastavro
+
+_PRIMITIVE_TYPES = {
+    'null', 'boolean', 'int', 'long', 'float', 'double', 'bytes', 'string'}
+_NAMED_TYPES = {'record', 'error', 'enum', 'fixed'}
+
+# Schema of the metadata map stored in an Avro file header
+_HEADER_META_SCHEMA = {'type': 'map', 'values': 'bytes'}
+
+# Unselected fields with at most this many values are skipped in Python
+_MAX_SKIP_LEAVES = 8
+
+
+def _full_name(name: str, namespace: str = None) -> str:
+    """Return the full name of an Avro named type
+
+    Args:
+        name: The name of the type
+        namespace: The enclosing namespace
+
+    Returns:
+        The namespace qualified name
+    """
+
+    if '.' in name or not namespace:
+        return name
+
+    return f'{namespace}.{name}'
+
+
+def parse_fields(fields: Iterable[str]) -> dict:
+    """Convert a list of field names into a nested selection
+
+    Nested fields are separated with a period (e.g., ``candidate.ra``).
+    Fields selected in full map to ``None``.
+
+    Args:
+        fields: Names of the fields to select
+
+    Returns:
+        A dictionary mapping field names to their selected sub-fields
+    """
+
+    selection = {}
+    for field in fields:
+        *parents, name = field.split('.')
+        node = selection
+        for parent in parents:
+            if parent in node and node[parent] is None:
+                break  # The parent is already selected in full
+
+            node = node.setdefault(parent, {})
+
+        else:
+            node[name] = None
+
+    return selection
+
+
+def _collect_named_types(schema, namespace: str, named: dict) -> None:
+    """Collect the definitions of all named types in a schema
+
+    Args:
+        schema: An Avro schema or sub-schema
+        namespace: The enclosing namespace
+        named: Dictionary to populate with ``{full name: (definition, namespace)}``
+    """
+
+    if isinstance(schema, list):
+        for branch in schema:
+            _collect_named_types(branch, namespace, named)
+
+    elif isinstance(schema, dict):
+        schema_type = schema['type']
+        if schema_type in _NAMED_TYPES:
+            name = _full_name(schema['name'], schema.get('namespace', namespace))
+            named[name] = (schema, namespace)
+            for field in schema.get('fields', []):
+                _collect_named_types(field['type'], name.rpartition('.')[0], named)
+
+        elif schema_type == 'array':
+            _collect_named_types(schema['items'], namespace, named)
+
+        elif schema_type == 'map':
+            _collect_named_types(schema['values'], namespace, named)
+
+        else:
+            _collect_named_types(schema_type, namespace, named)
+
+
+def _project(schema, selection, namespace: str, named: dict, emitted: dict):
+    """Recursively project a schema onto a selection of fields
+
+    Named types are always written using their full name so that the
+    projected schema does not depend on namespace inheritance.
+
+    Args:
+        schema: An Avro schema or sub-schema
+        selection: Selected sub-fields as returned by ``parse_fields``
+        namespace: The enclosing namespace
+        named: Named type definitions from ``_collect_named_types``
+        emitted: Selections of named types already written to the output
+
+    Returns:
+        The projected schema
+    """
+
+    if isinstance(schema, list):
+        return [_project(b, selection, namespace, named, emitted) for b in schema]
+
+    if isinstance(schema, str):
+        if schema in _PRIMITIVE_TYPES:
+            return schema
+
+        name = _full_name(schema, namespace)
+        if name not in emitted:
+            definition, def_namespace = named[name]
+            return _project(definition, selection, def_namespace, named, emitted)
+
+        schema = {'type': 'record', 'name': name}  # Checked below
+
+    schema_type = schema['type']
+    if schema_type in _NAMED_TYPES:
+        name = _full_name(schema['name'], schema.get('namespace', namespace))
+        if name in emitted:
+            if emitted[name] != selection:
+                raise ValueError(
+                    f'Conflicting field selections for Avro type {name}')
+
+            return name
+
+        emitted[name] = selection
+        if schema_type not in ('record', 'error'):
+            out_schema = {k: v for k, v in schema.items() if k != 'namespace'}
+            out_schema['name'] = name
+            return out_schema
+
+        fields = schema['fields']
+        if selection is not None:
+            field_names = {f['name'] for f in fields}
+            unknown = set(selection) - field_names
+            if unknown:
+                raise ValueError(
+                    f'Fields {sorted(unknown)} not found in Avro type {name}')
+
+            fields = [f for f in fields if f['name'] in selection]
+
+        out_fields = []
+        for field in fields:
+            out_field = {
+                'name': field['name'],
+                'type': _project(
+                    field['type'],
+                    None if selection is None else selection[field['name']],
+                    name.rpartition('.')[0],
+                    named,
+                    emitted)
+            }
+
+            if 'default' in field:
+                out_field['default'] = field['default']
+
+            out_fields.append(out_field)
+
+        return {'type': schema_type, 'name': name, 'fields': out_fields}
+
+    if schema_type == 'array':
+        items = _project(schema['items'], selection, namespace, named, emitted)
+        return {'type': 'array', 'items': items}
+
+    if schema_type == 'map':
+        values = _project(schema['values'], selection, namespace, named, emitted)
+        return {'type': 'map', 'values': values}
+
+    if isinstance(schema_type, (dict, list)) or schema_type not in _PRIMITIVE_TYPES:
+        return _project(schema_type, selection, namespace, named, emitted)
+
+    return schema
+
+
+def project_schema(schema: Union[dict, str], fields: Iterable[str]) -> dict:
+    """Return a reader schema containing only a subset of fields
+
+    Decoding an alert with the returned schema skips all other fields at
+    the binary level. Nested fields are separated with a period (e.g.,
+    ``candidate.ra``).
+
+    Args:
+        schema: The writer schema as a dictionary or JSON string
+        fields: Names of the fields to keep
+
+    Returns:
+        The projected schema as a dictionary
+    """
+
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+
+    named = dict()
+    _collect_named_types(schema, None, named)
+    return _project(schema, parse_fields(fields), None, named, dict())
+
+
+def _expand(schema, namespace: str, named: dict):
+    """Return a copy of a schema with all named type references inlined
+
+    Args:
+        schema: An Avro schema or sub-schema
+        namespace: The enclosing namespace
+        named: Named type definitions from ``_collect_named_types``
+
+    Returns:
+        The expanded schema
+    """
+
+    if isinstance(schema, list):
+        return [_expand(branch, namespace, named) for branch in schema]
+
+    if isinstance(schema, str):
+        if schema in _PRIMITIVE_TYPES:
+            return schema
+
+        definition, def_namespace = named[_full_name(schema, namespace)]
+        return _expand(definition, def_namespace, named)
+
+    schema_type = schema['type']
+    if schema_type in ('record', 'error'):
+        name = _full_name(schema['name'], schema.get('namespace', namespace))
+        fields = [
+            {'name': f['name'],
+             'type': _expand(f['type'], name.rpartition('.')[0], named)}
+            for f in schema['fields']
+        ]
+        return {'type': 'record', 'name': name, 'fields': fields}
+
+    if schema_type == 'array':
+        return {'type': 'array', 'items': _expand(schema['items'], namespace, named)}
+
+    if schema_type == 'map':
+        return {'type': 'map', 'values': _expand(schema['values'], namespace, named)}
+
+    if isinstance(schema_type, (dict, list)) or schema_type not in _PRIMITIVE_TYPES | _NAMED_TYPES:
+        return _expand(schema_type, namespace, named)
+
+    return schema
+
+
+def _count_leaves(schema) -> float:
+    """Return the number of values that must be read to skip a datum
+
+    Arrays and maps have an unknown length and are counted as infinite.
+
+    Args:
+        schema: An expanded Avro schema
+
+    Returns:
+        The number of leaf values in the schema
+    """
+
+    if isinstance(schema, list):
+        return 1 + max(_count_leaves(branch) for branch in schema)
+
+    if isinstance(schema, dict):
+        if schema['type'] in ('array', 'map'):
+            return float('inf')
+
+        if schema['type'] in ('record', 'error'):
+            return sum(_count_leaves(f['type']) for f in schema['fields'])
+
+    return 1
+
+
+def _read_long(file_obj) -> int:
+    """Read a zig-zag encoded variable length integer
+
+    Args:
+        file_obj: A binary file object
+
+    Returns:
+        The decoded integer
+    """
+
+    byte = ord(file_obj.read(1))
+    value = byte & 0x7F
+    shift = 7
+    while byte & 0x80:
+        byte = ord(file_obj.read(1))
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+    return (value >> 1) ^ -(value & 1)
+
+
+def _skip(file_obj, schema) -> None:
+    """Advance a file object past a single datum without decoding it
+
+    Args:
+        file_obj: A binary file object
+        schema: The expanded schema of the datum to skip
+    """
+
+    if isinstance(schema, list):
+        _skip(file_obj, schema[_read_long(file_obj)])
+        return
+
+    schema_type = schema['type'] if isinstance(schema, dict) else schema
+    if schema_type == 'null':
+        return
+
+    elif schema_type == 'boolean':
+        file_obj.seek(1, 1)
+
+    elif schema_type in ('int', 'long', 'enum'):
+        _read_long(file_obj)
+
+    elif schema_type == 'float':
+        file_obj.seek(4, 1)
+
+    elif schema_type == 'double':
+        file_obj.seek(8, 1)
+
+    elif schema_type in ('bytes', 'string'):
+        file_obj.seek(_read_long(file_obj), 1)
+
+    elif schema_type == 'fixed':
+        file_obj.seek(schema['size'], 1)
+
+    elif schema_type in ('record', 'error'):
+        for field in schema['fields']:
+            _skip(file_obj, field['type'])
+
+    elif schema_type in ('array', 'map'):
+        count = _read_long(file_obj)
+        while count:
+            if count < 0:  # Block size is given so the block can be skipped
+                file_obj.seek(_read_long(file_obj), 1)
+
+            else:
+                for _ in range(count):
+                    if schema_type == 'map':
+                        _skip(file_obj, 'string')
+
+                    _skip(file_obj, schema.get('items', schema.get('values')))
+
+            count = _read_long(file_obj)
+
+    else:
+        _skip(file_obj, schema_type)
+
+
+@lru_cache(maxsize=32)
+def get_field_plan(writer_schema: str, fields: tuple) -> list:
+    """Return instructions for decoding a subset of fields from an alert
+
+    Plans are cached so each schema version is only processed once. Each
+    top level field is either decoded in full, decoded using a projected
+    reader schema, or skipped. Small fields (e.g., image cutouts) are
+    skipped in Python by seeking past them. Large fields are skipped by
+    ``fastavro`` using a reader schema that selects no sub-fields.
+
+    Args:
+        writer_schema: The writer schema as a JSON string
+        fields: Names of the fields to keep
+
+    Returns:
+        A list of tuples ``(name, selected, writer, reader, skip_schema)``
+    """
+
+    schema = json.loads(writer_schema)
+    named = dict()
+    _collect_named_types(schema, None, named)
+    selection = parse_fields(fields)
+
+    field_names = {f['name'] for f in schema['fields']}
+    unknown = set(selection) - field_names
+    if unknown:
+        raise ValueError(f'Fields {sorted(unknown)} not found in alert schema')
+
+    record_name = _full_name(schema['name'], schema.get('namespace'))
+    namespace = record_name.rpartition('.')[0]
+
+    plan = []
+    for field in schema['fields']:
+        name = field['name']
+        selected = name in selection
+        if not selected:
+            expanded = _expand(field['type'], namespace, named)
+            if _count_leaves(expanded) <= _MAX_SKIP_LEAVES:
+                plan.append((name, False, None, None, expanded))
+                continue
+
+        writer = _project(field['type'], None, namespace, named, dict())
+        if selected and selection[name] is None:
+            reader = None
+
+        else:
+            sub_selection = selection.get(name, dict())
+            reader = _project(field['type'], sub_selection, namespace, named, dict())
+            reader = fastavro.parse_schema(reader)
+
+        plan.append((name, selected, fastavro.parse_schema(writer), reader, None))
+
+    return plan
+
+
+def read_header(file_obj) -> dict:
+    """Return the metadata from the header of an Avro file
+
+    The file position is left at the start of the first data block.
+
+    Args:
+        file_obj: An Avro file opened in binary mode
+
+    Returns:
+        The header metadata with values decoded as strings
+    """
+
+    file_obj.seek(4)  # Skip the magic bytes
+    metadata = fastavro.schemaless_reader(file_obj, _HEADER_META_SCHEMA)
+    file_obj.seek(16, 1)  # Skip the sync marker
+    return {k: v.decode() for k, v in metadata.items()}
+
+
+def read_fields(file_obj, fields: Iterable[str]) -> dict:
+    """Decode a subset of fields from the first record of an Avro file
+
+    Args:
+        file_obj: An Avro file opened in binary mode
+        fields: Names of the fields to decode (e.g., ``candidate.ra``)
+
+    Returns:
+        The decoded record as a dictionary
+    """
+
+    metadata = read_header(file_obj)
+    writer_schema = metadata['avro.schema']
+    fields = tuple(fields)
+
+    if metadata.get('avro.codec', 'null') != 'null':
+        file_obj.seek(0)
+        reader_schema = project_schema(writer_schema, fields)
+        return next(fastavro.reader(file_obj, reader_schema=reader_schema))
+
+    plan = get_field_plan(writer_schema, fields)
+    _read_long(file_obj)  # Number of records in the block
+    _read_long(file_obj)  # Size of the block in bytes
+
+    record = dict()
+    for name, selected, writer, reader, skip_schema in plan:
+        if skip_schema is not None:
+            _skip(file_obj, skip_schema)
+            continue
+
+        value = fastavro.schemaless_reader(file_obj, writer, reader)
+        if selected:
+            record[name] = value
+
+    return record
+
+
+def get_field_schema(writer_schema: Union[dict, str], field_name: str):
+    """Return the expanded schema of a top level field
+
+    All named type references in the returned schema are inlined.
+
+    Args:
+        writer_schema: The writer schema as a dictionary or JSON string
+        field_name: Name of the top level field
+
+    Returns:
+        The expanded schema of the field
+    """
+
+    if isinstance(writer_schema, str):
+        writer_schema = json.loads(writer_schema)
+
+    named = dict()
+    _collect_named_types(writer_schema, None, named)
+    record_name = _full_name(
+        writer_schema['name'], writer_schema.get('namespace'))
+
+    for field in writer_schema['fields']:
+        if field['name'] == field_name:
+            return _expand(field['type'], record_name.rpartition('.')[0], named)
+
+    raise ValueError(f'Field {field_name} not found in alert schema')
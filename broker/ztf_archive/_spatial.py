@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Spatial queries over locally downloaded ZTF alerts using a kd-tree built
+on the unit vectors of alert positions.
+"""
+
+import pickle
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from broker.ztf_archive._utils import get_ztf_cache_dir
+from ._index import (_index_mtime, _local_releases, chord_length,
+                     get_alert_index, get_index_paths, radec_to_xyz)
+from ._parse_data import _parse_alert_file
+
+SPATIAL_INDEX_PATH = get_ztf_cache_dir() / 'spatial_index.pkl'
+_spatial_index_memo = {}
+
+
+class AlertSpatialIndex:
+    """A kd-tree over the positions of locally downloaded alerts"""
+
+    def __init__(self, index: np.ndarray):
+        """Build a spatial index from an alert index
+
+        Args:
+            index: An alert index as returned by ``get_alert_index``
+        """
+
+        from scipy.spatial import cKDTree
+
+        is_valid = np.isfinite(index['ra']) & np.isfinite(index['dec'])
+        self.index = index[is_valid]
+        self.tree = cKDTree(
+            radec_to_xyz(self.index['ra'], self.index['dec']).reshape(-1, 3))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def cone_search(self, ra: float, dec: float, radius: float) -> np.ndarray:
+        """Return index entries for alerts within a cone
+
+        Args:
+            ra: Right Ascension of the cone center in degrees
+            dec: Declination of the cone center in degrees
+            radius: Radius of the cone in degrees
+
+        Returns:
+            The matching index entries as a structured numpy array
+        """
+
+        center = radec_to_xyz(ra, dec)[0]
+        rows = self.tree.query_ball_point(center, chord_length(radius))
+        return self.index[np.sort(np.asarray(rows, dtype=int))]
+
+    def polygon_search(self, vertices: Sequence[Tuple[float, float]]) -> np.ndarray:
+        """Return index entries for alerts within a convex spherical polygon
+
+        Vertices may be given in clockwise or counter-clockwise order.
+
+        Args:
+            vertices: ``(ra, dec)`` pairs in degrees defining the polygon
+
+        Returns:
+            The matching index entries as a structured numpy array
+        """
+
+        vertices = np.asarray(vertices, dtype=float)
+        if len(vertices) < 3:
+            raise ValueError('A polygon requires at least three vertices')
+
+        corners = radec_to_xyz(vertices[:, 0], vertices[:, 1])
+        center = corners.sum(axis=0)
+        center /= np.linalg.norm(center)
+
+        # Pre-select alerts in the smallest cone centered on the polygon
+        max_chord = np.linalg.norm(corners - center, axis=1).max()
+        rows = np.sort(np.asarray(
+            self.tree.query_ball_point(center, max_chord), dtype=int))
+        if not len(rows):
+            return self.index[rows]
+
+        # Keep points on the inner side of every edge
+        normals = np.cross(corners, np.roll(corners, -1, axis=0))
+        normals *= np.sign(normals @ center)[:, None]
+        is_inside = np.all(self.tree.data[rows] @ normals.T >= 0, axis=1)
+        return self.index[rows[is_inside]]
+
+
+def _index_signature() -> Optional[tuple]:
+    """Return a value that changes whenever the local alert index changes
+
+    Only file metadata is read, so the alert index itself is not loaded.
+
+    Returns:
+        A tuple of release dates and index modification times, or None if
+        the index of a downloaded release is missing or out of date
+    """
+
+    signature = []
+    for release in _local_releases():
+        mtime = _index_mtime(release)
+        if mtime is None:
+            return None
+
+        signature.append((release, mtime))
+
+    return tuple(signature)
+
+
+def get_spatial_index(rebuild: bool = False) -> AlertSpatialIndex:
+    """Return a spatial index of all locally downloaded alerts
+
+    The spatial index is saved next to the local alert index and rebuilt
+    whenever the set of downloaded alerts changes. Whether it is up to date
+    is checked from file modification times, so the alert index is only
+    loaded when the spatial index is rebuilt.
+
+    Args:
+        rebuild: Rebuild the spatial index even if it is up to date
+
+    Returns:
+        An ``AlertSpatialIndex`` object
+    """
+
+    signature = None if rebuild else _index_signature()
+    if signature is not None and signature in _spatial_index_memo:
+        return _spatial_index_memo[signature]
+
+    spatial_index = None
+    if signature is not None and SPATIAL_INDEX_PATH.exists():
+        with SPATIAL_INDEX_PATH.open('rb') as f:
+            saved_signature, saved_index = pickle.load(f)
+
+        if saved_signature == signature:
+            spatial_index = saved_index
+
+    if spatial_index is None:
+        index = get_alert_index()  # Updates the alert index if necessary
+        signature = _index_signature()
+        spatial_index = AlertSpatialIndex(index)
+        SPATIAL_INDEX_PATH.parent.mkdir(exist_ok=True, parents=True)
+        with SPATIAL_INDEX_PATH.open('wb') as f:
+            pickle.dump((signature, spatial_index), f)
+
+    _spatial_index_memo.clear()
+    _spatial_index_memo[signature] = spatial_index
+    return spatial_index
+
+
+def _format_results(
+        entries: np.ndarray,
+        decode: bool,
+        fields: Sequence[str]) -> Union[np.ndarray, List[dict]]:
+    """Return alert ids or decoded alerts for a set of index entries
+
+    Args:
+        entries: Index entries of the matching alerts
+        decode: Return the decoded alerts instead of their ids
+        fields: Only decode the given fields (Default: All fields)
+
+    Returns:
+        An array of alert ids or a list of alert dictionaries
+    """
+
+    if not decode:
+        return entries['alert_id']
+
+    return [_parse_alert_file(path, fields=fields) for path in get_index_paths(entries)]
+
+
+def cone_search(
+        ra: float,
+        dec: float,
+        radius: float,
+        decode: bool = False,
+        fields: Sequence[str] = None) -> Union[np.ndarray, List[dict]]:
+    """Find locally downloaded alerts within a cone
+
+    Args:
+        ra: Right Ascension of the cone center in degrees
+        dec: Declination of the cone center in degrees
+        radius: Radius of the cone in degrees (e.g., ``5 / 3600`` for 5")
+        decode: Return the decoded alerts instead of their ids (Default: False)
+        fields: Only decode the given fields (Default: All fields)
+
+    Returns:
+        An array of alert ids or a list of alert dictionaries
+    """
+
+    entries = get_spatial_index().cone_search(ra, dec, radius)
+    return _format_results(entries, decode, fields)
+
+
+def polygon_search(
+        vertices: Sequence[Tuple[float, float]],
+        decode: bool = False,
+        fields: Sequence[str] = None) -> Union[np.ndarray, List[dict]]:
+    """Find locally downloaded alerts within a convex spherical polygon
+
+    Args:
+        vertices: ``(ra, dec)`` pairs in degrees defining the polygon
+        decode: Return the decoded alerts instead of their ids (Default: False)
+        fields: Only decode the given fields (Default: All fields)
+
+    Returns:
+        An array of alert ids or a list of alert dictionaries
+    """
+
+    entries = get_spatial_index().polygon_search(vertices)
+    return _format_results(entries, decode, fields)
@@ -21,3 +21,20 @@ def get_ztf_data_dir() -> Path:
 
     else:
         return Path(__file__).resolve().parent / 'ztf_archive/data'
+
+
+def get_ztf_cache_dir() -> Path:
+    """Return the directory path where metadata for local ZTF alerts is cached
+
+    The cache directory is kept separate from ``get_ztf_data_dir`` so that
+    cached files are never mistaken for downloaded releases.
+
+    Returns:
+        A ``Path`` object
+    """
+
+    if 'PGB_DATA_DIR' in os.environ:
+        return Path(os.environ['PGB_DATA_DIR']) / 'ztf_archive_cache'
+
+    else:
+        return Path(__file__).resolve().parent / 'ztf_archive/cache'
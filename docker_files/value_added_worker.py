@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Script to compute value added products for alerts published to Pub/Sub"""
+
+import os
+
+from broker.value_added.worker import ValueAddedWorker
+
+# Create a worker listening to the alert data topic
+worker = ValueAddedWorker(
+    subscription=os.getenv('pgb_value_added_subscription',
+                           'ztf_alert_data_value_added'),
+    data_set='ztf_alerts',
+    batch_size=int(os.getenv('pgb_value_added_batch_size', 100)),
+)
+
+if __name__ == '__main__':
+    worker.run()  # Process alerts in batches indefinitely
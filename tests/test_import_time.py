@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""This file tests that importing ``broker`` does not load heavy dependencies
+and stays fast enough for short-lived cloud functions.
+"""
+
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import warnings
+from pathlib import Path
+from unittest import TestCase, mock
+
+# Modules that should only be loaded when the code using them is called
+HEAVY_MODULES = (
+    'aplpy',
+    'astropy',
+    'astroquery',
+    'astrorapid',
+    'google.cloud.logging',
+    'matplotlib',
+    'numpy',
+    'pandas',
+    'requests',
+    'sklearn',
+    'tqdm',
+)
+
+# Generous upper bound on the import time of the package in seconds
+MAX_IMPORT_TIME = 1.5
+
+_IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import broker, broker.ztf_archive, broker.value_added
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+'''
+
+
+def run_import():
+    """Import the package in a fresh interpreter
+
+    Returns:
+        The import time in seconds and a list of loaded modules
+    """
+
+    env = os.environ.copy()
+    env['PGB_OFFLINE'] = 'True'
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(Path(__file__).resolve().parent.parent), env.get('PYTHONPATH', '')])
+
+    out = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', _IMPORT_SCRIPT],
+        env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+    results = json.loads(out.stdout.strip().splitlines()[-1])
+    return results['elapsed'], results['modules']
+
+
+class ImportTime(TestCase):
+    """Tests for the import time of the ``broker`` package"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.elapsed, cls.modules = run_import()
+
+    def test_heavy_modules_not_loaded(self):
+        """Test importing the package does not load heavy dependencies"""
+
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, self.modules)
+
+    def test_import_time(self):
+        """Test the package imports within ``MAX_IMPORT_TIME`` seconds"""
+
+        self.assertLess(self.elapsed, MAX_IMPORT_TIME)
+
+    def test_lazy_access(self):
+        """Test public objects are still accessible from the package"""
+
+        from broker import value_added, ztf_archive
+
+        self.assertTrue(callable(ztf_archive.iter_alerts))
+        self.assertTrue(callable(ztf_archive.get_local_releases))
+        self.assertIn('iter_alerts', dir(ztf_archive))
+        self.assertIn('get_xmatches', value_added.__all__)
+
+
+class CloudLoggingFallback(TestCase):
+    """Tests for the lazily created cloud logging handler"""
+
+    def test_client_failure_falls_back_once(self):
+        """Test a failed client is only created once and records go to stderr"""
+
+        from broker import _CloudLoggingHandler
+
+        handler = _CloudLoggingHandler()
+        record = logging.makeLogRecord({'msg': 'test message'})
+        stderr = io.StringIO()
+        with mock.patch.dict(sys.modules, {'google.cloud': None}), \
+                mock.patch('sys.stderr', stderr), \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            handler.handle(record)
+            fallback = handler._handler
+            handler.handle(record)
+
+        self.assertIsInstance(fallback, logging.StreamHandler)
+        self.assertIs(handler._handler, fallback)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(stderr.getvalue().count('test message'), 2)
+        self.assertNotIn('Traceback', stderr.getvalue())
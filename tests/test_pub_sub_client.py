@@ -1,6 +1,7 @@
 """This file provides tests for the ``broker.pub_sub_client`` module."""
 
 import os
+import time
 from pathlib import Path
 import unittest
 from deepdiff import DeepDiff
@@ -54,3 +55,98 @@ class TestPubSub(unittest.TestCase):
         #         _pickle.UnpicklingError: invalid load key, 'O'.
 
         self.assertEqual(DeepDiff(sample_alert_data[0], message[0]), {})
+
+
+class LocalPubSub(unittest.TestCase):
+    """Test the in-process Pub/Sub stand-in in ``local_pubsub``"""
+
+    def setUp(self):
+        self.pubsub = psc.local_pubsub.LocalPubSub()
+        self.publisher = psc.local_pubsub.PublisherClient(self.pubsub)
+        self.subscriber = psc.local_pubsub.SubscriberClient(self.pubsub)
+        self.topic = self.publisher.topic_path('project', topic_name)
+        self.subscription = self.subscriber.subscription_path(
+            'project', subscription_name)
+
+        self.publisher.create_topic(self.topic)
+        self.subscriber.create_subscription(
+            self.subscription, self.topic, ack_deadline_seconds=1)
+
+    def test_publish_returns_message_id(self):
+        """Test that publishing resolves to a string message id"""
+
+        future = self.publisher.publish(self.topic, b'data')
+        self.assertIs(type(future.result()), str)
+
+    def test_input_match_output(self):
+        """Test that published data and attributes are delivered unchanged"""
+
+        with open(test_alert_path, 'rb') as f:
+            sample_alert_data = f.read()
+
+        self.publisher.publish(self.topic, sample_alert_data, survey='ztf')
+
+        received = []
+        future = self.subscriber.subscribe(
+            self.subscription, callback=lambda m: (received.append(m), m.ack()))
+
+        for _ in range(50):
+            if received:
+                break
+
+            time.sleep(0.1)
+
+        future.cancel()
+        future.result()
+
+        self.assertEqual(sample_alert_data, received[0].data)
+        self.assertEqual({'survey': 'ztf'}, received[0].attributes)
+        self.assertEqual(1, self.pubsub.get_stats(self.subscription)['acked'])
+
+    def test_nack_redelivers(self):
+        """Test that a nacked message is delivered again"""
+
+        self.publisher.publish(self.topic, b'data')
+        (ack_id, record), = self.pubsub.pull(self.subscription, 10)
+        self.pubsub.modify_ack_deadline(self.subscription, [ack_id], 0)
+
+        (_, redelivered), = self.pubsub.pull(self.subscription, 10)
+        self.assertEqual(record.message_id, redelivered.message_id)
+        self.assertEqual(2, redelivered.delivery_attempt)
+
+    def test_expired_lease_redelivers(self):
+        """Test that a message not acked within its deadline is redelivered"""
+
+        self.publisher.publish(self.topic, b'data')
+        (ack_id, _), = self.pubsub.pull(self.subscription, 10)
+        self.assertEqual([], self.pubsub.pull(self.subscription, 10, timeout=0))
+
+        leased = self.pubsub.pull(self.subscription, 10, timeout=3)
+        self.assertEqual(1, len(leased))
+
+        # Acks of the expired lease are ignored
+        self.pubsub.acknowledge(self.subscription, [ack_id])
+        self.assertEqual(0, self.pubsub.get_stats(self.subscription)['acked'])
+
+    def test_flow_control(self):
+        """Test that no more than ``max_messages`` unacked messages are held"""
+
+        for i in range(10):
+            self.publisher.publish(self.topic, str(i).encode())
+
+        received = []
+        flow_control = psc.local_pubsub.FlowControl(max_messages=3)
+        future = self.subscriber.subscribe(
+            self.subscription, callback=received.append,
+            flow_control=flow_control)
+
+        time.sleep(0.5)
+        self.assertEqual(3, len(received))
+
+        for message in received[:2]:
+            message.ack()
+
+        time.sleep(0.5)
+        future.cancel()
+        future.result()
+        self.assertEqual(5, len(received))
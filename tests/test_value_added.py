@@ -0,0 +1,1489 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""This file provides tests for the ``broker.value_added`` module.
+
+The photo-z model and the RAPID classifier are replaced by fakes and no test
+requires network access.
+"""
+
+import threading
+import time
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+import fastavro
+import numpy as np
+
+from broker.value_added import classify
+from broker.value_added.catalog import LocalCatalog
+from broker.value_added import dust
+from broker.value_added import plotting
+from broker.value_added import redshift as red
+from broker.value_added import stream
+from broker.value_added import value_added as va
+from broker.value_added import xmatch as xm
+from broker.value_added.classifier_service import RapidClassifierService
+from broker.value_added.result_store import PRODUCTS, ResultStore
+from broker.value_added.worker import ValueAddedWorker, check_dependencies
+
+TEST_ALERTS_DIR = Path(__file__).resolve().parent / 'test_alerts'
+
+
+def load_test_alerts():
+    """Return the alerts in ``TEST_ALERTS_DIR`` as a list of dicts"""
+
+    alerts = []
+    for path in sorted(TEST_ALERTS_DIR.glob('*.avro')):
+        with open(path, 'rb') as infile:
+            alerts.extend(fastavro.reader(infile))
+
+    return alerts
+
+
+def write_dust_maps(map_dir, size=64):
+    """Write small synthetic SFD maps whose values are 0.01 * column index
+
+    Returns:
+        The map value at the galactic poles
+    """
+
+    from astropy.io import fits
+
+    data = np.tile(np.arange(size, dtype=np.float32) * .01, (size, 1))
+    for n, file_name in dust.SFD_FILES.items():
+        header = fits.Header()
+        header['LAM_SCAL'] = size / 2 - 1
+        header['CRPIX1'] = size / 2 + .5
+        header['CRPIX2'] = size / 2 + .5
+        header['LAM_NSGP'] = n
+        fits.PrimaryHDU(data, header).writeto(Path(map_dir) / file_name)
+
+    return (size / 2 - .5) * .01
+
+
+class FakePhotozModel:
+    """Stands in for the random forest photo-z model"""
+
+    def __init__(self):
+        self.num_calls = 0
+        self.num_rows = 0
+
+    def predict(self, features):
+        self.num_calls += 1
+        self.num_rows += len(features)
+        return features[:, 4] / 100  # r magnitude / 100
+
+
+class FakeClassifier:
+    """Stands in for astrorapid's ``Classify``
+
+    Predicts two classes with a probability of the first class equal to the
+    light curve's redshift at every epoch.
+    """
+
+    class_names = ('Pre-explosion', 'SNIa')
+
+    def __init__(self):
+        self.batches = []  # objids of each get_predictions() call
+        self.threads = set()
+
+    def get_predictions(self, light_curves, return_predictions_at_obstime=False,
+                        return_objids=False):
+        self.batches.append([lc[7] for lc in light_curves])
+        self.threads.add(threading.current_thread().name)
+        preds = [np.tile([lc[8], 1 - lc[8]], (len(lc[0]), 1))
+                 for lc in light_curves]
+        times = [np.asarray(lc[0]) for lc in light_curves]
+        return preds, times, [lc[7] for lc in light_curves]
+
+
+def make_light_curve(cxid, num_epochs=5, redshift=.1):
+    """Return a light curve formatted for input to RAPID"""
+
+    mjd = 58000. + np.arange(num_epochs)
+    return (mjd, np.ones(num_epochs), np.full(num_epochs, .1),
+            np.array(['g', 'r'] * num_epochs)[:num_epochs],
+            np.full(num_epochs, 4096), 10., 20., cxid, redshift, .02)
+
+
+def start_fake_service(test_case, **kwargs):
+    """Start a classifier service using a ``FakeClassifier``
+
+    Returns:
+        The service and its classifier
+    """
+
+    classifier = FakeClassifier()
+    service = RapidClassifierService(classifier_factory=lambda: classifier,
+                                     **kwargs)
+    service.start()
+    test_case.addCleanup(service.stop)
+    return service, classifier
+
+
+def patch_photoz_model(test_case):
+    """Replace the photo-z model for the duration of a test
+
+    Returns:
+        The ``FakePhotozModel`` in use
+    """
+
+    model = FakePhotozModel()
+    patcher = mock.patch.object(red, 'load_rongpuRF', return_value=model)
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+    return model
+
+
+class PhotozBatching(TestCase):
+    """Tests for batched photo-z estimation"""
+
+    def setUp(self):
+        self.model = patch_photoz_model(self)
+
+    def test_single_model_call(self):
+        """Test a batch of objects is passed to the model once"""
+
+        rmag = np.array([18., 19., 20., 21.])
+        z_phot = red.calcz_rongpuRF_batch(rmag + 1, rmag, rmag - 1, rmag - 2)
+
+        self.assertEqual(self.model.num_calls, 1)
+        np.testing.assert_allclose(z_phot, rmag / 100)
+
+    def test_missing_inputs(self):
+        """Test objects with missing magnitudes get a redshift of -1"""
+
+        gmag = np.array([19., np.nan, 20.])
+        z_phot = red.calcz_rongpuRF_batch(gmag, 18., 17., 16.)
+
+        self.assertEqual(self.model.num_rows, 2)
+        np.testing.assert_allclose(z_phot, [.18, -1, .18])
+
+    def test_non_finite_predictions(self):
+        """Test non-finite model outputs are replaced by -1"""
+
+        self.model.predict = lambda features: np.full(len(features), np.nan)
+        z_phot = red.calcz_rongpuRF_batch([19., 20.], 18., 17., 16.)
+        np.testing.assert_array_equal(z_phot, [-1, -1])
+
+    def test_placeholder_ids_not_cached(self):
+        """Test the -999 placeholder of empty PS1 slots is never cached"""
+
+        cache = red.PhotozCache()
+        red.calcz_rongpuRF_cached([-999, 5, None], 19., 18., 17., 16.,
+                                  cache=cache)
+
+        self.assertEqual(len(cache), 1)
+        self.assertIn(5, cache)
+        self.assertNotIn(-999, cache)
+
+    def test_xmatch_redshifts_finite(self):
+        """Test cross match redshifts are finite, with -1 for non-galaxies"""
+
+        alerts = load_test_alerts()
+        table = xm.get_xmatches_table(alerts, photoz_cache=red.PhotozCache())
+
+        self.assertEqual(len(table), len(alerts) * len(xm.PS1_SLOTS))
+        self.assertTrue(np.isfinite(table['redshift']).all())
+        is_star = table['sgscore'] >= 0.5
+        self.assertTrue((table['redshift'][is_star] == -1).all())
+
+
+class CrossMatchTable(TestCase):
+    """Tests for building cross matches as a columnar table"""
+
+    def setUp(self):
+        self.model = patch_photoz_model(self)
+        self.alerts = load_test_alerts()
+
+    def test_table_layout(self):
+        """Test the table has one row per alert and PS1 slot, by alert"""
+
+        table = xm.get_xmatches_table(self.alerts, photoz_cache=red.PhotozCache())
+
+        self.assertListEqual(list(table.columns), xm.XMATCH_COLUMNS)
+        for i, alert in enumerate(self.alerts):
+            rows = table.iloc[i * 3:(i + 1) * 3]
+            self.assertTrue((rows['objectId'] == alert['objectId']).all())
+            self.assertListEqual(
+                rows['xobjId'].tolist(),
+                [alert['candidate'][f'objectidps{s}'] for s in xm.PS1_SLOTS])
+
+    def test_single_model_call(self):
+        """Test photo-z's of the whole batch come from one model call"""
+
+        xm.get_xmatches_table(self.alerts, photoz_cache=red.PhotozCache())
+        self.assertEqual(self.model.num_calls, 1)
+
+    def test_dicts_match_table(self):
+        """Test ``get_xmatches`` returns the rows of ``get_xmatches_table``"""
+
+        cache = red.PhotozCache()
+        table = xm.get_xmatches_table(self.alerts, photoz_cache=cache)
+        dicts = xm.get_xmatches(self.alerts, photoz_cache=cache)
+        self.assertListEqual(dicts, table.to_dict('records'))
+
+    def test_empty_batches(self):
+        """Test empty batches and other surveys return an empty table"""
+
+        for alerts, survey in (([], 'ZTF'), (self.alerts, 'LSST')):
+            table = xm.get_xmatches_table(alerts, survey=survey)
+            self.assertEqual(len(table), 0)
+            self.assertListEqual(list(table.columns), xm.XMATCH_COLUMNS)
+
+
+class PhotozCaching(TestCase):
+    """Tests for caching photo-z's by PS1 object id"""
+
+    def setUp(self):
+        self.model = patch_photoz_model(self)
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.db_path = Path(temp_dir.name) / 'photoz.db'
+
+    def test_cached_objects_not_recomputed(self):
+        """Test only uncached objects are passed to the model"""
+
+        cache = red.PhotozCache()
+        first = red.calcz_rongpuRF_cached([1, 2], 19., [18., 17.], 16., 15.,
+                                          cache=cache)
+        second = red.calcz_rongpuRF_cached([2, 3], 19., [17., 20.], 16., 15.,
+                                           cache=cache)
+
+        self.assertEqual(self.model.num_rows, 3)
+        self.assertEqual(second[0], first[1])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_duplicate_ids_computed_once(self):
+        """Test objects repeated within a batch are passed to the model once"""
+
+        z_phot = red.calcz_rongpuRF_cached([7, 7, 7], 19., 18., 17., 16.,
+                                           cache=red.PhotozCache())
+
+        self.assertEqual(self.model.num_rows, 1)
+        np.testing.assert_allclose(z_phot, [.18] * 3)
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted first"""
+
+        cache = red.PhotozCache(maxsize=2)
+        cache.put_many([1, 2], [.1, .2])
+        cache.get_many([1])
+        cache.put_many([3], [.3])
+
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+
+    def test_persisted_entries(self):
+        """Test entries are shared through sqlite and tagged by model"""
+
+        cache = red.PhotozCache(path=self.db_path)
+        cache.put_many([1, 2], [.1, .2])
+        cache.close()
+
+        reopened = red.PhotozCache(path=self.db_path)
+        redshifts, found = reopened.get_many([1, 2, 3])
+        reopened.close()
+        np.testing.assert_array_equal(found, [True, True, False])
+        np.testing.assert_allclose(redshifts[:2], [.1, .2])
+
+        other_model = red.PhotozCache(path=self.db_path, model='other.pkl')
+        self.assertFalse(other_model.get_many([1, 2])[1].any())
+        other_model.close()
+
+
+class DustLookup(TestCase):
+    """Tests for Milky Way E(B-V) lookups from local SFD maps"""
+
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.map_dir = Path(temp_dir.name)
+        self.pole_value = write_dust_maps(self.map_dir)
+
+    def test_galactic_poles(self):
+        """Test lookups at both poles interpolate the central map value"""
+
+        dust_map = dust.DustMap(self.map_dir, scale=1)
+        ngp = (192.85948, 27.12825)
+        sgp = (12.85948, -27.12825)
+        ebv = dust_map.ebv([ngp[0], sgp[0]], [ngp[1], sgp[1]])
+        dust_map.close()
+
+        np.testing.assert_allclose(ebv, self.pole_value, rtol=1e-4)
+
+    def test_scale(self):
+        """Test values are scaled by the Schlafly & Finkbeiner factor"""
+
+        dust_map = dust.DustMap(self.map_dir)
+        ebv = dust_map.ebv(192.85948, 27.12825)
+        dust_map.close()
+
+        np.testing.assert_allclose(
+            ebv, self.pole_value * dust.SF11_SCALE, rtol=1e-4)
+
+    def test_pixel_cache(self):
+        """Test nearby positions share a cached lookup"""
+
+        dust_map = dust.DustMap(self.map_dir)
+        first = dust_map.ebv(10., 20.)
+        second = dust_map.ebv([10., 10.0001], [20., 20.])
+        dust_map.close()
+
+        self.assertEqual((dust_map.hits, dust_map.misses), (2, 1))
+        np.testing.assert_array_equal(second, first[0])
+
+    def test_missing_maps(self):
+        """Test lookups raise without maps and without the remote fallback"""
+
+        dust_map = dust.DustMap(self.map_dir / 'missing')
+        self.assertFalse(dust_map.available)
+        with self.assertRaises(FileNotFoundError):
+            dust_map.ebv(10., 20.)
+
+
+class HealpixPixels(TestCase):
+    """Tests for ``dust.ang2pix_nest``"""
+
+    def test_base_pixels(self):
+        """Test the centers of the 12 base pixels"""
+
+        ra = [45, 135, 225, 315, 0, 90, 180, 270, 45, 135, 225, 315]
+        dec = [41.8] * 4 + [0] * 4 + [-41.8] * 4
+        np.testing.assert_array_equal(dust.ang2pix_nest(1, ra, dec),
+                                      np.arange(12))
+
+    def test_nested_hierarchy(self):
+        """Test each pixel lies within its parent pixel at half the nside"""
+
+        rng = np.random.default_rng(0)
+        ra = rng.uniform(0, 360, 1000)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 1000)))
+        for order in range(1, 8):
+            np.testing.assert_array_equal(
+                dust.ang2pix_nest(2 ** order, ra, dec) // 4,
+                dust.ang2pix_nest(2 ** (order - 1), ra, dec))
+
+    def test_equal_area(self):
+        """Test uniformly distributed positions fill every pixel evenly"""
+
+        rng = np.random.default_rng(1)
+        ra = rng.uniform(0, 360, 192000)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 192000)))
+        counts = np.bincount(dust.ang2pix_nest(4, ra, dec), minlength=192)
+
+        self.assertEqual(len(counts), 192)
+        self.assertLess(np.abs(counts - 1000).max(), 150)
+
+    def test_invalid_nside(self):
+        """Test nside must be a power of 2"""
+
+        with self.assertRaises(ValueError):
+            dust.ang2pix_nest(3, 0., 0.)
+
+
+class LightCurveAssembly(TestCase):
+    """Tests for assembling RAPID light curves from alerts"""
+
+    def setUp(self):
+        self.alerts = load_test_alerts()
+
+    def test_batch_matches_single(self):
+        """Test batched assembly matches assembling each alert alone"""
+
+        epochs_list = [va.get_alert_epochs(alert) for alert in self.alerts]
+        batch = va.format_for_rapid_proc_epochs_batch(epochs_list)
+
+        for epochs, epoch_data in zip(epochs_list, batch):
+            single = va.format_for_rapid_proc_epochs(epochs)
+            for key, values in single.items():
+                np.testing.assert_array_equal(epoch_data[key], values)
+
+    def test_epoch_values(self):
+        """Test nondetections are skipped and magnitudes become fluxes"""
+
+        epochs = [
+            {'jd': 2458000.5, 'fid': 1, 'magpsf': 20., 'sigmapsf': .1,
+             'magzpsci': 25.},
+            {'jd': 2458001.5, 'fid': 2, 'magpsf': None, 'sigmapsf': None,
+             'magzpsci': None},
+            {'jd': 2458002.5, 'fid': 2, 'magpsf': 19., 'sigmapsf': .1,
+             'magzpsci': 25.},
+        ]
+        epoch_data = va.format_for_rapid_proc_epochs(epochs)
+
+        np.testing.assert_array_equal(epoch_data['mjd'], [58000, 58002])
+        np.testing.assert_allclose(epoch_data['flux'], [100, 10 ** 2.4])
+        np.testing.assert_array_equal(epoch_data['passband'], ['g', 'r'])
+        np.testing.assert_array_equal(epoch_data['photflag'], [4096, 6144])
+
+    def test_light_curve_store(self):
+        """Test stored epochs after the alert are not used"""
+
+        from broker.ztf_archive import LightCurveStore
+
+        alert = self.alerts[0]
+        later = deepcopy(alert)
+        later['candidate']['jd'] += 10
+        later['candidate']['candid'] += 1
+        later['prv_candidates'] = [alert['candidate']]
+
+        store = LightCurveStore()
+        store.update(later)  # e.g. a store built from later nights
+        epochs = va.get_alert_epochs(alert, store)
+
+        self.assertIsInstance(epochs, np.ndarray)
+        self.assertListEqual(
+            epochs['jd'].tolist(),
+            sorted({e['jd'] for e in va.get_alert_epochs(alert)}))
+        self.assertGreater(len(store.get_epochs(alert['objectId'])), len(epochs))
+
+        expected = va.format_for_rapid_proc_epochs(va.get_alert_epochs(alert))
+        epoch_data = va.format_for_rapid_proc_epochs(epochs)
+        np.testing.assert_array_equal(epoch_data['passband'], expected['passband'])
+        for key in ('mjd', 'flux', 'fluxerr'):
+            np.testing.assert_allclose(epoch_data[key], expected[key], rtol=1e-5)
+
+    def test_no_previous_candidates(self):
+        """Test alerts without previous candidates use the candidate only"""
+
+        alert = deepcopy(self.alerts[0])
+        alert['prv_candidates'] = None
+        self.assertListEqual(va.get_alert_epochs(alert), [alert['candidate']])
+
+    def test_inconsistent_zeropoints(self):
+        """Test an alert with inconsistent zeropoints is skipped, not raised"""
+
+        alerts = deepcopy(self.alerts)
+        candidate = alerts[1]['candidate']
+        candidate['fid'] = 1
+        alerts[1]['prv_candidates'].append(
+            dict(candidate, jd=candidate['jd'] - 1, magzpsci=None))
+        epochs_list = [va.get_alert_epochs(alert) for alert in alerts]
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            batch = va.format_for_rapid_proc_epochs_batch(epochs_list)
+
+        self.assertGreater(len(batch[0]['mjd']), 0)
+        self.assertEqual(len(batch[1]['mjd']), 0)
+        self.assertTrue(any('Inconsistent' in str(w.message) for w in caught))
+
+        xmatch_dicts = [{'objectId': alerts[1]['objectId'], 'xobjId': 1,
+                         'xcatalog': 'PS1', 'redshift': .1}]
+        light_curves, _ = va.format_for_rapid(alerts[1:], xmatch_dicts,
+                                              mwebvs=[0.])
+        self.assertListEqual(light_curves, [])
+
+    def test_format_for_rapid(self):
+        """Test one light curve per alert and galaxy with a redshift"""
+
+        xmatch_dicts = [
+            {'objectId': alert['objectId'], 'xobjId': 100 + i,
+             'xcatalog': 'PS1', 'redshift': z}
+            for i, (alert, z) in enumerate(zip(self.alerts, (.1, -1.)))]
+        light_curves, cx_dicts = va.format_for_rapid(
+            self.alerts, xmatch_dicts, mwebvs=[.01, .02])
+
+        self.assertEqual(len(light_curves), 1)
+        cxid = light_curves[0][7]
+        self.assertEqual(light_curves[0][8:], (.1, .01))
+        self.assertEqual(cx_dicts[cxid]['candid'],
+                         self.alerts[0]['candidate']['candid'])
+        self.assertEqual(cx_dicts[cxid]['xobjId'], 100)
+
+
+class ObjectIdGrouping(TestCase):
+    """Tests for grouping cross matches by objectId"""
+
+    def test_groups_match_mapping(self):
+        """Test groups match ``map_objectId_list`` and keep their order"""
+
+        object_ids = ['ZTFb', 'ZTFa', 'ZTFb', 'ZTFc', 'ZTFa', 'ZTFb']
+        groups = va.group_objectIds(object_ids)
+        expected = va.map_objectId_list([{'objectId': o} for o in object_ids])
+
+        self.assertSetEqual(set(groups), set(expected))
+        for object_id, positions in groups.items():
+            self.assertListEqual(positions.tolist(), expected[object_id])
+
+    def test_empty(self):
+        """Test an empty sequence gives no groups"""
+
+        self.assertDictEqual(va.group_objectIds([]), {})
+
+    def test_xmatch_columns(self):
+        """Test cross match columns are gathered from dicts and tables"""
+
+        import pandas as pd
+
+        xmatch_dicts = [
+            {'objectId': 'ZTFa', 'xobjId': 1, 'xcatalog': 'PS1', 'redshift': .1},
+            {'objectId': 'ZTFb', 'xobjId': 2, 'xcatalog': 'PS1', 'redshift': -1},
+        ]
+        from_dicts = va.get_xmatch_columns(xmatch_dicts)
+        from_table = va.get_xmatch_columns(pd.DataFrame(xmatch_dicts))
+
+        for column in ('objectId', 'xobjId', 'xcatalog', 'redshift'):
+            self.assertListEqual(from_dicts[column].tolist(),
+                                 from_table[column].tolist())
+
+        self.assertEqual(from_dicts['redshift'].dtype, float)
+
+
+class ClassifierService(TestCase):
+    """Tests for the long-lived RAPID classifier service"""
+
+    def test_micro_batches(self):
+        """Test light curves are classified in batches of max_batch_size"""
+
+        service, classifier = start_fake_service(
+            self, max_batch_size=4, max_latency=60)
+        futures = service.submit_many(
+            [make_light_curve(f'lc{i}') for i in range(10)])
+        service.stop()
+
+        self.assertListEqual([len(b) for b in classifier.batches], [4, 4, 2])
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertSetEqual(classifier.threads, {'RapidClassifierService'})
+
+    def test_deadline(self):
+        """Test a partial batch is classified once max_latency has passed"""
+
+        service, classifier = start_fake_service(self, max_latency=.05)
+        lc_preds, lc_times = service.submit(make_light_curve('lc')).result(5)
+
+        self.assertEqual(len(classifier.batches), 1)
+        np.testing.assert_allclose(lc_preds[-1], [.1, .9])
+
+    def test_results_in_input_order(self):
+        """Test duplicate light curves each get a result, in input order"""
+
+        service, _ = start_fake_service(self, max_latency=.01)
+        light_curves = [make_light_curve('a', redshift=.1),
+                        make_light_curve('b', redshift=.2),
+                        make_light_curve('a', redshift=.1)]
+        predictions = service.predict(light_curves, timeout=5)
+
+        self.assertListEqual(predictions[2], ['a', 'b', 'a'])
+        self.assertEqual(len(service.submit_many(light_curves)), 3)
+
+    def test_classify(self):
+        """Test ``classify`` adds class probabilities to cx_dicts"""
+
+        service, _ = start_fake_service(self, max_latency=.01)
+        light_curves = [make_light_curve('a', redshift=.3)]
+        cx_dicts = {'a': {'objectId': 'ZTFa'}}
+        result = service.classify(light_curves, cx_dicts, timeout=5)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['objectId'], 'ZTFa')
+        self.assertAlmostEqual(result[0]['prob_class0'], .3)
+        self.assertEqual(service.class_names, FakeClassifier.class_names)
+
+    def test_factory_errors(self):
+        """Test model loading errors are raised by each future"""
+
+        def fail():
+            raise RuntimeError('no model')
+
+        service = RapidClassifierService(classifier_factory=fail,
+                                         max_latency=.01)
+        service.start()
+        self.addCleanup(service.stop)
+        with self.assertRaises(RuntimeError):
+            service.submit(make_light_curve('lc')).result(5)
+
+    def test_stopped(self):
+        """Test light curves cannot be submitted to a stopped service"""
+
+        service, _ = start_fake_service(self)
+        service.stop()
+        with self.assertRaises(RuntimeError):
+            service.submit(make_light_curve('lc'))
+
+    def test_own_classifier(self):
+        """Test the service does not share the model used by ``rapid``"""
+
+        service = RapidClassifierService()
+        self.assertIs(service.classifier_factory, classify.new_rapid_classifier)
+        self.assertIsNot(service.classifier_factory,
+                         classify.load_rapid_classifier)
+
+    def test_get_value_added(self):
+        """Test ``get_value_added`` classifies with the given service"""
+
+        patch_photoz_model(self)
+        service, classifier = start_fake_service(self, max_latency=.01)
+        alerts = load_test_alerts()
+        mwebvs = np.zeros(len(alerts))
+        with mock.patch.object(va, 'get_mwebvs', return_value=mwebvs):
+            xmatch_dicts, classification_dicts = va.get_value_added(
+                alerts, classifier_service=service,
+                classification_cache=classify.ClassificationCache())
+
+        light_curves, _ = va.format_for_rapid(alerts, xmatch_dicts,
+                                              mwebvs=mwebvs)
+        self.assertGreater(len(light_curves), 0)
+        self.assertListEqual(classifier.batches, [[lc[7] for lc in light_curves]])
+        self.assertEqual(len(classification_dicts), len(light_curves))
+
+
+class RapidClassification(TestCase):
+    """Tests for ``classify.rapid``"""
+
+    def setUp(self):
+        self.classifier = FakeClassifier()
+        patcher = mock.patch.object(classify, 'load_rapid_classifier',
+                                    return_value=self.classifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_input_order(self):
+        """Test light curves of any length are classified in one call and
+        results are returned in input order
+        """
+
+        light_curves = [make_light_curve(f'lc{n}', num_epochs=n, redshift=n / 100)
+                        for n in (40, 1, 100, 8)]
+        cx_dicts = {lc[7]: {'cxid': lc[7]} for lc in light_curves}
+        result = classify.rapid(light_curves, cx_dicts)
+
+        self.assertEqual(len(self.classifier.batches), 1)
+        self.assertListEqual([d['cxid'] for d in result],
+                             [lc[7] for lc in light_curves])
+        self.assertListEqual([d['prob_class0'] for d in result],
+                             [lc[8] for lc in light_curves])
+
+    def test_no_light_curves(self):
+        """Test nothing is classified if there are no light curves"""
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.assertListEqual(classify.rapid([], {}), [])
+
+        self.assertListEqual(self.classifier.batches, [])
+
+
+class ClassificationCaching(TestCase):
+    """Tests for caching RAPID classifications by light curve content"""
+
+    def setUp(self):
+        self.classifier = FakeClassifier()
+        patcher = mock.patch.object(classify, 'load_rapid_classifier',
+                                    return_value=self.classifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def make_input(xobjId, candid=1, flux=1.):
+        """Return light curves and cx_dicts for one object + host pair"""
+
+        cxid = va.alert_xobj_id(['ZTFa', candid, 58004., 'PS1', xobjId])
+        light_curve = list(make_light_curve(cxid))
+        light_curve[1] = light_curve[1] * flux
+        cx_dict = {'objectId': 'ZTFa', 'candid': candid, 'xobjId': xobjId,
+                   'xcatalog': 'PS1'}
+        return [tuple(light_curve)], {cxid: cx_dict}
+
+    def test_key_ids(self):
+        """Test keys of placeholder and dashed ids use the cx_dict values"""
+
+        for xobjId in (-999, '2MASS-J12345678-1234567'):
+            light_curves, cx_dicts = self.make_input(xobjId)
+            key = classify.classification_cache_key(
+                light_curves[0], cx_dicts[light_curves[0][7]])
+            self.assertTupleEqual(key[:3], ('ZTFa', 'PS1', str(xobjId)))
+
+    def test_key_content(self):
+        """Test keys ignore the candid but not the light curve content"""
+
+        def key(**kwargs):
+            light_curves, cx_dicts = self.make_input(-999, **kwargs)
+            return classify.classification_cache_key(
+                light_curves[0], cx_dicts[light_curves[0][7]])
+
+        self.assertEqual(key(candid=1), key(candid=2))
+        self.assertNotEqual(key(), key(flux=2.))
+
+    def test_rapid_reuses_cache(self):
+        """Test unchanged light curves are not classified again"""
+
+        cache = classify.ClassificationCache()
+        first = classify.rapid(*self.make_input(-999, candid=1), cache=cache)
+        second = classify.rapid(*self.make_input(-999, candid=2), cache=cache)
+        classify.rapid(*self.make_input(-999, flux=2.), cache=cache)
+
+        self.assertEqual(len(self.classifier.batches), 2)
+        self.assertEqual(second[0]['candid'], 2)
+        self.assertEqual(second[0]['prob_class0'], first[0]['prob_class0'])
+        self.assertDictEqual(
+            {k: v for k, v in cache.stats().items() if k != 'hit_rate'},
+            {'size': 2, 'maxsize': 100000, 'policy': 'lru', 'hits': 1,
+             'misses': 2, 'evictions': 0})
+
+    def test_eviction_policies(self):
+        """Test 'lru' evicts the least recently used and 'fifo' the oldest"""
+
+        for policy, kept in (('lru', 'a'), ('fifo', 'b')):
+            cache = classify.ClassificationCache(maxsize=2, policy=policy)
+            cache.put('a', {})
+            cache.put('b', {})
+            cache.get('a')
+            cache.put('c', {})
+
+            self.assertIn(kept, cache)
+            self.assertIn('c', cache)
+            self.assertEqual(cache.evictions, 1)
+
+        with self.assertRaises(ValueError):
+            classify.ClassificationCache(policy='random')
+
+    def test_get_value_added(self):
+        """Test ``get_value_added`` reuses cached classifications"""
+
+        patch_photoz_model(self)
+        service, classifier = start_fake_service(self, max_latency=.01)
+        cache = classify.ClassificationCache()
+        alerts = load_test_alerts()
+        with mock.patch.object(va, 'get_mwebvs',
+                               return_value=np.zeros(len(alerts))):
+            results = [va.get_value_added(alerts, classifier_service=service,
+                                          classification_cache=cache)
+                       for _ in range(2)]
+
+        self.assertEqual(len(classifier.batches), 1)
+        self.assertListEqual(results[0][1], results[1][1])
+        self.assertGreater(cache.hits, 0)
+
+
+class ValueAddedStream(TestCase):
+    """Tests for the ``stream`` module"""
+
+    def setUp(self):
+        patch_photoz_model(self)
+        self.service, self.classifier = start_fake_service(
+            self, max_latency=.01)
+        self.alerts = load_test_alerts()
+        patcher = mock.patch.object(
+            va, 'get_mwebvs', side_effect=lambda alerts: np.zeros(len(alerts)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.executor = ThreadPoolExecutor(2)
+        self.addCleanup(self.executor.shutdown)
+
+    def iter_value_added(self, alerts, **kwargs):
+        kwargs.setdefault('executor', self.executor)
+        kwargs.setdefault('classification_cache', classify.ClassificationCache())
+        return stream.iter_value_added(
+            alerts, batch_size=1, classifier_service=self.service, **kwargs)
+
+    def test_matches_get_value_added(self):
+        """Test each batch matches ``get_value_added`` for that batch"""
+
+        results = list(self.iter_value_added(iter(self.alerts)))
+
+        self.assertEqual(len(results), len(self.alerts))
+        for alert, (xmatch_dicts, classification_dicts) in zip(self.alerts, results):
+            expected = va.get_value_added(
+                [alert], classifier_service=self.service,
+                classification_cache=classify.ClassificationCache())
+            self.assertListEqual(xmatch_dicts, expected[0])
+            self.assertListEqual(classification_dicts, expected[1])
+
+    def test_classification_cache(self):
+        """Test a replayed stream is classified from the cache"""
+
+        cache = classify.ClassificationCache()
+        first = list(self.iter_value_added(self.alerts, classification_cache=cache))
+        num_batches = len(self.classifier.batches)
+        second = list(self.iter_value_added(self.alerts, classification_cache=cache))
+
+        self.assertListEqual(first, second)
+        self.assertEqual(len(self.classifier.batches), num_batches)
+
+    def test_result_store(self):
+        """Test stored products are not recomputed"""
+
+        store = ResultStore(':memory:', versions=dict.fromkeys(PRODUCTS, 'test'))
+        self.addCleanup(store.close)
+        first = list(self.iter_value_added(self.alerts, result_store=store))
+        with mock.patch.object(xm, 'get_xmatches_table') as get_xmatches_table:
+            second = list(self.iter_value_added(self.alerts, result_store=store))
+
+        get_xmatches_table.assert_not_called()
+        self.assertListEqual(first, second)
+        self.assertEqual(store.count('xmatch'), len(self.alerts))
+        self.assertEqual(len(self.classifier.batches), 1)
+
+    def test_default_executor(self):
+        """Test the default executor spawns a bounded number of processes"""
+
+        def make_executor(max_workers, mp_context):
+            self.assertEqual(mp_context.get_start_method(), 'spawn')
+            return ThreadPoolExecutor(max_workers)
+
+        with mock.patch.object(stream, 'ProcessPoolExecutor',
+                               side_effect=make_executor) as pool:
+            list(self.iter_value_added(self.alerts, executor=None, max_workers=3))
+
+        self.assertEqual(pool.call_args[1]['max_workers'], 3)
+
+    def test_blocked_input(self):
+        """Test closing the stream does not wait for a blocked input"""
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def alerts():
+            yield self.alerts[0]
+            release.wait()
+
+        results = self.iter_value_added(alerts())
+        next(results)
+        start = time.monotonic()
+        with mock.patch.object(stream, '_JOIN_TIMEOUT', .1):
+            results.close()
+
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_input_errors(self):
+        """Test errors reading the input reach the consumer"""
+
+        def alerts():
+            yield self.alerts[0]
+            raise KeyError('bad alert')
+
+        with self.assertRaises(KeyError):
+            list(self.iter_value_added(alerts()))
+
+
+class ResultStoreUploads(TestCase):
+    """Tests for recording uploads in a ``ResultStore``"""
+
+    def setUp(self):
+        self.store = ResultStore(':memory:', versions=dict.fromkeys(PRODUCTS, 'test'))
+        self.addCleanup(self.store.close)
+
+    def test_uploaded(self):
+        """Test uploads are recorded per destination"""
+
+        self.store.put_uploaded('data.xmatch', [1, 2])
+        self.store.put_uploaded('data.xmatch', [2])
+
+        self.assertSetEqual(self.store.get_uploaded('data.xmatch', [1, 2, 3]), {1, 2})
+        self.assertSetEqual(self.store.get_uploaded('data.classification', [1]), set())
+
+    def test_delete_uploaded(self):
+        """Test uploads can be forgotten by destination and candid"""
+
+        self.store.put_uploaded('a', range(1200))
+        self.store.put_uploaded('b', [1])
+        self.store.delete_uploaded(candids=range(1000))
+
+        self.assertEqual(len(self.store.get_uploaded('a', range(1200))), 200)
+        self.assertSetEqual(self.store.get_uploaded('b', [1]), set())
+
+        self.store.delete_uploaded('a')
+        self.assertSetEqual(self.store.get_uploaded('a', range(1200)), set())
+
+    def test_delete_candids(self):
+        """Test results can be removed by candid"""
+
+        self.store.put_many('mwebv', {1: .1, 2: .2})
+        self.store.delete(candids=[1])
+
+        self.assertDictEqual(self.store.get_many('mwebv', [1, 2]), {2: .2})
+
+
+class FakeMessage:
+    """Stands in for a Pub/Sub message"""
+
+    def __init__(self, data, message_id='0'):
+        self.data = data
+        self.message_id = message_id
+        self.acks = 0
+        self.nacks = 0
+
+    def ack(self):
+        self.acks += 1
+
+    def nack(self):
+        self.nacks += 1
+
+
+class FlakyUpload:
+    """Records uploaded rows and fails the first uploads to some tables"""
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})  # {table: number of failures}
+        self.rows = {}  # {table: [row dicts]}
+
+    def __call__(self, data, data_set, table):
+        if self.failures.get(table, 0) > 0:
+            self.failures[table] -= 1
+            raise RuntimeError(f'Upload to {table} failed')
+
+        self.rows.setdefault(table, []).extend(data.to_dict('records'))
+
+
+class ValueAddedWorkerUploads(TestCase):
+    """Tests for uploads by ``ValueAddedWorker``"""
+
+    def setUp(self):
+        patch_photoz_model(self)
+        self.service, self.classifier = start_fake_service(self, max_latency=.01)
+        patcher = mock.patch.object(
+            va, 'get_mwebvs', side_effect=lambda alerts: np.zeros(len(alerts)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alerts = load_test_alerts()
+        self.data = [path.read_bytes()
+                     for path in sorted(TEST_ALERTS_DIR.glob('*.avro'))]
+
+    def make_worker(self, upload, **kwargs):
+        return ValueAddedWorker('subscription', upload=upload,
+                                classifier_service=self.service, **kwargs)
+
+    def process(self, worker):
+        messages = [FakeMessage(data, str(i)) for i, data in enumerate(self.data)]
+        worker.process_messages(messages)
+        return messages
+
+    def test_redelivered_batch(self):
+        """Test a redelivered batch does not upload cross matches twice"""
+
+        upload = FlakyUpload({'classification': 1})
+        worker = self.make_worker(upload)
+
+        messages = self.process(worker)
+        self.assertListEqual([m.nacks for m in messages], [1] * len(messages))
+        self.assertNotIn('classification', upload.rows)
+
+        messages = self.process(worker)
+        self.assertListEqual([m.acks for m in messages], [1] * len(messages))
+        self.assertEqual(len(upload.rows['xmatch']),
+                         len(self.alerts) * len(xm.PS1_SLOTS))
+        self.assertEqual(worker.num_skipped_uploads, len(self.alerts))
+        self.assertEqual(worker.num_failed_batches, 1)
+
+    def test_own_store_forgets_acked(self):
+        """Test the default in-memory store is emptied once a batch is acked"""
+
+        worker = self.make_worker(FlakyUpload())
+        self.process(worker)
+
+        self.assertEqual(worker.result_store.count('xmatch'), 0)
+        candids = [alert['candidate']['candid'] for alert in self.alerts]
+        self.assertSetEqual(worker.result_store.get_uploaded(
+            'ztf_alerts.xmatch', candids), set())
+
+    def test_result_store(self):
+        """Test alerts in a given store are not uploaded again"""
+
+        store = ResultStore(':memory:', versions=dict.fromkeys(PRODUCTS, 'test'))
+        self.addCleanup(store.close)
+        upload = FlakyUpload()
+        worker = self.make_worker(upload, result_store=store)
+        self.process(worker)
+        num_rows = {table: len(rows) for table, rows in upload.rows.items()}
+        messages = self.process(worker)
+
+        self.assertDictEqual(
+            {table: len(rows) for table, rows in upload.rows.items()}, num_rows)
+        self.assertEqual(num_rows['xmatch'], len(self.alerts) * len(xm.PS1_SLOTS))
+        self.assertListEqual([m.acks for m in messages], [1] * len(messages))
+
+    def test_failing_message(self):
+        """Test a message whose products fail is isolated and finally dropped"""
+
+        bad_candid = self.alerts[0]['candidate']['candid']
+        get_value_added_by_candid = va.get_value_added_by_candid
+
+        def fail_on_bad_alert(alert_list, **kwargs):
+            if any(a['candidate']['candid'] == bad_candid for a in alert_list):
+                raise ValueError('bad alert')
+
+            return get_value_added_by_candid(alert_list, **kwargs)
+
+        upload = FlakyUpload()
+        worker = self.make_worker(upload, max_failures=2)
+        with mock.patch.object(va, 'get_value_added_by_candid',
+                               side_effect=fail_on_bad_alert):
+            bad, good = self.process(worker)
+            self.assertEqual((bad.acks, bad.nacks, good.acks), (0, 1, 1))
+            self.assertEqual(len(upload.rows['xmatch']), len(xm.PS1_SLOTS))
+
+            bad, _ = self.process(worker)
+
+        self.assertEqual((bad.acks, bad.nacks), (1, 0))
+        self.assertEqual(worker.num_dropped, 1)
+
+    def test_missing_dependencies(self):
+        """Test the worker does not start without the dust maps"""
+
+        with TemporaryDirectory() as map_dir:
+            dust_map = dust.DustMap(map_dir)
+            subscriber = mock.Mock()
+            worker = self.make_worker(FlakyUpload(), subscriber=subscriber)
+            with mock.patch.object(dust, 'get_dust_map', return_value=dust_map):
+                with self.assertRaisesRegex(RuntimeError, 'SFD dust maps'):
+                    worker.start()
+
+                subscriber.subscribe.assert_not_called()
+
+                write_dust_maps(map_dir)
+                check_dependencies(self.service)
+
+    def test_undecodable_message(self):
+        """Test messages that cannot be decoded are acked without uploads"""
+
+        upload = FlakyUpload()
+        message = FakeMessage(b'not avro')
+        self.make_worker(upload).process_messages([message])
+
+        self.assertEqual(message.acks, 1)
+        self.assertDictEqual(upload.rows, {})
+
+
+def make_alert(object_id, ra, dec, candid=1):
+    """Return the alert fields used for cross matching"""
+
+    return {'objectId': object_id,
+            'candidate': {'candid': candid, 'ra': ra, 'dec': dec}}
+
+
+class LocalCatalogMatching(TestCase):
+    """Tests for cross matching against a ``LocalCatalog``"""
+
+    def setUp(self):
+        # sources 1, 2 and 4 arcsec east of (10, 0) and one at the pole
+        offsets = np.array([1, 2, 4]) / 3600
+        self.catalog = LocalCatalog(
+            'Test', ['a', 'b', 'c', 'pole'],
+            np.append(10 + offsets, 0.), [0., 0., 0., 90.],
+            redshift=[.1, .2, .3, .4], sgscore=[.5, .6, .7, .8])
+
+    def test_builtin_ids(self):
+        """Test matched ids are builtin types, as in PS1 cross matches"""
+
+        xmatch, = self.catalog.get_xmatches([make_alert('ZTFa', 10., 0.)])
+        catalog = LocalCatalog('Test', np.array([7]), [10.], [0.])
+        table = catalog.get_xmatches_table([make_alert('ZTFa', 10., 0.)])
+
+        self.assertIs(type(xmatch['xobjId']), str)
+        self.assertIs(type(table['xobjId'].iloc[0]), int)
+
+    def test_nearest(self):
+        """Test the nearest source within the radius is matched"""
+
+        positions, rows, sep = self.catalog.match([10., 10., 50.], [0., 90., 0.])
+
+        np.testing.assert_array_equal(positions, [0, 1])
+        np.testing.assert_array_equal(rows, [0, 3])
+        np.testing.assert_allclose(sep, [1, 0], atol=1e-6)
+
+    def test_radius(self):
+        """Test all sources within the radius are matched, by separation"""
+
+        positions, rows, sep = self.catalog.match(10., 0., radius=3, nearest=False)
+
+        np.testing.assert_array_equal(positions, [0, 0])
+        np.testing.assert_array_equal(rows, [0, 1])
+        np.testing.assert_allclose(sep, [1, 2], rtol=1e-6)
+
+    def test_invalid_positions(self):
+        """Test sources and positions without coordinates are skipped"""
+
+        catalog = LocalCatalog('Test', ['a', 'b'], [10., np.nan], [0., 0.])
+        positions, rows, _ = catalog.match([np.nan, 10.], [0., 0.])
+
+        self.assertEqual(len(catalog), 1)
+        np.testing.assert_array_equal(positions, [1])
+        np.testing.assert_array_equal(rows, [0])
+
+    def test_xmatches_table(self):
+        """Test matches are formatted as in ``xmatch.get_xmatches()``"""
+
+        alerts = [make_alert('ZTFa', 10., 0.), make_alert('ZTFb', 50., 0.),
+                  make_alert('ZTFc', 0., 90.)]
+        table = self.catalog.get_xmatches_table(alerts)
+
+        self.assertListEqual(list(table.columns), xm.XMATCH_COLUMNS)
+        self.assertListEqual(table['objectId'].tolist(), ['ZTFa', 'ZTFc'])
+        self.assertListEqual(table['xobjId'].tolist(), ['a', 'pole'])
+        self.assertListEqual(table['redshift'].tolist(), [.1, .4])
+        self.assertListEqual(self.catalog.get_xmatches(alerts),
+                             table.to_dict('records'))
+        self.assertEqual(len(self.catalog.get_xmatches_table([])), 0)
+
+    def test_defaults(self):
+        """Test sources without redshift or sgscore get the defaults"""
+
+        catalog = LocalCatalog('Test', ['a'], [10.], [0.])
+        xmatch, = catalog.get_xmatches([make_alert('ZTFa', 10., 0.)])
+
+        self.assertEqual(xmatch['redshift'], -1)
+        self.assertTrue(np.isnan(xmatch['sgscore']))
+
+    def test_save_load(self):
+        """Test a saved catalog loads unchanged"""
+
+        with TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'catalog.npz'
+            self.catalog.save(path)
+            loaded = LocalCatalog.load(path)
+
+        self.assertEqual(loaded.name, 'Test')
+        for attr in ('ids', 'ra', 'dec', 'redshift', 'sgscore'):
+            np.testing.assert_array_equal(getattr(loaded, attr),
+                                          getattr(self.catalog, attr))
+
+    def test_from_file(self):
+        """Test a catalog is read from the named columns of a CSV file"""
+
+        with TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'catalog.csv'
+            path.write_text('source_id,RA,DEC,z,other\n'
+                            '7,10.0,0.0,0.5,x\n'
+                            '8,,0.0,0.6,y\n')
+            catalog = LocalCatalog.from_file(path, 'CSV', id_col='source_id',
+                                             ra_col='RA', dec_col='DEC',
+                                             redshift_col='z')
+
+        self.assertEqual(len(catalog), 1)
+        xmatch, = catalog.get_xmatches([make_alert('ZTFa', 10., 0.)])
+        self.assertEqual(xmatch['xobjId'], 7)
+        self.assertEqual(xmatch['xcatalog'], 'CSV')
+        self.assertEqual(xmatch['redshift'], .5)
+
+
+class AlertPositions(TestCase):
+    """Tests for reading alert positions from the local alert index"""
+
+    def setUp(self):
+        from broker.ztf_archive import _index
+
+        self.indices = {}
+        for day, num_alerts in (('20200101', 5), ('20200102', 3), ('20200103', 4)):
+            index = np.zeros(num_alerts, dtype=_index.INDEX_DTYPE)
+            index['release'] = day
+            index['candid'] = int(day) * 10 + np.arange(num_alerts)
+            index['ra'] = np.arange(num_alerts) * 10.
+            index['dec'] = -np.arange(num_alerts)
+            self.indices[day] = index
+
+        for name, kwargs in (
+                ('_local_releases', {'return_value': sorted(self.indices)}),
+                ('get_release_index', {'side_effect': self.indices.__getitem__})):
+            patcher = mock.patch.object(_index, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def candids(self, chunks):
+        return [c for chunk in chunks for c in chunk['alert_id'].tolist()]
+
+    def test_all_alerts(self):
+        """Test every indexed alert is returned in chunks"""
+
+        chunks = list(xm.iter_alerts_ra_dec(chunk_size=2))
+
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+        self.assertListEqual(list(chunks[0].columns), xm.RA_DEC_COLUMNS)
+        self.assertListEqual(
+            self.candids(chunks),
+            [c for index in self.indices.values() for c in index['candid'].tolist()])
+
+    def test_max_alerts(self):
+        """Test reading stops after max_alerts, across releases"""
+
+        for max_alerts, expected in ((6, 6), (0, 12), (None, 12), (100, 12)):
+            chunks = xm.iter_alerts_ra_dec(max_alerts=max_alerts, chunk_size=4)
+            self.assertEqual(len(self.candids(chunks)), expected)
+
+    def test_dates(self):
+        """Test releases outside the date range are skipped"""
+
+        chunks = xm.iter_alerts_ra_dec(start_date='20200102', end_date='20200102')
+        self.assertListEqual(self.candids(chunks),
+                             self.indices['20200102']['candid'].tolist())
+
+    def test_get_alerts_ra_dec(self):
+        """Test positions are returned or written as CSV and Parquet"""
+
+        import pandas as pd
+
+        expected = xm.get_alerts_ra_dec(max_alerts=7, chunk_size=3)
+        self.assertEqual(len(expected), 7)
+        self.assertListEqual(expected['ra'].tolist()[:6], [0., 10., 20., 30., 40., 0.])
+
+        with TemporaryDirectory() as tmp_dir:
+            for name, read in (('alerts.csv', pd.read_csv),
+                               ('alerts.parquet', pd.read_parquet)):
+                path = Path(tmp_dir) / name
+                self.assertIsNone(xm.get_alerts_ra_dec(
+                    path, max_alerts=7, chunk_size=3))
+                pd.testing.assert_frame_equal(read(path), expected,
+                                              check_dtype=False)
+
+    def test_no_alerts(self):
+        """Test an error is raised if there are no local alerts"""
+
+        with self.assertRaises(RuntimeError):
+            xm.get_alerts_ra_dec(start_date='20210101')
+
+
+class FakeExecutor:
+    """Stands in for a process pool. Submitted work is never run"""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, func, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class BackgroundPlotting(TestCase):
+    """Tests for ``plotting.RapidPlotter``"""
+
+    def make_plotter(self, **kwargs):
+        plotter = plotting.RapidPlotter('plots', **kwargs)
+        plotter._executor = self.executor = FakeExecutor()
+        return plotter
+
+    @staticmethod
+    def make_input(object_ids):
+        light_curves = [make_light_curve(f'{oid}-1-58000.0-PS1-{i}')
+                        for i, oid in enumerate(object_ids)]
+        predictions = ([np.full((len(lc[0]), 2), .5) for lc in light_curves],
+                       [lc[0] for lc in light_curves],
+                       [lc[7] for lc in light_curves])
+        return light_curves, predictions
+
+    def test_rate_limit(self):
+        """Test an object is plotted at most once per min_interval"""
+
+        plotter = self.make_plotter(min_interval=3600)
+        num_queued = plotter.submit(*self.make_input(['ZTFa', 'ZTFa', 'ZTFb']))
+
+        self.assertEqual(num_queued, 2)
+        self.assertEqual(plotter.num_rate_limited, 1)
+
+        plotter = self.make_plotter(min_interval=0)
+        self.assertEqual(plotter.submit(*self.make_input(['ZTFa', 'ZTFa'])), 2)
+
+    def test_drop_newest(self):
+        """Test plots submitted to a full pool are dropped"""
+
+        plotter = self.make_plotter(max_pending=2, min_interval=0)
+        plotter.submit(*self.make_input(['ZTFa', 'ZTFb', 'ZTFc']))
+
+        self.assertEqual(len(self.executor.futures), 2)
+        self.assertDictEqual(plotter.stats(), {
+            'pending': 2, 'submitted': 2, 'dropped': 1, 'rate_limited': 0,
+            'failed': 0})
+
+    def test_drop_oldest(self):
+        """Test the oldest queued plot is cancelled in favor of a new one"""
+
+        plotter = self.make_plotter(max_pending=2, min_interval=0,
+                                    drop_policy='oldest')
+        plotter.submit(*self.make_input(['ZTFa', 'ZTFb', 'ZTFc']))
+
+        first, *others = self.executor.futures
+        self.assertTrue(first.cancelled())
+        self.assertFalse(any(f.cancelled() for f in others))
+        self.assertEqual(plotter.stats()['pending'], 2)
+        self.assertEqual(plotter.num_dropped, 1)
+
+    def test_drop_oldest_running(self):
+        """Test plots being rendered are not cancelled"""
+
+        plotter = self.make_plotter(max_pending=1, min_interval=0,
+                                    drop_policy='oldest')
+        plotter.submit(*self.make_input(['ZTFa']))
+        self.executor.futures[0].set_running_or_notify_cancel()
+        plotter.submit(*self.make_input(['ZTFb']))
+
+        self.assertEqual(len(self.executor.futures), 1)
+        self.assertEqual(plotter.num_dropped, 1)
+
+    def test_finished_plots(self):
+        """Test finished plots free their slot and failures are counted"""
+
+        plotter = self.make_plotter(max_pending=2, min_interval=0)
+        plotter.submit(*self.make_input(['ZTFa', 'ZTFb']))
+        self.executor.futures[0].set_result('plot.pdf')
+        self.executor.futures[1].set_exception(RuntimeError('no display'))
+
+        self.assertEqual(plotter.stats()['pending'], 0)
+        self.assertEqual(plotter.num_failed, 1)
+
+    def test_close_without_waiting(self):
+        """Test closing without waiting cancels the queued plots"""
+
+        plotter = self.make_plotter(min_interval=0)
+        plotter.submit(*self.make_input(['ZTFa', 'ZTFb', 'ZTFc']))
+        self.executor.futures[0].set_running_or_notify_cancel()
+        plotter.close(wait=False)
+
+        self.assertListEqual([f.cancelled() for f in self.executor.futures],
+                             [False, True, True])
+        self.assertEqual(plotter.stats()['pending'], 1)
+        self.assertIsNone(plotter._executor)
+
+    def test_invalid_drop_policy(self):
+        """Test an unknown drop policy raises an error"""
+
+        with self.assertRaises(ValueError):
+            plotting.RapidPlotter('plots', drop_policy='random')
+
+    def test_plot_classification(self):
+        """Test a plot is written for a snapshot"""
+
+        lc = make_light_curve('ZTFa-1-58000.0-PS1-1')
+        snapshot = {'cxid': lc[7], 'mjd': lc[0], 'flux': lc[1],
+                    'fluxerr': lc[2], 'passband': lc[3],
+                    'preds': np.full((len(lc[0]), 2), .5), 'times': lc[0],
+                    'class_names': None}
+
+        with TemporaryDirectory() as tmp_dir:
+            path = plotting.plot_classification(Path(tmp_dir) / 'plots', snapshot)
+            self.assertTrue(path.is_file())
+
+
+class StoredValueAdded(TestCase):
+    """Tests for ``ResultStore`` and ``get_value_added`` with a store"""
+
+    def setUp(self):
+        patch_photoz_model(self)
+        self.service, self.classifier = start_fake_service(self, max_latency=.01)
+        patcher = mock.patch.object(
+            va, 'get_mwebvs', side_effect=lambda alerts: np.zeros(len(alerts)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alerts = load_test_alerts()
+        self.candids = [alert['candidate']['candid'] for alert in self.alerts]
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = Path(tmp_dir.name) / 'value_added.db'
+        self.store = self.open_store()
+
+    def open_store(self, version='test'):
+        store = ResultStore(self.path, versions=dict.fromkeys(PRODUCTS, version))
+        self.addCleanup(store.close)
+        return store
+
+    def get_value_added(self, alerts, **kwargs):
+        kwargs.setdefault('result_store', self.store)
+        return va.get_value_added(
+            alerts, classifier_service=self.service,
+            classification_cache=classify.ClassificationCache(), **kwargs)
+
+    def test_versions(self):
+        """Test results are persisted and looked up by model version"""
+
+        self.store.put_many('mwebv', {1: .1, 2: np.float32(.5)})
+        self.store.close()
+
+        store = self.open_store()
+        self.assertDictEqual(store.get_many('mwebv', [1, 2, 3]), {1: .1, 2: .5})
+        self.assertEqual((store.hits, store.misses), (2, 1))
+        self.assertDictEqual(self.open_store('new').get_many('mwebv', [1]), {})
+
+        store.delete(product='mwebv', version='test')
+        self.assertEqual(store.count('mwebv'), 0)
+
+    def test_model_versions(self):
+        """Test classifications are tagged with the versions of their inputs"""
+
+        from broker.value_added.result_store import get_model_versions
+
+        versions = get_model_versions()
+        self.assertSetEqual(set(versions), set(PRODUCTS))
+        self.assertIn(versions['xmatch'], versions['classification'])
+        self.assertIn(versions['mwebv'], versions['classification'])
+
+    def test_matches_unstored(self):
+        """Test stored products match those computed without a store"""
+
+        expected = va.get_value_added(
+            self.alerts, classifier_service=self.service,
+            classification_cache=classify.ClassificationCache())
+        first = self.get_value_added(self.alerts)
+        second = self.get_value_added(self.alerts)
+
+        self.assertListEqual(first[0], expected[0])
+        self.assertListEqual(first[1], expected[1])
+        self.assertEqual(first, second)
+        self.assertEqual(self.store.count('xmatch'), len(self.alerts))
+
+    def test_not_recomputed(self):
+        """Test only products missing from the store are computed"""
+
+        self.get_value_added(self.alerts[:1])
+        with mock.patch.object(xm, 'get_xmatches_table',
+                               wraps=xm.get_xmatches_table) as get_xmatches_table:
+            self.get_value_added(self.alerts)
+
+        alerts, = get_xmatches_table.call_args[0]
+        self.assertListEqual([a['candidate']['candid'] for a in alerts],
+                             self.candids[1:])
+
+    def test_grouped_by_alert(self):
+        """Test cross matches are stored by alert when catalogs add rows"""
+
+        # matches only the second alert, in a batch with two
+        # alerts of the same object
+        alerts = [deepcopy(self.alerts[0]), self.alerts[1], self.alerts[0]]
+        alerts[0]['candidate']['candid'] += 1
+        cand = self.alerts[1]['candidate']
+        catalog = LocalCatalog('Test', ['src'], [cand['ra']], [cand['dec']])
+
+        get_xmatches_table = xm.get_xmatches_table
+        with mock.patch.object(
+                xm, 'get_xmatches_table',
+                side_effect=lambda *args, **kwargs: get_xmatches_table(
+                    *args, catalogs=[catalog], **kwargs)):
+            self.get_value_added(alerts)
+
+        xmatches = self.store.get_many(
+            'xmatch', [a['candidate']['candid'] for a in alerts])
+        num_rows = [len(xmatches[a['candidate']['candid']]) for a in alerts]
+        self.assertListEqual(num_rows, [len(xm.PS1_SLOTS),
+                                        len(xm.PS1_SLOTS) + 1,
+                                        len(xm.PS1_SLOTS)])
+        self.assertEqual(xmatches[cand['candid']][-1]['xcatalog'], 'Test')
+        for alert in alerts:
+            rows = xmatches[alert['candidate']['candid']]
+            self.assertTrue(all(r['objectId'] == alert['objectId'] for r in rows))
+
+    def test_alert_index(self):
+        """Test the alert index of each cross match row"""
+
+        cand = self.alerts[1]['candidate']
+        catalog = LocalCatalog('Test', ['src'], [cand['ra']], [cand['dec']])
+        table, alert_index = xm.get_xmatches_table(
+            self.alerts, catalogs=[catalog], alert_index=True)
+
+        num_slots = len(xm.PS1_SLOTS)
+        np.testing.assert_array_equal(
+            alert_index, [0] * num_slots + [1] * num_slots + [1])
+        self.assertEqual(len(table), len(alert_index))
+
+        table, alert_index = xm.get_xmatches_table([], alert_index=True)
+        self.assertEqual(len(table), len(alert_index))
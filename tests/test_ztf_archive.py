@@ -3,9 +3,10 @@
 
 """This file provides tests for the ``broker.ztf_archive`` module."""
 
+from itertools import islice
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, mock
 import types
 from broker import ztf_archive as ztfa
 
@@ -76,6 +77,28 @@ class DownloadLogging(TestCase):
         self.assertIsInstance(next(alerts), int)
 
 
+class LocalListing(TestCase):
+    """Test the cached inventory of local ZTF data."""
+
+    def test_inventory_counts(self):
+        """Test the inventory agrees with the downloaded data"""
+
+        inventory = ztfa.get_local_inventory()
+        self.assertEqual(NUM_TEST_ALERTS, inventory.count())
+        self.assertEqual(NUM_TEST_ALERTS, inventory.count(TEST_RELEASE))
+        self.assertTrue(inventory.has_release(TEST_RELEASE))
+
+        alert_id = next(ztfa.get_local_alerts())
+        self.assertIn(alert_id, inventory)
+        self.assertEqual(TEST_RELEASE, inventory.get_release(alert_id))
+
+    def test_missing_alert(self):
+        """Test ``get_alert_data`` raises ValueError for unknown alerts"""
+
+        with self.assertRaises(ValueError):
+            ztfa.get_alert_data(-1)
+
+
 class DataParsing(TestCase):
     """Test the parsing of ZTF data."""
 
@@ -92,6 +115,17 @@ class DataParsing(TestCase):
         alert_list = next(ztfa.iter_alerts(10))
         self.assertEqual(len(alert_list), 10)
 
+    def test_iter_alerts_parallel(self):
+        """Test ``iter_alerts`` yields the same alerts when run in parallel"""
+
+        serial = list(islice(ztfa.iter_alerts(raw=True), 20))
+        parallel = list(islice(
+            ztfa.iter_alerts(raw=True, num_workers=2, chunk_size=3), 20))
+        self.assertListEqual(serial, parallel)
+
+        alert_list = next(ztfa.iter_alerts(10, num_workers=2))
+        self.assertEqual(len(alert_list), 10)
+
     def test_get_alert_data(self):
         """Test ``get_alert_data`` returns the correct data type."""
 
@@ -102,3 +136,215 @@ class DataParsing(TestCase):
 
         test_data_bytes = ztfa.get_alert_data(test_alert, raw=True)
         self.assertIsInstance(test_data_bytes, bytes)
+
+    def test_get_alert_data_fields(self):
+        """Test ``get_alert_data`` only returns the requested fields"""
+
+        test_alert = next(ztfa.get_local_alerts())
+        full_data = ztfa.get_alert_data(test_alert)
+
+        fields = ['objectId', 'prv_candidates', 'candidate.ra', 'candidate.dec']
+        data = ztfa.get_alert_data(test_alert, fields=fields)
+        self.assertSetEqual({'objectId', 'prv_candidates', 'candidate'}, set(data))
+        self.assertSetEqual({'ra', 'dec'}, set(data['candidate']))
+        self.assertEqual(full_data['candidate']['ra'], data['candidate']['ra'])
+        self.assertEqual(full_data['prv_candidates'], data['prv_candidates'])
+
+        with self.assertRaises(ValueError):
+            ztfa.get_alert_data(test_alert, fields=['not_a_field'])
+
+
+class AlertFiltering(TestCase):
+    """Test the selection of alerts using the local alert index."""
+
+    def test_index_size(self):
+        """Test ``get_alert_index`` has one entry per local alert"""
+
+        index = ztfa.get_alert_index()
+        self.assertEqual(len(index), NUM_TEST_ALERTS)
+        self.assertEqual(len(ztfa.get_alert_index(start_date='20180627')), 0)
+
+    def test_iter_release_indices(self):
+        """Test ``iter_release_indices`` yields each release in the date range"""
+
+        (release, index), = ztfa.iter_release_indices(end_date='2018-06-26')
+        self.assertEqual(TEST_RELEASE, release)
+        self.assertEqual(len(index), NUM_TEST_ALERTS)
+        self.assertListEqual([], list(ztfa.iter_release_indices(start_date='20180627')))
+
+    def test_iter_alerts_filters(self):
+        """Test ``iter_alerts`` only yields alerts passing the filters"""
+
+        filters = {'fid': 1, 'min_rb': 0.5}
+        expected = len(ztfa.select_alerts(**filters))
+        alerts = list(ztfa.iter_alerts(filters=filters, fields=['candidate']))
+
+        self.assertEqual(expected, len(alerts))
+        for alert in alerts:
+            self.assertEqual(1, alert['candidate']['fid'])
+            self.assertGreaterEqual(alert['candidate']['rb'], 0.5)
+
+
+class SpatialQueries(TestCase):
+    """Test cone and polygon searches over local alerts."""
+
+    def test_cone_search(self):
+        """Test ``cone_search`` finds an alert at its own position"""
+
+        entry = ztfa.get_alert_index()[0]
+        alert_ids = ztfa.cone_search(entry['ra'], entry['dec'], 1 / 3600)
+        self.assertIn(entry['alert_id'], alert_ids)
+
+        alerts = ztfa.cone_search(
+            entry['ra'], entry['dec'], 1 / 3600, decode=True, fields=['candid'])
+        self.assertIn(entry['candid'], [a['candid'] for a in alerts])
+
+    def test_polygon_search(self):
+        """Test ``polygon_search`` finds an alert inside a small square"""
+
+        entry = ztfa.get_alert_index()[0]
+        ra, dec, size = entry['ra'], entry['dec'], 0.01
+        square = [
+            (ra - size, dec - size), (ra + size, dec - size),
+            (ra + size, dec + size), (ra - size, dec + size)]
+
+        self.assertIn(entry['alert_id'], ztfa.polygon_search(square))
+
+    def test_current_index_not_loaded(self):
+        """Test repeated searches do not load the alert index"""
+
+        entry = ztfa.get_alert_index()[0]
+        ztfa.cone_search(entry['ra'], entry['dec'], 1 / 3600)
+
+        spatial = ztfa._spatial
+        with mock.patch.object(spatial, 'get_alert_index') as get_alert_index:
+            spatial._spatial_index_memo.clear()  # Reload the saved kd-tree
+            ztfa.cone_search(entry['ra'], entry['dec'], 1 / 3600)
+
+        get_alert_index.assert_not_called()
+
+
+class LightCurves(TestCase):
+    """Test the assembly of light curves from local alerts."""
+
+    def test_epochs_deduplicated(self):
+        """Test light curves contain no duplicate epochs"""
+
+        store = ztfa.LightCurveStore()
+        alerts = list(islice(ztfa.iter_alerts(), 50))
+        store.update_many(alerts)
+        store.update_many(alerts)  # Repeated alerts should not add epochs
+
+        for object_id in store.object_ids():
+            epochs = store[object_id]
+            keys = set(zip(epochs['jd'].tolist(), epochs['fid'].tolist()))
+            self.assertEqual(len(keys), len(epochs))
+
+    def test_save_load(self):
+        """Test a saved store is loaded with the same light curves"""
+
+        store = ztfa.LightCurveStore()
+        store.update_many(islice(ztfa.iter_alerts(), 50))
+
+        with TemporaryDirectory() as out_dir:
+            path = Path(out_dir) / 'light_curves.npz'
+            store.save(path)
+            loaded = ztfa.LightCurveStore.load(path)
+
+        self.assertListEqual(store.object_ids(), loaded.object_ids())
+        for object_id in store.object_ids():
+            self.assertListEqual(
+                store.get_epochs(object_id), loaded.get_epochs(object_id))
+
+
+class CutoutDecoding(TestCase):
+    """Test the batch decoding of alert cutouts."""
+
+    def test_get_cutouts(self):
+        """Test ``get_cutouts`` returns stacked float32 arrays"""
+
+        alerts = list(islice(ztfa.iter_alerts(), 10))
+        cache = ztfa.CutoutCache(maxsize=5)
+        cutouts = ztfa.get_cutouts(alerts, num_workers=2, cache=cache)
+
+        for cutout_type in ('science', 'template', 'difference'):
+            self.assertEqual('float32', cutouts[cutout_type].dtype)
+            self.assertEqual(10, len(cutouts[cutout_type]))
+
+        self.assertEqual(10, len(cutouts['headers']))
+        self.assertEqual(5, len(cache))
+
+    def test_render_thumbnails(self):
+        """Test ``render_thumbnails`` writes one PNG per alert"""
+
+        alerts = list(islice(ztfa.iter_alerts(), 3))
+        with TemporaryDirectory() as out_dir:
+            paths = ztfa.render_thumbnails(alerts, out_dir)
+            self.assertEqual(3, len(paths))
+            self.assertTrue(all(p.exists() for p in paths))
+
+
+class ColumnarExport(TestCase):
+    """Test the export of local alerts to Parquet files."""
+
+    def test_export_release(self):
+        """Test exported tables contain one candidate per alert"""
+
+        with TemporaryDirectory() as out_dir:
+            ztfa.export_release(TEST_RELEASE, out_dir)
+            candidates = ztfa.read_exported_table('candidates', out_dir)
+            self.assertEqual(len(candidates), NUM_TEST_ALERTS)
+            self.assertSetEqual({TEST_RELEASE}, set(candidates['night']))
+
+            prv_candidates = ztfa.read_exported_table(
+                'prv_candidates', out_dir, columns=['objectId', 'jd', 'fid'])
+            self.assertFalse(prv_candidates.duplicated().any())
+
+    def test_dedup_across_nights(self):
+        """Test previous epochs exported for another night are not repeated"""
+
+        import shutil
+
+        with TemporaryDirectory() as out_dir:
+            ztfa.export_release(TEST_RELEASE, out_dir)
+
+            # pretend the same epochs were exported for an earlier night
+            table_dir = Path(out_dir) / 'prv_candidates'
+            shutil.copytree(table_dir / f'night={TEST_RELEASE}',
+                            table_dir / 'night=20180625')
+            ztfa.export_release(TEST_RELEASE, out_dir)
+
+            prv_candidates = ztfa.read_exported_table(
+                'prv_candidates', out_dir, columns=['objectId', 'jd', 'fid', 'night'])
+            self.assertFalse(
+                prv_candidates[['objectId', 'jd', 'fid']].duplicated().any())
+            self.assertSetEqual({'20180625'}, set(prv_candidates['night']))
+
+
+class RemoteManifest(TestCase):
+    """Test the parsing of the MD5SUMS file from the ZTF Alerts Archive"""
+
+    md5_text = (
+        f'{"a" * 32}  ztf_public_20180627.tar.gz\n'
+        f'{"b" * 32}  ztf_public_20180626.tar.gz\n'
+    )
+
+    def test_release_date(self):
+        """Test ``get_release_date`` parses dates from release file names"""
+
+        self.assertEqual(
+            TEST_RELEASE, ztfa.get_release_date('ztf_public_20180626.tar.gz'))
+        self.assertIsNone(ztfa.get_release_date('MD5SUMS'))
+
+    def test_manifest_index(self):
+        """Test ``ReleaseManifest`` indexes files by name and date"""
+
+        manifest = ztfa.ReleaseManifest(self.md5_text)
+        self.assertEqual(2, len(manifest))
+        self.assertIn('ztf_public_20180626.tar.gz', manifest)
+        self.assertEqual('b' * 32, manifest.md5['ztf_public_20180626.tar.gz'])
+        self.assertEqual(
+            'ztf_public_20180627.tar.gz', manifest.files_by_date['20180627'])
+        self.assertListEqual(
+            ['ztf_public_20180627.tar.gz', 'ztf_public_20180626.tar.gz'],
+            list(manifest))